@@ -0,0 +1,170 @@
+"""
+Summarizes difference caches without committing them
+Counts changed posts per field, most added and removed tags, and rating and score changes per year or id range
+Files are indexed in parallel like commit_differences.merge_differences does, so only the latest entry of each post is counted,
+then worker processes read and count chunks of latest entries, every line is read once by one worker
+"""
+
+import argparse
+from collections import Counter
+from multiprocessing import Pool
+import numpy as np
+from tqdm import tqdm
+
+from utils import jsoncodec
+from commit_differences import latest_entries, bounded_imap
+from utils.cachestore import CACHE_FILE_ORDERS, expand_cache_files
+
+# creation year per post id, set in each worker process by init_worker
+years = None
+
+def init_worker(worker_years):
+    global years
+    years = worker_years
+
+def empty_stats():
+    return {
+        "posts": Counter(),
+        "fields": Counter(),
+        "added": Counter(),
+        "removed": Counter(),
+        "groups": Counter(),
+        "ratings": Counter(),
+    }
+
+def add_difference(stats, difference, group):
+    """
+    Adds one post difference to stats
+    For values, difference holds the database value, so changes are counted by previous value
+    """
+    if difference is None:
+        stats["posts"]["failed"] += 1
+        return
+    new_dict, old_dict = difference
+    if new_dict is None:
+        stats["posts"]["missing_in_database"] += 1
+        stats["groups"][(group, "missing_in_database")] += 1
+        return
+    if not new_dict and not old_dict:
+        stats["posts"]["unchanged"] += 1
+        stats["groups"][(group, "unchanged")] += 1
+        return
+    stats["posts"]["changed"] += 1
+    stats["groups"][(group, "changed")] += 1
+    for key in new_dict.keys() | old_dict.keys():
+        stats["fields"][key] += 1
+        if "tag_list" in key:
+            stats["added"].update(new_dict.get(key, ()))
+            stats["removed"].update(old_dict.get(key, ()))
+    if "rating" in new_dict:
+        stats["groups"][(group, "rating_changed")] += 1
+        stats["ratings"][(group, new_dict["rating"])] += 1
+    if "score" in new_dict:
+        stats["groups"][(group, "score_changed")] += 1
+        stats["groups"][(group, "previous_score_sum")] += new_dict["score"] or 0
+
+def summarize_entries(filepath, offsets, group_size=1000000):
+    """
+    Returns stats of lines at offsets of filepath, runs in worker process
+    Offsets are the latest entries of their posts from latest_entries, so every post is counted once
+    """
+    stats = empty_stats()
+    with open(filepath, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            try:
+                entry = jsoncodec.loads(f.readline())
+                post_id = int(entry["id"])
+                difference = entry["difference"]
+            except Exception as e:
+                continue
+            if years is not None:
+                group = int(years[post_id]) if post_id < len(years) and years[post_id] else "unknown"
+            else:
+                group = f"{post_id - post_id % group_size}..{post_id - post_id % group_size + group_size - 1}"
+            add_difference(stats, difference, group)
+    return stats
+
+def merge_stats(target, stats):
+    for name, counter in stats.items():
+        target[name].update(counter)
+    return target
+
+def load_years(batch_size=100000):
+    """
+    Returns int16 array of creation year per post id, read from the database
+    """
+    from db import Post
+    database = Post._meta.database
+    years = np.zeros(0, dtype=np.int16)
+    last_id = -1
+    while True:
+        query = Post.select(Post.id, Post.created_at).where(Post.id > last_id).order_by(Post.id).limit(batch_size)
+        rows = database.execute(query).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        if last_id >= len(years):
+            years = np.concatenate([years, np.zeros(last_id + 1 - len(years) + len(years) // 2, dtype=np.int16)])
+        for post_id, created_at in rows:
+            if created_at:
+                years[post_id] = int(str(created_at)[:4])
+    return years
+
+def build_summary(stats, top=50):
+    groups = {}
+    for (group, name), value in stats["groups"].items():
+        groups.setdefault(str(group), {})[name] = value
+    for (group, rating), value in stats["ratings"].items():
+        groups.setdefault(str(group), {}).setdefault("previous_ratings", {})[rating] = value
+    return {
+        "posts": dict(stats["posts"]),
+        "fields": dict(stats["fields"].most_common()),
+        "most_added_tags": stats["added"].most_common(top),
+        "most_removed_tags": stats["removed"].most_common(top),
+        "groups": dict(sorted(groups.items())),
+    }
+
+def print_summary(summary, top=20):
+    print(f"Posts: {summary['posts']}")
+    print("Changed posts per field:")
+    for field, count in summary["fields"].items():
+        print(f"  {field:<24}{count:>12}")
+    for title, key in (("Most added tags:", "most_added_tags"), ("Most removed tags:", "most_removed_tags")):
+        print(title)
+        for tag, count in summary[key][:top]:
+            print(f"  {str(tag):<40}{count:>12}")
+    print("Per group:")
+    for group, values in summary["groups"].items():
+        changed = values.get("changed", 0)
+        print(f"  {group:<24} changed {changed:>10}, rating changed {values.get('rating_changed', 0):>8}, score changed {values.get('score_changed', 0):>8}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize difference caches')
+    # usage : python analyze_differences.py "difference_cache_*.jsonl" --processes 8 --output difference_summary.json
+    parser.add_argument('patterns', type=str, nargs='*', default=["difference_cache*.jsonl"], help='Glob patterns of difference cache files')
+    parser.add_argument('--processes', type=int, default=4, help='Number of worker processes')
+    parser.add_argument('--order', type=str, default="name", choices=CACHE_FILE_ORDERS, help='Merge order of files, later files win, same as commit_differences.py')
+    parser.add_argument('--output', type=str, default="difference_summary.json", help='Summary json file')
+    parser.add_argument('--years', action="store_true", help='Group by creation year from database instead of id range')
+    parser.add_argument('--group-size', type=int, default=1000000, help='Id range per group if not grouped by year')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='Entries per worker task')
+    parser.add_argument('--top', type=int, default=50, help='Number of most added and removed tags in summary')
+    args = parser.parse_args()
+    filepaths = expand_cache_files(args.patterns, args.order)
+    if not filepaths:
+        raise FileNotFoundError(f"No difference cache files found for {args.patterns}")
+    stats = empty_stats()
+    with Pool(processes=args.processes, initializer=init_worker, initargs=(load_years() if args.years else None,)) as pool:
+        entries = latest_entries(filepaths, pool, committable_only=False, window=args.processes * 2)
+        tasks = [
+            (filepath, offsets[start:start + args.chunk_size], args.group_size)
+            for filepath, offsets in entries for start in range(0, len(offsets), args.chunk_size)
+        ]
+        for chunk_stats in tqdm(bounded_imap(pool, summarize_entries, tasks, args.processes * 2), total=len(tasks), desc="Summarizing"):
+            merge_stats(stats, chunk_stats)
+    summary = build_summary(stats, top=args.top)
+    with open(args.output, "wb") as f:
+        f.write(jsoncodec.dumps(summary))
+    print_summary(summary)
+    print(f"Wrote summary of {len(filepaths)} files to {args.output}")
@@ -0,0 +1,136 @@
+"""
+Local stand-in for the proxy server used by utils/proxyhandler.ProxyHandler and sanity_check.ProxyHandler
+Implements get_response, get_response_raw, file_size and filepart with synthetic data
+Latency, error rate and rate limit (429) rate are configurable
+"""
+
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from benchmarks.synthetic import synthetic_post, file_size, file_content
+
+class FakeProxyConfig:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, post_count=100000, tag_count=1000):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.post_count = post_count
+        self.tag_count = tag_count
+        self.lock = threading.Lock()
+        self.requests = {}
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+    def total_requests(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+def query_posts(url, config:FakeProxyConfig):
+    """
+    Returns synthetic posts.json or tags.json response for url
+    page=a{id} returns the first limit items after id, like danbooru cursor pages
+    """
+    after = re.search(r"page=a(\d+)", url)
+    limit = re.search(r"limit=(\d+)", url)
+    if "tags.json" in url:
+        start = re.search(r"id_ge\]=(\d+)", url)
+        end = re.search(r"id_lt\]=(\d+)", url)
+        start, end = (int(start.group(1)) if start else 1), (int(end.group(1)) if end else 1 << 31)
+        if after is not None:
+            start = max(start, int(after.group(1)) + 1)
+        end = min(end, config.tag_count * 5 + 1)
+        if after is not None and limit is not None:
+            end = min(end, max(start, 1) + int(limit.group(1)))
+        return [{"id": i, "name": f"tag_{i}", "post_count": i % 1000, "category": 0} for i in range(max(start, 1), end)]
+    match = re.search(r"id(?:%3A|:)(\d+)\.\.(\d+)", url)
+    if match is None:
+        return []
+    start, end = int(match.group(1)), min(int(match.group(2)), config.post_count)
+    if after is not None:
+        start = max(start, int(after.group(1)) + 1)
+        if limit is not None:
+            end = min(end, max(start, 1) + int(limit.group(1)) - 1)
+    return [synthetic_post(i, tag_count=config.tag_count) for i in range(max(start, 1), end + 1)]
+
+def get_post_id(url):
+    match = re.search(r"/(\d+)\.\w+$", url)
+    return int(match.group(1)) if match else None
+
+def make_handler(config:FakeProxyConfig):
+    class FakeProxyHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def log_message(self, format, *args):
+            pass
+        def send(self, status, body:bytes, content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            endpoint = parsed.path.strip("/")
+            params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+            config.count(endpoint or "root")
+            if config.latency or config.jitter:
+                time.sleep(config.latency + random.random() * config.jitter)
+            if not endpoint:
+                return self.send(200, b"ok", "text/plain")
+            roll = random.random()
+            if roll < config.rate_limit_rate:
+                return self.send(429, b"Too Many Requests", "text/plain")
+            if roll < config.rate_limit_rate + config.error_rate:
+                return self.send(500, b"Internal Server Error", "text/plain")
+            url = params.get("url", "")
+            if endpoint == "get_response":
+                body = json.dumps({"success": True, "response": json.dumps(query_posts(url, config))}).encode()
+                return self.send(200, body)
+            if endpoint == "get_response_raw":
+                post_id = get_post_id(url)
+                if post_id is None:
+                    return self.send(200, json.dumps(query_posts(url, config)).encode())
+                return self.send(200, file_content(post_id), "image/jpeg")
+            if endpoint == "file_size":
+                post_id = get_post_id(url)
+                return self.send(200, str(file_size(post_id)).encode(), "text/plain")
+            if endpoint == "filepart":
+                post_id = get_post_id(url)
+                # end is inclusive
+                return self.send(200, file_content(post_id, int(params["start"]), int(params["end"]) + 1), "application/octet-stream")
+            return self.send(404, b"Not Found", "text/plain")
+    return FakeProxyHandler
+
+def start_fake_proxy(config:FakeProxyConfig, host="127.0.0.1", port=0):
+    """
+    Starts fake proxy in background thread, returns server, address is http://{host}:{server.server_port}/
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fake proxy server with synthetic data')
+    # usage : python -m benchmarks.fake_proxy --port 8080 --latency 0.05 --error-rate 0.01 --rate-limit-rate 0.01
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen')
+    parser.add_argument('--latency', type=float, default=0.0, help='Base latency per request in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Rate of 500 responses')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Rate of 429 responses')
+    parser.add_argument('--post-count', type=int, default=100000, help='Number of synthetic posts')
+    args = parser.parse_args()
+    config = FakeProxyConfig(args.latency, args.jitter, args.error_rate, args.rate_limit_rate, args.post_count)
+    server = start_fake_proxy(config, port=args.port)
+    print(f"Fake proxy listening on http://127.0.0.1:{server.server_port}/")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
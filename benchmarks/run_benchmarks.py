@@ -0,0 +1,161 @@
+"""
+Offline benchmark of sanity_check, download_post and update-database
+Runs each target as subprocess against local fake proxy and synthetic database
+Reports requests/s, posts/s and peak RSS of each target
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import importlib.util
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.fake_proxy import FakeProxyConfig, start_fake_proxy
+
+DOWNLOAD_DRIVER = """
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from download_post import download_post
+from utils.proxyhandler import ProxyHandler
+from benchmarks.synthetic import synthetic_post
+post_count, threads, wait_time, save_location = int(sys.argv[1]), int(sys.argv[2]), float(sys.argv[3]), sys.argv[4]
+handler = ProxyHandler("ips.txt", wait_time=wait_time, timeouts=20, proxy_auth="user:pass")
+with ThreadPoolExecutor(max_workers=threads) as executor:
+    for post_id in range(1, post_count + 1):
+        executor.submit(download_post, synthetic_post(post_id), handler, save_location=save_location, split_size=100000)
+"""
+
+UPDATE_DATABASE_DRIVER = """
+import sys
+import importlib.util
+from tqdm import tqdm
+spec = importlib.util.spec_from_file_location("update_database", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+module.handler.wait_time = float(sys.argv[3])
+queries = module.split_query(1, int(sys.argv[2]))
+module.pbar = tqdm(total=len(queries), disable=True)
+module.get_posts_threaded(queries)
+"""
+
+def prepare_workdir(workdir, proxy_address, post_count, tag_count, drift):
+    """
+    Copies db.py to workdir and creates synthetic database next to it
+    Scripts are run with workdir as cwd and first entry of PYTHONPATH, so they use the synthetic database
+    """
+    os.makedirs(workdir, exist_ok=True)
+    spec = importlib.util.find_spec("db")
+    if spec is None or spec.origin is None:
+        raise FileNotFoundError("db.py not found, locate db.py in the repository directory or PYTHONPATH")
+    if os.path.abspath(os.path.dirname(spec.origin)) != os.path.abspath(workdir):
+        shutil.copy(spec.origin, os.path.join(workdir, "db.py"))
+    with open(os.path.join(workdir, "ips.txt"), "w") as f:
+        f.write(proxy_address + "\n")
+    subprocess.run(
+        [sys.executable, "-m", "benchmarks.synthetic_db", "--output", os.path.join(workdir, "danbooru2023.db"),
+         "--post-count", str(post_count), "--tag-count", str(tag_count), "--drift", str(drift)],
+        cwd=workdir, env=get_env(workdir), check=True,
+    )
+
+def get_env(workdir):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([workdir, REPO_ROOT] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    return env
+
+def run_target(name, command, workdir, config:FakeProxyConfig, posts, stdin=b""):
+    """
+    Runs command and returns result dict with throughput and peak RSS
+    """
+    requests_before = config.total_requests()
+    start_time = time.time()
+    with open(os.path.join(workdir, f"{name}.out"), "wb") as output:
+        process = subprocess.Popen(command, cwd=workdir, env=get_env(workdir), stdin=subprocess.PIPE, stdout=output, stderr=subprocess.STDOUT)
+        process.stdin.write(stdin)
+        process.stdin.close()
+        if hasattr(os, "wait4"):
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in kilobytes on linux and bytes on macos
+            peak_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        else:
+            process.wait()
+            peak_rss = None
+    elapsed = time.time() - start_time
+    requests = config.total_requests() - requests_before
+    result = {
+        "target": name,
+        "exit_code": process.returncode,
+        "seconds": elapsed,
+        "requests": requests,
+        "requests_per_second": requests / elapsed,
+        "posts": posts,
+        "posts_per_second": posts / elapsed,
+        "peak_rss_mb": peak_rss / 1024 / 1024 if peak_rss is not None else None,
+    }
+    print(f"{name}: {elapsed:.1f}s, {result['requests_per_second']:.1f} requests/s, {result['posts_per_second']:.1f} posts/s, peak RSS {result['peak_rss_mb'] or 0:.1f} MB, exit code {process.returncode}")
+    return result
+
+def remove_files(workdir, names):
+    for name in names:
+        path = os.path.join(workdir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline benchmark with fake proxy and synthetic database')
+    # usage : python benchmarks/run_benchmarks.py --posts 20000 --latency 0.02 --error-rate 0.01 --output bench.json
+    parser.add_argument('--workdir', type=str, default="bench_workdir", help='Directory for synthetic database and outputs')
+    parser.add_argument('--posts', type=int, default=20000, help='Number of synthetic posts')
+    parser.add_argument('--tags', type=int, default=1000, help='Number of synthetic tags per tag type')
+    parser.add_argument('--drift', type=float, default=0.05, help='Rate of posts which differ between proxy and database')
+    parser.add_argument('--download-posts', type=int, default=2000, help='Number of posts to download')
+    parser.add_argument('--threads', type=int, default=32, help='Threads of each target')
+    parser.add_argument('--wait-time', type=float, default=0.0, help='Wait time between requests of proxy handler')
+    parser.add_argument('--latency', type=float, default=0.0, help='Fake proxy latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Fake proxy random extra latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fake proxy rate of 500 responses')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Fake proxy rate of 429 responses')
+    parser.add_argument('--targets', type=str, nargs='*', default=["sanity_check", "download_post", "update-database"], help='Targets to run')
+    parser.add_argument('--skip-prepare', action="store_true", help='Reuse synthetic database in workdir')
+    parser.add_argument('--output', type=str, default=None, help='Write results as json')
+    args = parser.parse_args()
+    workdir = os.path.abspath(args.workdir)
+    config = FakeProxyConfig(args.latency, args.jitter, args.error_rate, args.rate_limit_rate, post_count=args.posts, tag_count=args.tags)
+    server = start_fake_proxy(config)
+    proxy_address = f"http://127.0.0.1:{server.server_port}"
+    print(f"Fake proxy listening on {proxy_address}")
+    if not args.skip_prepare:
+        prepare_workdir(workdir, proxy_address, args.posts, args.tags, args.drift)
+    else:
+        with open(os.path.join(workdir, "ips.txt"), "w") as f:
+            f.write(proxy_address + "\n")
+    results = []
+    if "sanity_check" in args.targets:
+        remove_files(workdir, ["difference_cache_bench.jsonl", "requests_bench.jsonl", "post_patch_state_cache.bitmap", "tag_creation_cache.jsonl"])
+        results.append(run_target("sanity_check", [
+            sys.executable, os.path.join(REPO_ROOT, "sanity_check.py"), "--start-idx", "1", "--end-idx", str(args.posts),
+            "--threads", str(args.threads), "--retry", "30", "--proxy", "--proxy-address", proxy_address, "--proxy-auth", "user:pass",
+            "--logging-file", "sanity_check.log", "--save-file", "difference_cache_bench.jsonl", "--requests-cache", "requests_bench.jsonl",
+        ], workdir, config, args.posts, stdin=b"\n"))
+    if "download_post" in args.targets:
+        remove_files(workdir, ["downloads"])
+        results.append(run_target("download_post", [
+            sys.executable, "-c", DOWNLOAD_DRIVER, str(args.download_posts), str(args.threads), str(args.wait_time), os.path.join(workdir, "downloads") + "/",
+        ], workdir, config, args.download_posts))
+    if "update-database" in args.targets:
+        remove_files(workdir, ["post"])
+        results.append(run_target("update-database", [
+            sys.executable, "-c", UPDATE_DATABASE_DRIVER, os.path.join(REPO_ROOT, "update-database.py"), str(args.posts), str(args.wait_time),
+        ], workdir, config, args.posts))
+    server.shutdown()
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
@@ -0,0 +1,59 @@
+"""
+Deterministic synthetic danbooru data, shared by fake proxy and synthetic database
+Same post id always gives same post, so database and proxy agree except for drifted posts
+"""
+
+import random
+
+TAG_TYPES = ["general", "character", "artist", "meta", "copyright"]
+TAGS_PER_POST = {"general": 20, "character": 2, "artist": 1, "meta": 2, "copyright": 1}
+RATINGS = ["g", "s", "q", "e"]
+
+def tag_names(tag_count=1000):
+    """
+    Yields (name, type) of all synthetic tags
+    """
+    for tag_type in TAG_TYPES:
+        for i in range(tag_count):
+            yield f"{tag_type}_{i}", tag_type
+
+def file_size(post_id):
+    """
+    Returns synthetic file size of post
+    """
+    return 20000 + (post_id * 7919) % 200000
+
+def file_content(post_id, start=0, end=None):
+    """
+    Returns synthetic file bytes [start, end) of post
+    """
+    size = file_size(post_id)
+    end = size if end is None else min(end, size)
+    pattern = post_id.to_bytes(8, "little")
+    offset = start % len(pattern)
+    return (pattern * ((end - start) // len(pattern) + 2))[offset:offset + end - start]
+
+def synthetic_post(post_id, tag_count=1000, drift=0.0, drifted=False):
+    """
+    Returns post in danbooru posts.json format
+    If drifted, posts selected by drift rate get changed tags and score, this is the stale database version
+    """
+    rng = random.Random(post_id)
+    tags = {}
+    for tag_type in TAG_TYPES:
+        tags[tag_type] = sorted(rng.sample(range(tag_count), TAGS_PER_POST[tag_type]))
+    score = rng.randint(0, 500)
+    if drifted and random.Random(-post_id).random() < drift:
+        tags["general"] = tags["general"][1:] + [(tags["general"][0] + 1) % tag_count]
+        score = max(score - 10, 0)
+    return {
+        "id": post_id,
+        "created_at": f"{2005 + post_id % 19}-01-01T00:00:00.000-05:00",
+        "rating": RATINGS[rng.randrange(len(RATINGS))],
+        "score": score,
+        "fav_count": rng.randint(0, 1000),
+        "file_ext": "jpg",
+        "file_url": f"https://cdn.donmai.us/original/{post_id}.jpg",
+        "large_file_url": f"https://cdn.donmai.us/original/{post_id}.jpg",
+        **{f"tag_string_{tag_type}": " ".join(f"{tag_type}_{i}" for i in sorted(set(tags[tag_type]))) for tag_type in TAG_TYPES},
+    }
@@ -0,0 +1,76 @@
+"""
+Creates synthetic Post/Tag sqlite database with models from db.py
+Posts match benchmarks.synthetic, a fraction of posts is drifted so sanity_check finds differences
+"""
+
+import os
+import argparse
+from peewee import SqliteDatabase, chunked
+from tqdm import tqdm
+
+from benchmarks.synthetic import TAG_TYPES, tag_names, synthetic_post
+
+def default_value(field):
+    """
+    Returns placeholder value for not-null fields which synthetic data does not fill
+    """
+    if field.null:
+        return None
+    field_type = str(field.field_type).upper()
+    if "INT" in field_type:
+        return 0
+    if "BOOL" in field_type:
+        return False
+    if "FLOAT" in field_type or "REAL" in field_type or "DOUBLE" in field_type:
+        return 0.0
+    return ""
+
+def create_database(path, post_count=100000, tag_count=1000, drift=0.05, batch_size=1000):
+    """
+    Creates database at path, existing file is replaced
+    Returns path
+    """
+    from db import Post, Tag
+    if os.path.exists(path):
+        os.remove(path)
+    database = SqliteDatabase(path, pragmas={"journal_mode": "wal", "synchronous": "off"})
+    database.bind([Post, Tag], bind_refs=False, bind_backrefs=False)
+    database.connect()
+    database.create_tables([Tag, Post])
+    tag_ids = {}
+    with database.atomic():
+        for rows in chunked(tag_names(tag_count), batch_size):
+            Tag.insert_many([{"name": name, "type": tag_type, "popularity": 0} for name, tag_type in rows]).execute()
+        for tag_id, name in Tag.select(Tag.id, Tag.name).tuples():
+            tag_ids[name] = tag_id
+    post_fields = Post._meta.fields
+    template = {name: default_value(field) for name, field in post_fields.items() if not field.primary_key}
+    with database.atomic():
+        for ids in tqdm(chunked(range(1, post_count + 1), batch_size), total=(post_count + batch_size - 1) // batch_size, desc="Creating posts"):
+            rows = []
+            for post_id in ids:
+                post = synthetic_post(post_id, tag_count=tag_count, drift=drift, drifted=True)
+                row = dict(template)
+                row.update({key: value for key, value in post.items() if key in post_fields})
+                all_tags = []
+                for tag_type in TAG_TYPES:
+                    tags = [tag_ids[name] for name in post[f"tag_string_{tag_type}"].split(" ")]
+                    all_tags.extend(tags)
+                    if f"tag_list_{tag_type}" in post_fields:
+                        row[f"tag_list_{tag_type}"] = tags
+                if "tag_list" in post_fields:
+                    row["tag_list"] = all_tags
+                rows.append(row)
+            Post.insert_many(rows).execute()
+    database.close()
+    return path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create synthetic danbooru database')
+    # usage : python -m benchmarks.synthetic_db --output bench/danbooru2023.db --post-count 100000
+    parser.add_argument('--output', type=str, default="danbooru2023.db", help='Database file')
+    parser.add_argument('--post-count', type=int, default=100000, help='Number of posts')
+    parser.add_argument('--tag-count', type=int, default=1000, help='Number of tags per tag type')
+    parser.add_argument('--drift', type=float, default=0.05, help='Rate of posts which differ from fake proxy')
+    args = parser.parse_args()
+    create_database(args.output, post_count=args.post_count, tag_count=args.tag_count, drift=args.drift)
@@ -3,87 +3,336 @@ Reads and commits differences from difference_cache.jsonl to database
 Returns number of differences committed
 """
 
-import glob
+import re
+import argparse
+from array import array
+from collections import deque, defaultdict
+from multiprocessing import Pool, get_context
+from concurrent.futures import ProcessPoolExecutor
 from random import random, choice
 from db import *
 import os
 import json
+from utils import jsoncodec
+from utils.cachestore import CACHE_FILE_ORDERS, expand_cache_files
+from peewee import chunked
 from tqdm import tqdm
+import numpy as np
+
+TAG_LIST_FIELDS = ["tag_list_general", "tag_list_character", "tag_list_artist", "tag_list_meta", "tag_list_copyright"]
+# tag lists are stored as delimited tag ids, only the numbers are needed
+TAG_ID_PATTERN = re.compile(r"\d+")
 
 def is_different(diff_0, diff_1):
     if not diff_0 and not diff_1:
         return False
     return True
     
+def is_committable(difference):
+    """
+    Returns True if difference changes an existing post
+    """
+    return bool(difference) and difference[0] is not None and is_different(difference[0], difference[1])
+
 def get_differences(filepath):
     """
     Reads differences from difference_cache.jsonl
     Returns list of differences
     """
     differences = {}
-    with open(filepath, 'r') as file:
-        for line in file:
-            try:
-                loaded_dict = json.loads(line)
-                if not loaded_dict['difference']:
-                    continue
-                if not is_different(loaded_dict['difference'][0], loaded_dict['difference'][1]):
-                    continue
-                differences[loaded_dict['id']] = loaded_dict['difference']
-            except:
-                pass
+    for loaded_dict in jsoncodec.iter_jsonl(filepath):
+        try:
+            if not is_committable(loaded_dict['difference']):
+                continue
+            differences[loaded_dict['id']] = loaded_dict['difference']
+        except:
+            pass
     return differences
 
-def commit_differences(differences):
+def bounded_imap(pool, function, tasks, window=8):
+    """
+    Yields function(*task) of tasks in order, at most window tasks are queued in pool
+    pool.imap would buffer all results when they are consumed slower than workers produce them
     """
-    Commits differences to database
-    Returns number of differences committed
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, task))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def index_differences(filepath):
+    """
+    Returns (ids, offsets, committable) arrays of lines of difference cache file, runs in worker process
+    Malformed lines are skipped
+    """
+    ids, offsets, committable = array("q"), array("q"), bytearray()
+    offset = 0
+    with open(filepath, "rb") as f:
+        for line in f:
+            try:
+                loaded_dict = jsoncodec.loads(line)
+                post_id = int(loaded_dict['id'])
+                line_committable = is_committable(loaded_dict['difference'])
+            except Exception as e:
+                post_id = -1
+            if post_id >= 0:
+                ids.append(post_id)
+                offsets.append(offset)
+                committable.append(line_committable)
+            offset += len(line)
+    return np.frombuffer(ids, dtype=np.int64), np.frombuffer(offsets, dtype=np.int64), np.frombuffer(committable, dtype=bool)
+
+def latest_entries(filepaths, pool, committable_only=True, window=8):
     """
-    for ids in tqdm(differences):
-        if not is_different(differences[ids][0], differences[ids][1]):
+    Returns list of (filepath, sorted offsets) of the latest line of each post id in difference cache files
+    filepaths are in merge order of expand_cache_files, files are indexed in parallel, entries of later files and later lines of same file win
+    Only id arrays of one file and a flag per post id are kept while resolving
+    If committable_only, posts whose latest entry is up to date are left out
+    """
+    filepaths = list(reversed(filepaths))
+    claimed = np.zeros(0, dtype=bool)
+    entries = []
+    # newest file first, ids claimed by newer files are skipped in older files
+    for filepath, (ids, offsets, committable) in zip(filepaths, bounded_imap(pool, index_differences, ((filepath,) for filepath in filepaths), window)):
+        if not len(ids):
             continue
-        commit_difference(ids, differences[ids])
-def commit_difference(id, difference):
+        unique_ids, reversed_index = np.unique(ids[::-1], return_index=True)
+        last = len(ids) - 1 - reversed_index
+        if unique_ids[-1] >= len(claimed):
+            claimed = np.concatenate([claimed, np.zeros(unique_ids[-1] + 1 - len(claimed), dtype=bool)])
+        latest = last[~claimed[unique_ids]]
+        claimed[unique_ids] = True
+        if committable_only:
+            latest = latest[committable[latest]]
+        print(f"Indexed {len(ids)} entries from {filepath}, {len(latest)} latest")
+        entries.append((filepath, np.sort(offsets[latest])))
+    entries.reverse()
+    return entries
+
+def read_entries(filepath, offsets):
+    """
+    Returns list of (post id, difference) of lines at offsets, runs in worker process
+    """
+    result = []
+    with open(filepath, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            loaded_dict = jsoncodec.loads(f.readline())
+            result.append((loaded_dict['id'], loaded_dict['difference']))
+    return result
+
+def merge_differences(filepaths, pool, chunk_size=10000, window=8):
     """
-    Commits difference to database
+    Merges difference cache files, latest entry of each post wins as in latest_entries
+    Returns (number of posts, iterator of (post id, difference)), lines are read and parsed by pool while the iterator is consumed
+    """
+    entries = latest_entries(filepaths, pool, window=window)
+    total = sum(len(offsets) for _, offsets in entries)
+    tasks = [(filepath, offsets[start:start + chunk_size]) for filepath, offsets in entries for start in range(0, len(offsets), chunk_size)]
+    def iterate():
+        for pairs in bounded_imap(pool, read_entries, tasks, window):
+            yield from pairs
+    return total, iterate()
+
+def parse_tag_ids(value):
+    """
+    Returns list of tag ids of raw tag list column value
+    """
+    return [int(tag_id) for tag_id in TAG_ID_PATTERN.findall(value)] if value else []
+
+def load_tag_lists(post_ids, fields=TAG_LIST_FIELDS):
     """
-    if difference:
-        post_by_id = Post.get_by_id(id)
+    Returns dict of post id -> {field: [tag ids]} for posts which exist
+    Raw column values are read through the cursor, so tag lists are never converted to Tag objects
+    """
+    query = Post.select(Post.id, *[getattr(Post, field) for field in fields]).where(Post.id.in_(post_ids))
+    return {row[0]: dict(zip(fields, map(parse_tag_ids, row[1:]))) for row in Post._meta.database.execute(query)}
+
+def get_tag_names(tag_ids, chunk_size=500):
+    """
+    Returns dict of tag id -> tag name, tags are queried in chunks
+    """
+    tag_names = {}
+    for ids in chunked(list(tag_ids), chunk_size):
+        for tag_id, name in Tag.select(Tag.id, Tag.name).where(Tag.id.in_(ids)).tuples():
+            tag_names[tag_id] = name
+    return tag_names
+
+def resolve_tags(differences, tags=None, chunk_size=500, create=True):
+    """
+    Resolves all tag names to be added in differences with one pass
+    Tags which are not in database are created if create, names already in tags are not queried again
+    If not create, missing names are mapped to (name, type) placeholders instead of tag ids, so their usage can be counted before they exist
+    Returns dict of tag name -> tag id
+    """
+    tags = {} if tags is None else tags
+    tag_types = {}
+    for difference in differences:
         new_dict, old_dict = difference
         for keys in new_dict:
             if keys not in old_dict:
-                post_by_id.__setattr__(keys, new_dict[keys])
-            else:
-                # replace old value with new value
-                if "tag" not in keys:
-                    print(f"Warning: {keys} is not a tag")
-                current_value = post_by_id.__getattribute__(keys)
-                target_values_to_remove = old_dict[keys]
-                target_values_to_add = new_dict[keys]
-                # remove old values
-                for values in current_value:
-                    name = values.name
-                    if name in target_values_to_remove:
-                        current_value.remove(values)
-                # add new values
-                for values in target_values_to_add:
-                    # no int values allowed
-                    assert isinstance(values, str), f"Error: {values} is not a string"
-                    tag = Tag.get_or_none(Tag.name == values)
-                    if tag is None:
-                        print(f"Warning: {values} is not in database, adding")
-                        tag = Tag.create(name=values, type=keys.split("_")[-1], popularity=0)
-                    # assert unique, tag should not be iterable
-                    assert not isinstance(tag, list), f"Error: {tag} is iterable"
-                    current_value.append(tag)
-        post_by_id.save()
-    else:
-        return
+                continue
+            for values in new_dict[keys]:
+                # no int values allowed
+                assert isinstance(values, str), f"Error: {values} is not a string"
+                if values not in tags:
+                    tag_types.setdefault(values, keys.split("_")[-1])
+    for names in chunked(list(tag_types), chunk_size):
+        for tag_id, name in Tag.select(Tag.id, Tag.name).where(Tag.name.in_(names)).tuples():
+            tags[name] = tag_id
+    missing = [name for name in tag_types if name not in tags]
+    if missing and create:
+        print(f"Warning: {len(missing)} tags are not in database, adding")
+        for names in chunked(missing, chunk_size):
+            Tag.insert_many([{"name": name, "type": tag_types[name], "popularity": 0} for name in names]).execute()
+            for tag_id, name in Tag.select(Tag.id, Tag.name).where(Tag.name.in_(names)).tuples():
+                tags[name] = tag_id
+    elif missing:
+        for name in missing:
+            tags[name] = (name, tag_types[name])
+    return tags
+
+def apply_difference(difference, tag_lists, tag_names, tags):
+    """
+    Applies difference to tag lists of one post loaded by load_tag_lists
+    tag_names maps current tag ids to names, tags maps added tag names to ids, names which are not in tags are not added
+    Returns dict of changed field -> new value, tag lists are lists of tag ids
+    """
+    new_dict, old_dict = difference
+    changed = {}
+    for keys in new_dict:
+        if keys not in old_dict:
+            changed[keys] = new_dict[keys]
+            continue
+        # replace old value with new value
+        if keys not in tag_lists:
+            print(f"Warning: {keys} is not a tag")
+            continue
+        target_values_to_remove = set(old_dict[keys])
+        current_ids = [tag_id for tag_id in tag_lists[keys] if tag_names.get(tag_id) not in target_values_to_remove]
+        seen_ids = set(current_ids)
+        for values in new_dict[keys]:
+            tag_id = tags.get(values)
+            if tag_id is None or tag_id in seen_ids:
+                continue
+            seen_ids.add(tag_id)
+            current_ids.append(tag_id)
+        changed[keys] = current_ids
+    return changed
+
+def removed_tag_ids(differences, tag_lists):
+    """
+    Returns ids of current tags of posts in tag lists which differences may remove
+    """
+    tag_ids = set()
+    for ids, (new_dict, old_dict) in differences:
+        if ids not in tag_lists:
+            continue
+        for keys in old_dict:
+            if keys in new_dict and keys in tag_lists[ids]:
+                tag_ids.update(tag_lists[ids][keys])
+    return tag_ids
+
+def count_tag_changes(tag_deltas, tag_lists, changed):
+    """
+    Adds +1 for tags added to and -1 for tags removed from tag lists of one post by changed fields of apply_difference
+    """
+    for keys, value in changed.items():
+        if keys not in tag_lists:
+            continue
+        before, after = set(tag_lists[keys]), set(value)
+        for tag_id in after - before:
+            tag_deltas[tag_id] += 1
+        for tag_id in before - after:
+            tag_deltas[tag_id] -= 1
+
+def commit_differences_bulk(differences, batch_size=500, total=None, tag_deltas=None, write=True):
+    """
+    Commits (post id, difference) pairs to database with batched statements
+    differences is streamed, tags of each batch are resolved with one pass and kept for later batches,
+    tag lists of posts are loaded as raw tag ids and updated per batch
+    If tag_deltas is given, usage changes of tags which are actually added or removed are added to it by tag id
+    If not write, nothing is written and missing tags are not created, tag_deltas then holds what a commit would change,
+    with tags which would be created keyed by (name, type) placeholders of resolve_tags
+    Should be called inside db.atomic()
+    Returns number of posts committed
+    """
+    tags = {}
+    committed = 0
+    pbar = tqdm(total=total)
+    for batch in chunked(differences, batch_size):
+        batch = [(ids, difference) for ids, difference in batch if is_committable(difference)]
+        resolve_tags((difference for _, difference in batch), tags, create=write)
+        tag_lists = load_tag_lists([ids for ids, _ in batch])
+        # only names of tags which may be removed are needed
+        tag_names = get_tag_names(removed_tag_ids(batch, tag_lists))
+        # bulk_update requires same fields for all posts
+        posts_by_fields = {}
+        for ids, difference in batch:
+            if ids not in tag_lists:
+                print(f"Warning: {ids} is not in database, skipping")
+                continue
+            # values such as year are not database fields, save() ignored them as well
+            changed = {field: value for field, value in apply_difference(difference, tag_lists[ids], tag_names, tags).items() if field in Post._meta.fields}
+            if tag_deltas is not None:
+                count_tag_changes(tag_deltas, tag_lists[ids], changed)
+            if changed:
+                # rows are not loaded, the instance only carries primary key and changed fields
+                posts_by_fields.setdefault(tuple(sorted(changed)), []).append(Post(id=ids, **changed))
+        if not write:
+            committed += sum(len(posts_to_update) for posts_to_update in posts_by_fields.values())
+            pbar.update(len(batch))
+            continue
+        for fields, posts_to_update in posts_by_fields.items():
+            # sqlite has limited number of variables per statement
+            Post.bulk_update(posts_to_update, fields=[getattr(Post, field) for field in fields], batch_size=max(1, 400 // (len(fields) * 2 + 1)))
+            committed += len(posts_to_update)
+        pbar.update(len(batch))
+    pbar.close()
+    return committed
+
+def sample_stream(pairs, sample):
+    """
+    Yields pairs, sample is left with one uniformly chosen pair as {post id: difference}
+    """
+    for count, (ids, difference) in enumerate(pairs, 1):
+        if random() * count < 1:
+            sample.clear()
+            sample[ids] = difference
+        yield ids, difference
+
 def main(filepath="difference_cache.jsonl"):
     print(f"Reading differences from {filepath}")
     differences = get_differences(filepath)
     with db.atomic():# commit all changes at once
-        commit_differences(differences)
+        committed = commit_differences_bulk(differences.items(), total=len(differences))
+    print(f"Committed {committed} posts")
+    show_sample(differences)
+
+def main_merged(filepaths, processes=None, batch_size=500, update_popularity=False):
+    """
+    Merges all difference cache files and streams them into one transaction
+    If update_popularity, popularity of tags added or removed by the commit is updated in the same transaction
+    """
+    print(f"Merging differences from {len(filepaths)} files")
+    sample = {}
+    tag_deltas = defaultdict(int) if update_popularity else None
+    with Pool(processes=processes) as pool:
+        total, differences = merge_differences(filepaths, pool, window=(processes or os.cpu_count() or 1) * 2)
+        print(f"Total {total} posts with differences")
+        with db.atomic():# commit all changes at once
+            committed = commit_differences_bulk(sample_stream(differences, sample), batch_size=batch_size, total=total, tag_deltas=tag_deltas)
+            if update_popularity:
+                from recompute_popularity import apply_tag_deltas
+                print(f"Updated popularity of {apply_tag_deltas(tag_deltas)} tags")
+    print(f"Committed {committed} posts")
+    show_sample(sample)
+
+def show_sample(differences):
+    if not differences:
+        return
     # sample random post from differences and show
     sample_post_id = choice(list(differences.keys()))
     print(f"Sample Post: {sample_post_id}")
@@ -126,10 +375,157 @@ def save_post(idx:int):
                 dump[field] = [tag.name for tag in dump[field]]
         json.dump(dump, file)
 
+def iterate_post_batches(batch_size=10000, start_id=0, end_id=None, fields=FIELDS_TO_EXTRACT):
+    """
+    Yields rows of fields of posts ordered by id in batches, paginated by last id instead of offset
+    Raw column values are read through the cursor, so tag lists are delimited tag ids and are never converted to Tag objects
+    """
+    names = list(fields.values())
+    id_index = names.index("id")
+    columns = [getattr(Post, name) for name in names]
+    database = Post._meta.database
+    last_id = start_id - 1
+    while True:
+        query = Post.select(*columns).where(Post.id > last_id)
+        if end_id is not None:
+            query = query.where(Post.id <= end_id)
+        rows = database.execute(query.order_by(Post.id).limit(batch_size)).fetchall()
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1][id_index]
+
+def prefetch_tag_names(rows, fields=FIELDS_TO_EXTRACT, chunk_size=500):
+    """
+    Returns dict of tag id -> tag name for all tags in rows of iterate_post_batches
+    Tag ids which are not in database are reported and left out
+    """
+    indices = [index for index, name in enumerate(fields.values()) if name.startswith("tag_list")]
+    tag_ids = set()
+    for row in rows:
+        for index in indices:
+            tag_ids.update(parse_tag_ids(row[index]))
+    tag_names = get_tag_names(tag_ids, chunk_size)
+    missing = tag_ids - tag_names.keys()
+    if missing:
+        print(f"Warning: {len(missing)} tag ids of posts are not in database, skipping them: {sorted(missing)[:10]}")
+    return tag_names
+
+def post_to_dict(row, tag_names, fields=FIELDS_TO_EXTRACT):
+    """
+    Converts row of iterate_post_batches to dict in save_post format, using prefetched tag names
+    Dangling tag ids which are not in tag_names are skipped
+    """
+    dump = {}
+    for (field, name), value in zip(fields.items(), row):
+        dump[field] = [tag_names[tag_id] for tag_id in parse_tag_ids(value) if tag_id in tag_names] if name.startswith("tag_list") else value
+    return dump
+
+def shard_bounds(shard_size, start_id=0, end_id=None):
+    """
+    Yields (first id, last id) of consecutive ranges with shard_size posts each, the last range may be smaller
+    Only the id index is read, rows of shards are loaded by export_shard
+    """
+    last_id = start_id - 1
+    while True:
+        query = Post.select(Post.id).where(Post.id > last_id)
+        if end_id is not None:
+            query = query.where(Post.id <= end_id)
+        first = query.order_by(Post.id).limit(1).scalar()
+        if first is None:
+            break
+        shard_last = query.order_by(Post.id).offset(shard_size - 1).limit(1).scalar()
+        if shard_last is None:
+            shard_last = query.order_by(Post.id.desc()).limit(1).scalar()
+        yield first, shard_last
+        last_id = shard_last
+
+def export_shard(filepath, start_id, end_id, batch_size=10000, output_format="jsonl"):
+    """
+    Reads posts in [start_id, end_id] and writes them to shard file, runs in worker process
+    Returns filepath and number of posts
+    """
+    rows = []
+    for posts in iterate_post_batches(batch_size=batch_size, start_id=start_id, end_id=end_id):
+        tag_names = prefetch_tag_names(posts)
+        rows.extend(post_to_dict(post, tag_names) for post in posts)
+    return write_shard(filepath, rows, output_format)
+
+def write_shard(filepath, rows, output_format="jsonl"):
+    """
+    Writes rows to shard file, returns filepath and number of rows
+    File is written to temporary path first, partially written shards are never visible
+    """
+    temp_path = filepath + ".tmp"
+    if output_format == "jsonl":
+        with open(temp_path, 'wb') as file:
+            file.write(b"".join(jsoncodec.dumps_line(row) for row in rows))
+    elif output_format == "parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("pyarrow is required for parquet output, install with pip install pyarrow")
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), temp_path)
+    else:
+        raise ValueError(f"Unknown output format {output_format}")
+    os.replace(temp_path, filepath)
+    return filepath, len(rows)
+
+def export_posts(folder="danbooru2023_fixed", batch_size=10000, shard_size=100000, workers=4, output_format="jsonl", start_id=0, end_id=None):
+    """
+    Exports posts as sharded jsonl or parquet files
+    Only id bounds of shards are computed here, worker processes read their range in batches with tag names prefetched,
+    then serialize and write it, so rows are never sent between processes
+    Workers are spawned and open their own database connection
+    Returns number of exported posts
+    """
+    if not os.path.exists(f"{folder}/posts"):
+        os.makedirs(f"{folder}/posts")
+    extension = "jsonl" if output_format == "jsonl" else "parquet"
+    exported = 0
+    shard_index = 0
+    pending = []
+    pbar = tqdm(desc="Exporting posts")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as executor:
+        def collect(future):
+            nonlocal exported
+            _, count = future.result()
+            exported += count
+            pbar.update(count)
+        for first_id, last_id in shard_bounds(shard_size, start_id=start_id, end_id=end_id):
+            # limit shards in flight, bounds are cheap and should not queue the whole table
+            while len(pending) >= workers * 2:
+                collect(pending.pop(0))
+            pending.append(executor.submit(export_shard, f"{folder}/posts/posts-{shard_index:05d}.{extension}", first_id, last_id, batch_size, output_format))
+            shard_index += 1
+        for future in pending:
+            collect(future)
+    pbar.close()
+    print(f"Exported {exported} posts to {shard_index} shards in {folder}/posts")
+    return exported
+
 if __name__ == "__main__":
-    jsonl_files = glob.glob(r"<path to difference_cache.jsonl>")
-    # sort by number
-    jsonl_files.sort()
-    for file in tqdm(jsonl_files):
-        main(file)
+    parser = argparse.ArgumentParser(description='Commit difference caches to database')
+    # usage : python commit_differences.py "difference_cache_*.jsonl" --processes 8
+    parser.add_argument('patterns', type=str, nargs='*', default=["difference_cache*.jsonl"], help='Glob patterns of difference cache files')
+    parser.add_argument('--processes', type=int, default=None, help='Number of processes to parse files')
+    parser.add_argument('--order', type=str, default="name", choices=CACHE_FILE_ORDERS, help='Merge order of files, later files win: numbers in file name, order of patterns, or modification time')
+    parser.add_argument('--batch-size', type=int, default=500, help='Number of posts per batch')
+    parser.add_argument('--update-popularity', action="store_true", help='Update popularity of tags added or removed by the commit')
+    # usage : python commit_differences.py --export --export-format jsonl --shard-size 100000
+    parser.add_argument('--export', action="store_true", help='Export posts from database instead of committing differences')
+    parser.add_argument('--export-dir', type=str, default="danbooru2023_fixed", help='Export directory')
+    parser.add_argument('--export-format', type=str, default="jsonl", choices=["jsonl", "parquet"], help='Export file format')
+    parser.add_argument('--shard-size', type=int, default=100000, help='Number of posts per exported shard')
+    parser.add_argument('--export-batch-size', type=int, default=10000, help='Number of posts per database query when exporting')
+    parser.add_argument('--workers', type=int, default=4, help='Number of processes to write shards')
+    args = parser.parse_args()
+    if args.export:
+        export_posts(args.export_dir, batch_size=args.export_batch_size, shard_size=args.shard_size, workers=args.workers, output_format=args.export_format)
+    else:
+        jsonl_files = expand_cache_files(args.patterns, args.order)
+        if not jsonl_files:
+            raise FileNotFoundError(f"No difference cache files found for {args.patterns}")
+        main_merged(jsonl_files, processes=args.processes, batch_size=args.batch_size, update_popularity=args.update_popularity)
     
\ No newline at end of file
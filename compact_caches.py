@@ -0,0 +1,36 @@
+"""
+Compacts append-only jsonl caches of sanity_check.py in place
+Only the latest line per key is kept, duplicate, superseded and malformed lines are dropped
+Run while sanity_check.py is not writing the files, or use its --compact-interval option instead
+"""
+
+import glob
+import argparse
+from utils.compaction import compact_jsonl, CACHE_KEYS
+
+def compact_files(patterns, kind):
+    """
+    Compacts files matching patterns, returns (lines read, lines kept) in total
+    """
+    files = sorted({file for pattern in patterns for file in glob.glob(pattern)})
+    total_read, total_kept = 0, 0
+    for file in files:
+        result = compact_jsonl(file, CACHE_KEYS[kind])
+        if result is None:
+            continue
+        total_read += result[0]
+        total_kept += result[1]
+        print(f"Compacted {file}: {result[0]} lines to {result[1]} lines")
+    print(f"Compacted {len(files)} {kind} files, {total_read} lines to {total_kept} lines")
+    return total_read, total_kept
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compact jsonl caches to the latest entry per key')
+    # usage : python compact_caches.py --requests "requests_*.jsonl" --differences "difference_cache*.jsonl"
+    parser.add_argument('--requests', type=str, nargs='*', default=["requests_*.jsonl"], help='Glob patterns of request cache files')
+    parser.add_argument('--differences', type=str, nargs='*', default=["difference_cache*.jsonl"], help='Glob patterns of difference cache files')
+    parser.add_argument('--tag-creation', type=str, nargs='*', default=["tag_creation_cache.jsonl"], help='Glob patterns of tag creation cache files')
+    args = parser.parse_args()
+    compact_files(args.requests, "requests")
+    compact_files(args.differences, "differences")
+    compact_files(args.tag_creation, "tag_creation")
@@ -1,9 +1,15 @@
 import os
-import json
+from utils import jsoncodec
 import requests
 import glob
 from tqdm import tqdm
 from utils.proxyhandler import ProxyHandler
+from utils.metrics import registry, start_exporter
+from utils.filelayout import ShardedLayout, FileIndex
+from utils.imageprocessing import ImagePostProcessor, parse_variant
+
+downloaded_bytes = registry.counter("download_bytes_total", "Bytes of downloaded files written to disk")
+downloaded_posts = registry.counter("download_posts_total", "Processed posts by result")
 
 def yield_posts(file_dir=r"G:\database\post", from_id=0, end_id=7110548):
     """
@@ -27,24 +33,36 @@ def yield_posts(file_dir=r"G:\database\post", from_id=0, end_id=7110548):
             files.append(os.path.join(root, filename))
     print(f"Total {len(files)} files")
     for file in files:
-        with open(file, 'r') as f:
+        with open(file, 'rb') as f:
             yield from f.readlines()
 
-def download_post(post_dict, proxyhandler:ProxyHandler, pbar=None, no_split=False, save_location="G:/danbooru2023-c/", split_size=1000000, max_retry=10):
+def download_post(post_dict, proxyhandler:ProxyHandler, pbar=None, no_split=False, save_location="G:/danbooru2023-c/", split_size=1000000, max_retry=10, layout:ShardedLayout=None, index:FileIndex=None, postprocessor:ImagePostProcessor=None):
+    """
+    Downloads the file of the post
+    layout defaults to the legacy {save_location}{post_id % 100} / layout
+    If index is given, existing files are looked up in the index instead of the filesystem
+    If postprocessor is given, downloaded files are queued to it
+    Files are written to {save_path}.part and renamed when complete, so readers of save_path never see partial files
+    """
     post_id = post_dict['id']
     ext = post_dict['file_ext']
+    saved_ext = ext
     download_target = post_dict.get("large_file_url", post_dict.get("file_url"))
-    save_path = save_location +f"{post_id % 100} /"+ f"{post_id}.{ext}"
-    if not os.path.exists(save_location +f"{post_id % 100} /"):
-        os.makedirs(save_location +f"{post_id % 100} /")
+    if layout is None:
+        layout = ShardedLayout(save_location, legacy=True)
+    layout.ensure_directory(post_id)
+    save_path = layout.path(post_id, saved_ext)
+    part_path = save_path + ".part"
     # if url contains file extension, use that
     if download_target and "." in download_target:
         ext = download_target.split(".")[-1]
     # skip video files
     if ext in ["webm", "mp4", "mov", "avi"]:
+        downloaded_posts.inc(result="skipped")
         return
     if not download_target:
         #print(f"Error: {post_id} has no download target, dict: {post_dict}") # gold account?
+        downloaded_posts.inc(result="skipped")
         return
     for i in range(max_retry):
         try:
@@ -58,14 +76,23 @@ def download_post(post_dict, proxyhandler:ProxyHandler, pbar=None, no_split=Fals
             break
     if filesize is None:
         print(f"Error: {post_id} has no filesize after {max_retry} retries")
+        downloaded_posts.inc(result="failed")
         return
 
-    if os.path.exists(save_path):
+    if index is not None:
+        saved_size = index.get_size(post_id, saved_ext)
+    else:
+        saved_size = os.path.getsize(save_path) if os.path.exists(save_path) else None
+    if saved_size is not None:
         # check file size
-        if os.path.getsize(save_path) != filesize:
-            print(f"Error: {post_id} had different file size saved, expected {filesize}, got {os.path.getsize(save_path)}")
-            os.remove(save_path)
+        if saved_size != filesize:
+            print(f"Error: {post_id} had different file size saved, expected {filesize}, got {saved_size}")
+            if os.path.exists(save_path):
+                os.remove(save_path)
+            if index is not None:
+                index.discard(post_id)
         else:
+            downloaded_posts.inc(result="exists")
             if pbar is not None:
                 pbar.update(1)
             return
@@ -89,8 +116,12 @@ def download_post(post_dict, proxyhandler:ProxyHandler, pbar=None, no_split=Fals
             print(f"Error: {post_id} had different file size when downloading (no split), expected {filesize}, got {len(content)}")
             return
             # save file
-        with open(save_path, 'wb') as f:
+        with open(part_path, 'wb') as f:
             f.write(content)
+        os.replace(part_path, save_path)
+        downloaded_bytes.inc(len(content))
+        if index is not None:
+            index.add(post_id, saved_ext, len(content))
     else:
         datas = [] # max 1MB per request
         if filesize is None:
@@ -98,11 +129,13 @@ def download_post(post_dict, proxyhandler:ProxyHandler, pbar=None, no_split=Fals
             return
         for i in range(0, filesize, split_size):
             datas.append((i, min(filesize, i + split_size)))
-        # download
-        current_filesize = os.path.getsize(save_path) if os.path.exists(save_path) else 0
+        # download, partial file of previous run is resumed from its last complete part
+        current_filesize = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        current_filesize -= current_filesize % split_size
         if current_filesize:
             print(f"Resuming {post_id} from {current_filesize}, to {filesize}")
-        with open(save_path, 'wb') as f:
+        with open(part_path, 'ab' if current_filesize else 'wb') as f:
+            f.truncate(current_filesize)
             for data in datas:
                 if data[0] < current_filesize:
                     continue
@@ -125,11 +158,19 @@ def download_post(post_dict, proxyhandler:ProxyHandler, pbar=None, no_split=Fals
                     print(f"Error: {post_id} had different file size when downloading {data[0]}-{data[1]}, expected {data[1] - data[0]}, got {file_response.headers.get('Content-Length')}")
                     return
                 f.write(file_response.content)
+                downloaded_bytes.inc(len(file_response.content))
         # compare file size
-        if os.path.getsize(save_path) != filesize:
-            print(f"Error: {post_id} had different file size after downloading, expected {filesize}, got {os.path.getsize(save_path)}")
-            os.remove(save_path)
+        if os.path.getsize(part_path) != filesize:
+            print(f"Error: {post_id} had different file size after downloading, expected {filesize}, got {os.path.getsize(part_path)}")
+            os.remove(part_path)
+            downloaded_posts.inc(result="failed")
             return
+        os.replace(part_path, save_path)
+        if index is not None:
+            index.add(post_id, saved_ext, filesize)
+    downloaded_posts.inc(result="downloaded")
+    if postprocessor is not None:
+        postprocessor.submit(post_dict, save_path)
     if pbar is not None:
         pbar.update(1)
 
@@ -145,19 +186,63 @@ def test():
     download_post(post, proxyhandler, no_split=False)
     raise Exception("Stop")
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Download post files')
+    # usage : python download_post.py --save-location G:/danbooru2023-c/ --levels 2 2
+    parser.add_argument('--save-location', type=str, default="G:/danbooru2023-c/", help='Root directory of downloaded files')
+    parser.add_argument('--levels', type=int, nargs='*', default=[2, 2], help='Digits of post id per directory level')
+    parser.add_argument('--legacy-layout', action="store_true", help='Use previous {post_id %% 100} / layout')
+    parser.add_argument('--scan-workers', type=int, default=16, help='Threads scanning existing files at startup')
+    parser.add_argument('--postprocess', action="store_true", help='Decode-check downloaded images and write resized variants in a process pool, requires Pillow')
+    parser.add_argument('--variants', type=str, nargs='*', default=["512:webp"], help='Variants as max_side:format, max side 0 only transcodes')
+    parser.add_argument('--variant-location', type=str, default="G:/danbooru2023-variants/", help='Root directory of variants')
+    parser.add_argument('--postprocess-workers', type=int, default=None, help='Post-processing processes, defaults to cpu count - 1')
+    parser.add_argument('--postprocess-pending', type=int, default=None, help='Images queued for post-processing before downloads are deferred to backlog')
+    parser.add_argument('--metrics-file', type=str, default=None, help='Metrics file, rewritten periodically (.json for json, prometheus text otherwise)')
+    parser.add_argument('--metrics-interval', type=float, default=10, help='Seconds between metrics file updates')
+    args = parser.parse_args()
     proxy_list_file = r"G:\database\proxy_list.txt"
-    save_location = "G:/danbooru2023-c/"
+    save_location = args.save_location
+    layout = ShardedLayout(save_location, levels=args.levels, legacy=args.legacy_layout)
+    if not args.legacy_layout and os.path.isdir(save_location + "0 /"):
+        print(f"Warning: {save_location} has files of legacy layout, run migrate_downloads.py first or use --legacy-layout")
+    index = FileIndex.scan(save_location, workers=args.scan_workers, layout=layout)
+    print(f"Indexed {len(index)} downloaded files")
     proxyhandler = ProxyHandler(proxy_list_file, wait_time=0.1, timeouts=20,proxy_auth="user:password_notdefault")
     proxyhandler.check()
-    from concurrent.futures import ThreadPoolExecutor
-    # test
-    with ThreadPoolExecutor(max_workers=80) as executor:
-        pbar = tqdm(total=-6400000 +7110548)
-        for post in yield_posts(from_id=6400000, end_id=7110548):
-            try:
-                post = json.loads(post)
-            except:
-                print(f"Error: {post}")
-                continue
-            #download_post(post, proxyhandler, pbar=pbar, no_split=False, save_location=save_location,split_size=1000000)
-            executor.submit(download_post, post, proxyhandler, pbar=pbar, no_split=False, save_location=save_location,split_size=1000000)
+    metrics_exporter = start_exporter(args.metrics_file, interval=args.metrics_interval) if args.metrics_file is not None else None
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+        postprocessor = None
+        requeued = []
+        if args.postprocess:
+            postprocessor = ImagePostProcessor(
+                args.variant_location, variants=[parse_variant(variant) for variant in args.variants], levels=args.levels,
+                workers=args.postprocess_workers, max_pending=args.postprocess_pending, requeue=requeued.append, index=index,
+            )
+        # test
+        with ThreadPoolExecutor(max_workers=80) as executor:
+            pbar = tqdm(total=-6400000 +7110548)
+            for post in yield_posts(from_id=6400000, end_id=7110548):
+                try:
+                    post = jsoncodec.loads(post)
+                except:
+                    print(f"Error: {post}")
+                    continue
+                #download_post(post, proxyhandler, pbar=pbar, no_split=False, save_location=save_location,split_size=1000000)
+                executor.submit(download_post, post, proxyhandler, pbar=pbar, no_split=False, save_location=save_location,split_size=1000000, layout=layout, index=index, postprocessor=postprocessor)
+        if postprocessor is not None:
+            # corrupt images are downloaded again until post-processing accepts them or max_requeue is reached
+            postprocessor.join()
+            while requeued:
+                posts, requeued[:] = list(requeued), []
+                print(f"Downloading {len(posts)} corrupt images again")
+                with ThreadPoolExecutor(max_workers=80) as executor:
+                    for post in posts:
+                        executor.submit(download_post, post, proxyhandler, no_split=False, save_location=save_location, split_size=1000000, layout=layout, index=index, postprocessor=postprocessor)
+                postprocessor.join()
+            postprocessor.close()
+    finally:
+        # last interval is exported on stop
+        if metrics_exporter is not None:
+            metrics_exporter.stop()
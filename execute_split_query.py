@@ -1,4 +1,8 @@
 command_string = "python sanity_check.py --start-idx {start} --end-idx {end} --threads 8 --retry 30 --proxy-auth {auth} --proxy-address http://{ip}:{port} --proxy --logging-file query_log_{index}.log --save-file difference_cache_{ranged}.jsonl --requests-cache requests_{index}.jsonl"
+# workers take small id blocks from coordinator instead of fixed range
+coordinator_command_string = "python sanity_check.py --coordinator {coordinator} --worker-id {index} --threads 8 --retry 30 --proxy-auth {auth} --proxy-address http://{ip}:{port} --proxy --logging-file query_log_{index}.log --save-file difference_cache_worker_{index}.jsonl --requests-cache requests_{index}.jsonl"
+coordinator_file = "coordinator.sqlite"
+block_size = 1000
 
 # executes the command string
 
@@ -22,6 +26,23 @@ per_ip_range = (end_at - start_from) // ip_count
 print(f"Per IP Range: {per_ip_range}")
 auth = input("Proxy Auth: ")
 port = input("Proxy Port: ")
+use_coordinator = input("Use coordinator? (y/N): ").strip().lower() == "y"
+if use_coordinator:
+    from utils.coordinator import LeaseCoordinator
+    coordinator = LeaseCoordinator(coordinator_file)
+    coordinator.init_blocks(start_from, end_at + 1, block_size)
+    print(f"Coordinator: {coordinator_file}, progress: {coordinator.progress()}")
+    coordinator.close()
+    for i in range(ip_count):
+        command = coordinator_command_string.format(coordinator=coordinator_file, ip=ips[i], index=i, auth=auth, port=port)
+        print(f"IP {i}: {ips[i]}")
+        print(f"Command: {command}")
+        print()
+        if os.name == 'nt':
+            subprocess.Popen(f"start /wait cmd /c {command}", shell=True)
+        else:
+            subprocess.Popen(f"screen -dmS {i} {command}", shell=True)
+    exit()
 
 for i in range(ip_count):
     start = start_from + i * per_ip_range
@@ -0,0 +1,32 @@
+"""
+Merges per-worker requests_*.jsonl and difference_cache_*.jsonl files into one deduplicated sqlite store
+The store can be passed to sanity_check.py as --requests-cache or --save-file, regardless of how ids were split
+"""
+
+import argparse
+from tqdm import tqdm
+from utils.cachestore import SqliteCacheStore, CACHE_FILE_ORDERS, expand_cache_files
+
+def merge_files(store:SqliteCacheStore, patterns, kind, order="name"):
+    """
+    Merges files matching patterns into store in merge order of expand_cache_files, entries of later files replace earlier ones
+    Returns number of merged lines
+    """
+    files = expand_cache_files(patterns, order)
+    merged = 0
+    for file in tqdm(files, desc=f"Merging {kind}"):
+        merged += store.merge_jsonl(file, kind)
+    print(f"Merged {merged} lines from {len(files)} {kind} files, {store.count(kind)} unique entries")
+    return merged
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merge request and difference caches into one store')
+    # usage : python merge_caches.py --output cache_store.sqlite --requests "requests_*.jsonl" --differences "difference_cache_*.jsonl"
+    parser.add_argument('--output', type=str, default="cache_store.sqlite", help='Merged store file')
+    parser.add_argument('--requests', type=str, nargs='*', default=["requests_*.jsonl"], help='Glob patterns of request cache files')
+    parser.add_argument('--differences', type=str, nargs='*', default=["difference_cache*.jsonl"], help='Glob patterns of difference cache files')
+    parser.add_argument('--order', type=str, default="name", choices=CACHE_FILE_ORDERS, help='Merge order of files, later files win: numbers in file name, order of patterns, or modification time')
+    args = parser.parse_args()
+    store = SqliteCacheStore(args.output)
+    merge_files(store, args.requests, "requests", args.order)
+    merge_files(store, args.differences, "differences", args.order)
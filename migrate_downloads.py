@@ -0,0 +1,61 @@
+"""
+Moves downloaded post files into the sharded directory layout of utils/filelayout.py
+Files of any previous layout under source are found by name {post_id}.{ext}, files already in place are kept
+Emptied legacy directories are removed
+"""
+
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from utils.filelayout import ShardedLayout, scan_files, parse_post_filename
+
+def move_file(path, post_id, ext, layout:ShardedLayout, dry_run=False):
+    """
+    Moves file to its layout path, returns "moved", "kept" or "conflict"
+    """
+    target = layout.path(post_id, ext)
+    if os.path.abspath(path) == os.path.abspath(target):
+        return "kept"
+    if os.path.exists(target):
+        print(f"Warning: {target} already exists, keeping {path}")
+        return "conflict"
+    if not dry_run:
+        layout.ensure_directory(post_id)
+        os.replace(path, target)
+    return "moved"
+
+def migrate(source, layout:ShardedLayout, workers=16, dry_run=False):
+    """
+    Moves all post files under source into layout, returns counts by result
+    """
+    files = []
+    for path, name, size in tqdm(scan_files(source, workers), desc="Scanning"):
+        parsed = parse_post_filename(name)
+        if parsed is not None:
+            files.append((path, *parsed))
+    results = {"moved": 0, "kept": 0, "conflict": 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(move_file, path, post_id, ext, layout, dry_run) for path, post_id, ext in files]
+        for future in tqdm(futures, desc="Moving"):
+            results[future.result()] += 1
+    if not dry_run:
+        # legacy directories are "{n} ", remove them if they are empty now
+        for n in range(100):
+            directory = os.path.join(source, f"{n} ")
+            if os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Move downloaded files into sharded directory layout')
+    # usage : python migrate_downloads.py G:/danbooru2023-c/ --levels 2 2
+    parser.add_argument('source', type=str, help='Directory of downloaded files')
+    parser.add_argument('--target', type=str, default=None, help='Root of new layout, defaults to source')
+    parser.add_argument('--levels', type=int, nargs='*', default=[2, 2], help='Digits of post id per directory level')
+    parser.add_argument('--workers', type=int, default=16, help='Threads for scanning and moving')
+    parser.add_argument('--dry-run', action="store_true", help='Only count files to move')
+    args = parser.parse_args()
+    layout = ShardedLayout(args.target or args.source, levels=args.levels)
+    results = migrate(args.source, layout, workers=args.workers, dry_run=args.dry_run)
+    print(f"Moved {results['moved']} files, {results['kept']} already in place, {results['conflict']} conflicts")
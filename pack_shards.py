@@ -0,0 +1,76 @@
+"""
+Packs downloaded images with their post metadata into sequential tar shards of WebDataset format
+Posts are read with yield_posts, each post whose file is downloaded becomes one sample {id}.{ext} + {id}.json
+Packing is incremental, packed posts are skipped on the next run, and --watch packs new downloads as they complete
+"""
+
+import os
+import time
+import argparse
+from tqdm import tqdm
+from utils import jsoncodec
+from utils.filelayout import ShardedLayout, FileIndex
+from utils.tarshards import ShardWriter
+from download_post import yield_posts
+
+def pack_downloaded(writer:ShardWriter, layout:ShardedLayout, index:FileIndex, post_dir, from_id=0, min_age=60):
+    """
+    Packs posts of post_dir whose files are in index and not packed yet
+    download_post renames files into place when complete, files modified in the last min_age seconds are still left for the next pass
+    Returns number of packed posts
+    """
+    packed = 0
+    now = time.time()
+    for line in tqdm(yield_posts(file_dir=post_dir, from_id=from_id), desc="Packing"):
+        try:
+            post = jsoncodec.loads(line)
+            post_id = post["id"]
+        except Exception as e:
+            continue
+        if post_id < from_id or post_id in writer.packed:
+            continue
+        found = index.get(post_id)
+        if found is None:
+            continue
+        ext = found[0]
+        path = layout.path(post_id, ext)
+        try:
+            if now - os.path.getmtime(path) < min_age:
+                continue
+        except FileNotFoundError:
+            index.discard(post_id)
+            continue
+        writer.add(post_id, [(ext, path), ("json", line.strip())])
+        packed += 1
+    return packed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack downloaded images and metadata into tar shards')
+    # usage : python pack_shards.py --save-location G:/danbooru2023-c/ --post-dir G:/database/post --output G:/danbooru2023-shards/
+    # usage : python pack_shards.py --watch 600
+    parser.add_argument('--save-location', type=str, default="G:/danbooru2023-c/", help='Root directory of downloaded files')
+    parser.add_argument('--post-dir', type=str, default=r"G:\database\post", help='Directory of crawled post jsonl files')
+    parser.add_argument('--output', type=str, default="G:/danbooru2023-shards/", help='Directory of shards and index.jsonl')
+    parser.add_argument('--levels', type=int, nargs='*', default=[2, 2], help='Digits of post id per directory level')
+    parser.add_argument('--legacy-layout', action="store_true", help='Use previous {post_id %% 100} / layout')
+    parser.add_argument('--shard-size', type=int, default=1024, help='Shard size in MB')
+    parser.add_argument('--shard-count', type=int, default=10000, help='Maximum samples per shard')
+    parser.add_argument('--from-id', type=int, default=0, help='First post id to pack')
+    parser.add_argument('--min-age', type=float, default=60, help='Seconds since last modification before a file is packed')
+    parser.add_argument('--watch', type=float, default=0, help='Pack again every given seconds, 0 packs once')
+    parser.add_argument('--scan-workers', type=int, default=16, help='Threads scanning downloaded files')
+    args = parser.parse_args()
+    layout = ShardedLayout(args.save_location, levels=args.levels, legacy=args.legacy_layout)
+    writer = ShardWriter(args.output, max_size=args.shard_size << 20, max_count=args.shard_count)
+    print(f"{len(writer.packed)} posts already packed")
+    try:
+        while True:
+            index = FileIndex.scan(args.save_location, workers=args.scan_workers, layout=layout)
+            packed = pack_downloaded(writer, layout, index, args.post_dir, from_id=args.from_id, min_age=args.min_age)
+            print(f"Packed {packed} posts of {len(index)} downloaded files")
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+    finally:
+        # last shard is completed even if it is smaller than shard size
+        writer.close()
@@ -0,0 +1,74 @@
+"""
+Post-processes downloaded images outside of download_post.py
+Processes images deferred to the backlog by download_post.py --postprocess, or all images of a download directory
+Corrupt images are removed, so the next download_post.py run downloads them again
+"""
+
+import os
+import argparse
+from tqdm import tqdm
+from utils import jsoncodec
+from utils.filelayout import scan_files, parse_post_filename
+from utils.imageprocessing import ImagePostProcessor, parse_variant
+
+def take_backlog(backlog_file):
+    """
+    Moves backlog aside to {backlog_file}.processing and returns its path, or None if there is no backlog
+    Images failing again are written to a new backlog, the moved file is removed by the caller once all its images are processed
+    """
+    processing_file = backlog_file + ".processing"
+    if os.path.exists(backlog_file):
+        if os.path.exists(processing_file):
+            # previous run was interrupted, keep both
+            with open(processing_file, "ab") as target, open(backlog_file, "rb") as source:
+                target.write(source.read())
+            os.remove(backlog_file)
+        else:
+            os.replace(backlog_file, processing_file)
+    if not os.path.exists(processing_file):
+        return None
+    return processing_file
+
+def backlog_entries(processing_file):
+    """
+    Yields (post_id, path) of backlog moved aside by take_backlog
+    """
+    for entry in jsoncodec.iter_jsonl(processing_file):
+        yield entry["id"], entry["path"]
+
+def directory_entries(root, workers=16):
+    for path, name, size in scan_files(root, workers):
+        parsed = parse_post_filename(name)
+        if parsed is not None:
+            yield parsed[0], path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Decode-check downloaded images and write resized variants')
+    # usage : python process_images.py --backlog postprocess_backlog.jsonl --variants 512:webp
+    # usage : python process_images.py --directory G:/danbooru2023-c/ --variants 512:webp 0:png
+    parser.add_argument('--backlog', type=str, default="postprocess_backlog.jsonl", help='Backlog file written by download_post.py')
+    parser.add_argument('--directory', type=str, default=None, help='Process all images under directory instead of backlog')
+    parser.add_argument('--variants', type=str, nargs='*', default=["512:webp"], help='Variants as max_side:format, max side 0 only transcodes')
+    parser.add_argument('--variant-location', type=str, default="G:/danbooru2023-variants/", help='Root directory of variants')
+    parser.add_argument('--levels', type=int, nargs='*', default=[2, 2], help='Digits of post id per directory level of variants')
+    parser.add_argument('--workers', type=int, default=None, help='Processes, defaults to cpu count - 1')
+    args = parser.parse_args()
+    # no download threads to protect here, so submit waits for a free slot instead of deferring
+    processor = ImagePostProcessor(
+        args.variant_location, variants=[parse_variant(variant) for variant in args.variants], levels=args.levels,
+        workers=args.workers, max_wait=None, backlog_file=args.backlog,
+    )
+    processing_file = None
+    if args.directory:
+        entries = directory_entries(args.directory)
+    else:
+        processing_file = take_backlog(args.backlog)
+        entries = backlog_entries(processing_file) if processing_file is not None else []
+    for post_id, path in tqdm(entries, desc="Processing"):
+        if os.path.exists(path):
+            processor.submit({"id": post_id}, path)
+    processor.join()
+    processor.close()
+    # removed only when submitted images are processed, an interrupted run processes the backlog again
+    if processing_file is not None:
+        os.remove(processing_file)
@@ -0,0 +1,139 @@
+"""
+Recomputes Tag.popularity from tag usage of posts
+Full mode counts tag ids of all tag_list_* fields in one streaming pass with bincount
+Incremental mode applies the tag additions and removals that committing difference caches with commit_differences.py makes
+"""
+
+import re
+import argparse
+from collections import defaultdict
+import numpy as np
+from peewee import chunked, Case, fn
+from tqdm import tqdm
+from db import *
+from utils.cachestore import CACHE_FILE_ORDERS, expand_cache_files
+
+TAG_LIST_FIELDS = ["tag_list_general", "tag_list_character", "tag_list_artist", "tag_list_meta", "tag_list_copyright"]
+# tag lists are stored as delimited tag ids, only the numbers are needed
+TAG_ID_PATTERN = re.compile(r"\d+")
+# sqlite has limited number of variables per statement, CASE updates bind id and value per tag and the id again in IN
+UPDATE_BATCH_SIZE = 400 // 3
+
+def count_tag_usage(batch_size=100000, fields=TAG_LIST_FIELDS):
+    """
+    Returns int64 array of usage count per tag id
+    Raw column values are read through the cursor, so tag lists are never converted to Tag objects
+    """
+    database = Post._meta.database
+    columns = [getattr(Post, field) for field in fields]
+    max_tag_id = Tag.select(fn.MAX(Tag.id)).scalar() or 0
+    counts = np.zeros(max_tag_id + 1, dtype=np.int64)
+    total = Post.select().count()
+    last_id = -1
+    with tqdm(total=total, desc="Counting tags") as pbar:
+        while True:
+            query = Post.select(Post.id, *columns).where(Post.id > last_id).order_by(Post.id).limit(batch_size)
+            rows = database.execute(query).fetchall()
+            if not rows:
+                break
+            text = " ".join(value for row in rows for value in row[1:] if value)
+            tag_ids = np.array(TAG_ID_PATTERN.findall(text), dtype=np.int64)
+            if len(tag_ids):
+                batch_counts = np.bincount(tag_ids)
+                if len(batch_counts) > len(counts):
+                    counts = np.concatenate([counts, np.zeros(len(batch_counts) - len(counts), dtype=np.int64)])
+                counts[:len(batch_counts)] += batch_counts
+            last_id = rows[-1][0]
+            pbar.update(len(rows))
+    return counts
+
+def write_popularity(counts, batch_size=UPDATE_BATCH_SIZE):
+    """
+    Writes counts as popularity of tags whose popularity differs, with one CASE update per batch
+    Tags which are not used get 0
+    Returns number of updated tags
+    """
+    changed = []
+    for tag_id, popularity in Tag.select(Tag.id, Tag.popularity).tuples().iterator():
+        count = int(counts[tag_id]) if tag_id < len(counts) else 0
+        if popularity != count:
+            changed.append((tag_id, count))
+    with Tag._meta.database.atomic():
+        for batch in tqdm(list(chunked(changed, batch_size)), desc="Updating tags"):
+            Tag.update(popularity=Case(Tag.id, batch)).where(Tag.id.in_([tag_id for tag_id, _ in batch])).execute()
+    return len(changed)
+
+def difference_tag_deltas(filepaths, processes=None):
+    """
+    Returns dict of tag id -> popularity change that committing difference caches makes
+    Files are merged like commit_differences does (latest entry of a post wins), and the commit is run without writing,
+    so only tags which are actually added to or removed from posts are counted
+    Counts depend on current tag lists, run before committing or use commit_differences.py --update-popularity
+    Tags added by differences which are not in database yet are keyed by (name, type) and created by apply_tag_deltas
+    """
+    from multiprocessing import Pool
+    from commit_differences import merge_differences, commit_differences_bulk
+    deltas = defaultdict(int)
+    with Pool(processes=processes) as pool:
+        total, differences = merge_differences(filepaths, pool)
+        commit_differences_bulk(differences, total=total, tag_deltas=deltas, write=False)
+    return deltas
+
+def resolve_placeholders(placeholders, batch_size=UPDATE_BATCH_SIZE):
+    """
+    Returns dict of (name, type) placeholder -> tag id, tags which are still not in database are created with popularity 0
+    Tags created meanwhile, e.g. by committing the differences, are looked up by name
+    """
+    by_name = {name: (name, tag_type) for name, tag_type in placeholders}
+    tag_ids = {}
+    for batch in chunked(list(by_name), batch_size):
+        for tag_id, name in Tag.select(Tag.id, Tag.name).where(Tag.name.in_(batch)).tuples():
+            tag_ids[by_name[name]] = tag_id
+    missing = [placeholder for placeholder in by_name.values() if placeholder not in tag_ids]
+    if missing:
+        print(f"Warning: {len(missing)} tags of differences are not in database, adding")
+        for batch in chunked(missing, batch_size):
+            Tag.insert_many([{"name": name, "type": tag_type, "popularity": 0} for name, tag_type in batch]).execute()
+            for tag_id, name in Tag.select(Tag.id, Tag.name).where(Tag.name.in_([name for name, _ in batch])).tuples():
+                tag_ids[by_name[name]] = tag_id
+    return tag_ids
+
+def apply_tag_deltas(deltas, batch_size=UPDATE_BATCH_SIZE):
+    """
+    Adds deltas to popularity, tags are grouped by delta so each group is one update per batch
+    Deltas are keyed by tag id, or by (name, type) placeholder of tags which did not exist when deltas were counted
+    Unknown popularity (-1 of created tags) is treated as 0
+    Returns number of updated tags
+    """
+    with Tag._meta.database.atomic():
+        placeholder_ids = resolve_placeholders([tag for tag in deltas if isinstance(tag, tuple)], batch_size)
+        grouped = defaultdict(list)
+        for tag, delta in deltas.items():
+            if delta != 0:
+                grouped[delta].append(placeholder_ids[tag] if isinstance(tag, tuple) else tag)
+        updated = 0
+        for delta, ids in grouped.items():
+            for batch in chunked(ids, batch_size):
+                Tag.update(popularity=fn.MAX(Tag.popularity, 0) + delta).where(Tag.id.in_(batch)).execute()
+                updated += len(batch)
+    return updated
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recompute tag popularity from posts')
+    # usage : python recompute_popularity.py
+    # usage : python recompute_popularity.py --differences difference_cache_*.jsonl
+    parser.add_argument('--differences', type=str, nargs='*', default=None, help='Apply tag changes that committing difference caches makes instead of recounting all posts, run before committing them')
+    parser.add_argument('--processes', type=int, default=None, help='Number of processes to parse difference caches')
+    parser.add_argument('--order', type=str, default="name", choices=CACHE_FILE_ORDERS, help='Merge order of difference caches, later files win, same as commit_differences.py')
+    parser.add_argument('--batch-size', type=int, default=100000, help='Posts read per query')
+    parser.add_argument('--update-batch-size', type=int, default=UPDATE_BATCH_SIZE, help='Tags updated per query, each tag binds up to 3 sqlite variables')
+    args = parser.parse_args()
+    if args.differences:
+        filepaths = expand_cache_files(args.differences, args.order)
+        deltas = difference_tag_deltas(filepaths, args.processes)
+        print(f"Read tag changes of {len(deltas)} tags from {len(filepaths)} files")
+        print(f"Updated popularity of {apply_tag_deltas(deltas, args.update_batch_size)} tags")
+    else:
+        counts = count_tag_usage(args.batch_size)
+        print(f"Counted {int(counts.sum())} tag usages of {int(np.count_nonzero(counts))} tags")
+        print(f"Updated popularity of {write_popularity(counts, args.update_batch_size)} tags")
@@ -3,18 +3,45 @@ from db import *
 
 import os
 import time
+import socket
+import re
+import multiprocessing
 import requests
-import json
 import logging
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import partial
+from collections import OrderedDict
+from threading import Lock
 
 from tqdm import tqdm
 
+from utils.idset import BitmapIdSet, migrate_jsonl
+from utils.tagdiff import TagVocabulary, diff_tag_lists
+from utils.coordinator import LeaseCoordinator
+from utils.cachestore import SqliteCacheStore, is_store_file
+from utils.metrics import registry, start_exporter
+from utils.profiling import profiler
+from utils import jsoncodec
+from utils.compaction import BackgroundCompactor, CACHE_KEYS
+from utils.appender import get_appender, checkpoint_all, configure as configure_appenders
+from utils.dbconnections import ConnectionManager
+from utils.pipeline import Pipeline
+from utils.records import compact_difference, expand_difference
+from contextlib import nullcontext
+
 log_file = "danbooru.log"
 PER_REQUEST_POSTS = 100
 
+retry_count_metric = registry.counter("retries_total", "Retried requests by source")
+cache_lookups = registry.counter("cache_lookups_total", "Cache lookups by cache and result (hit, miss)")
+proxy_latency = registry.histogram("proxy_request_seconds", "Latency of requests to proxy by proxy and endpoint")
+proxy_requests = registry.counter("proxy_requests_total", "Requests to proxy by proxy, endpoint and status")
+proxy_bytes = registry.counter("proxy_response_bytes_total", "Bytes received from proxy by proxy and endpoint")
+writer_backlog = registry.gauge("writer_queue_size", "Transactions waiting for writer thread")
+writer_tasks = registry.counter("writer_tasks_total", "Transactions executed by writer thread")
+posts_checked = registry.counter("posts_checked_total", "Checked posts by result")
+
 proxies_last_commmited = {}
 def wait_until_commit(proxy=None):
     """
@@ -36,6 +63,7 @@ def generate_retry_handler(retry_count=5):
                 return result
             except Exception as e:
                 logging.error("Error in request: {}, retrying".format(e))
+                retry_count_metric.inc(source="direct")
                 continue
         raise ValueError("Request failed")
     return get_request_locally
@@ -50,6 +78,7 @@ def generate_session_retry_handler(retry_count=5):
                 return result
             except Exception as e:
                 logging.error("Error in request: {}, retrying".format(e))
+                retry_count_metric.inc(source="proxy")
                 continue
         raise ValueError("Request failed")
     return get_request_locally
@@ -57,72 +86,206 @@ def generate_session_retry_handler(retry_count=5):
 request_getter = None
 session_getter = None
 
+def request_cache_line(url, body:bytes):
+    """
+    Returns jsonl line of request cache with original response body, same format as jsoncodec.dumps_line({"url": url, "response": response})
+    Newlines can only be whitespace in json, so they are replaced to keep one entry per line
+    """
+    if b"\n" in body or b"\r" in body:
+        body = body.replace(b"\r", b" ").replace(b"\n", b" ")
+    return b'{"url": ' + jsoncodec.dumps(url) + b', "response": ' + body.strip() + b'}\n'
+
+# url is the first key of request cache lines, so lines can be indexed without decoding responses
+REQUEST_URL_PATTERN = re.compile(rb'^\{"url": ?("(?:[^"\\]|\\.)*")')
+
+def parse_request_url(line:bytes):
+    """
+    Returns url of request cache line, or None if line is malformed
+    """
+    match = REQUEST_URL_PATTERN.match(line)
+    try:
+        return jsoncodec.loads(match.group(1)) if match is not None else jsoncodec.loads(line)["url"]
+    except Exception as e:
+        return None
+
 class CachedRequest:
     """
     Wrapper for requests to cache get method
     This is for avoiding rate limiting
+    If max_entries is set, at most max_entries responses are kept in memory and least recently used ones are evicted
+    Cache file is then only indexed on load, evicted responses are read again from their offset in the file
     """
-    def __init__(self, cache_file="cache.jsonl", proxy_handler=None):
+    def __init__(self, cache_file="cache.jsonl", proxy_handler=None, max_entries=0):
         self.cache_file = cache_file
-        self.cache = {}
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.lock = Lock()
+        # url -> offset of its latest line in cache file, only used if max_entries is set
+        self.offsets = {}
+        self.indexed_size = 0
+        # urls fetched in this run, their lines may not be indexed yet
+        self.fetched = set()
+        # shared buffered appender, compaction holds it while replacing the file
+        self.appender = get_appender(cache_file)
+        # merged store is looked up on demand instead of loading it
+        self.store = SqliteCacheStore(cache_file) if is_store_file(cache_file) else None
         self.load_cache()
         self.proxy_handler : ProxyHandler = proxy_handler
     
     def load_cache(self):
-        if os.path.isfile(self.cache_file):
-            with open(self.cache_file, "r") as f:
-                for line in f:
-                    try:
-                        data = json.loads(line)
-                        self.cache[data["url"]] = data["response"]
-                    except Exception as e:
-                        continue
+        if self.store is None and os.path.isfile(self.cache_file):
+            if self.max_entries:
+                self.index_file()
+                return
+            for data in jsoncodec.iter_jsonl(self.cache_file):
+                try:
+                    self.cache[data["url"]] = data["response"]
+                except Exception as e:
+                    continue
                         #logging.error("Error loading cache: {}, skipping line".format(e))
+    def index_file(self, start=0):
+        """
+        Records offset of each url in cache file from start, trailing partial line is not indexed
+        """
+        if not os.path.isfile(self.cache_file):
+            return
+        offset = start
+        with open(self.cache_file, "rb") as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                url = parse_request_url(line)
+                if url is not None:
+                    self.offsets[url] = offset
+                offset += len(line)
+        self.indexed_size = offset
+    def read_cached(self, url):
+        """
+        Returns response of url from cache file, or None if it is not in the file
+        """
+        with self.lock:
+            offset = self.offsets.get(url)
+            if offset is None and url in self.fetched:
+                # appended in this run, lines after the indexed part are indexed
+                self.appender.flush()
+                self.index_file(self.indexed_size)
+                offset = self.offsets.get(url)
+        for _ in range(2):
+            if offset is None:
+                return None
+            try:
+                with open(self.cache_file, "rb") as f:
+                    f.seek(offset)
+                    data = jsoncodec.loads(f.readline())
+                if data["url"] == url:
+                    return data["response"]
+            except Exception as e:
+                pass
+            # file was compacted meanwhile, offsets are rebuilt once
+            with self.lock:
+                self.offsets = {}
+                self.index_file()
+                offset = self.offsets.get(url)
+        return None
+    def remember(self, url, response):
+        with self.lock:
+            self.cache[url] = response
+            self.cache.move_to_end(url)
+            if self.max_entries:
+                while len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+    def release(self, url):
+        """
+        Evicts response of url from memory if entries are bounded, called when all posts of the page are checked
+        """
+        if self.max_entries:
+            with self.lock:
+                self.cache.pop(url, None)
     def get(self, url):
         global request_getter
         logging.debug(f"Getting response for url {url}")
-        if url in self.cache:
+        with self.lock:
+            cached = self.cache.get(url)
+            if cached is not None:
+                self.cache.move_to_end(url)
+        if cached is None and self.store is not None:
+            cached = self.store.get_request(url)
+        elif cached is None and self.max_entries:
+            with profiler.stage("request_read"):
+                cached = self.read_cached(url)
+        if cached is not None:
             logging.debug(f"Found cached response for url {url}")
-            return self.cache[url]
+            cache_lookups.inc(cache="requests", result="hit")
+            self.remember(url, cached)
+            return cached
         else:
-            if self.proxy_handler is not None:
-                logging.debug(f"Using proxy {self.proxy_handler}")
-                handler = self.proxy_handler
-                #print("Using proxy {}".format(handler))
-                if handler is None:
-                    r = request_getter(url) # no proxy
-                    r.raise_for_status()
-                    r = r.json()
-                else:
-                    logging.debug(f"Using proxy {handler}")
-                    r = handler.get(url)
+            cache_lookups.inc(cache="requests", result="miss")
+            handler = self.proxy_handler
+            if handler is not None:
+                logging.debug(f"Using proxy {handler}")
+                r, body = handler.fetch(url)
             else:
-                r = request_getter(url)
+                with profiler.stage("proxy_wait"):
+                    r = request_getter(url) # no proxy
                 r.raise_for_status()
-                r = r.json()
-            to_json = {"url": url, "response": r}
-            # validate, check "id" key
-            if "id" not in str(to_json["response"]):
-                raise ValueError("Invalid response: {}".format(to_json["response"]))
-            self.cache[url] = to_json["response"]
-            with open(self.cache_file, "a") as f:
-                f.write(json.dumps(to_json) + "\n")
-            return to_json["response"]
+                body = r.content
+                with profiler.stage("json_decode"):
+                    r = jsoncodec.loads(body)
+            # validate, check "id" key, body is checked as is instead of str(response)
+            if (b"id" not in body) if body is not None else ("id" not in str(r)):
+                raise ValueError("Invalid response: {}".format(r))
+            self.remember(url, r)
+            if self.max_entries:
+                with self.lock:
+                    self.fetched.add(url)
+            # original body is stored as is, response is encoded again only if body is not available
+            self.persist(url, body if body is not None else jsoncodec.dumps(r))
+            return r
+    def persist(self, url, body:bytes):
+        """
+        Stores response body of url in cache file or merged store
+        """
+        with profiler.stage("request_append"):
+            if self.store is not None:
+                self.store.put_request_raw(url, body)
+            else:
+                self.appender.append(request_cache_line(url, body))
+
+class ForwardingCachedRequest(CachedRequest):
+    """
+    Request cache of worker processes, responses are sent to writer process instead of written to cache file
+    Cache file is only read here, it is loaded or indexed like CachedRequest so cached responses are not fetched again
+    """
+    def __init__(self, cache_file, results, proxy_handler=None, max_entries=0):
+        self.results = results
+        super().__init__(cache_file, proxy_handler=proxy_handler, max_entries=max_entries)
+    def persist(self, url, body:bytes):
+        self.results.put(("request", url, body))
 
 
 class ProxyHandler:
     """
     Wrapper for proxies
+    With raw=True, proxy sends upstream body from get_response_raw instead of json envelope
     """
-    def __init__(self, proxies:List[str]=None, proxy_auth=None):
+    def __init__(self, proxies:List[str]=None, proxy_auth=None, raw=False):
         self.proxies = proxies
         self.proxy_auth = proxy_auth
         self.proxy_idx = 0
+        self.raw = raw
     def get(self, url):
-        global session_getter
         """
         Get response from proxy
         """
+        return self.fetch(url)[0]
+    def fetch(self, url):
+        global session_getter
+        """
+        Get (response, body) from proxy, body is original json bytes of response
+        Response is decoded once, body can be stored without encoding response again
+        Body is None if proxy returned already decoded response in envelope
+        """
         if self.proxies is None:
             print("No proxies available")
             raise ValueError("No proxies available")
@@ -135,87 +298,161 @@ class ProxyHandler:
             session.auth = tuple(self.proxy_auth.split(":"))
         if not proxy_addr.endswith("/"):
             proxy_addr += "/"
-        proxy_addr = proxy_addr + "get_response"
+        endpoint = "get_response_raw" if self.raw else "get_response"
+        proxy_addr = proxy_addr + endpoint
         #print("Using proxy {}".format(proxy_addr))
         wait_until_commit(proxy=proxy_addr)
-        r = session_getter(session, proxy_addr, params={"url": url}, proxy=proxy_addr)
+        start_time = time.time()
+        try:
+            with profiler.stage("proxy_wait"):
+                r = session_getter(session, proxy_addr, params={"url": url}, proxy=proxy_addr)
+        finally:
+            proxy_latency.observe(time.time() - start_time, proxy=proxy_addr, endpoint=endpoint)
+        proxy_requests.inc(proxy=proxy_addr, endpoint=endpoint, status=r.status_code)
+        proxy_bytes.inc(len(r.content), proxy=proxy_addr, endpoint=endpoint)
         r.raise_for_status()
-        json_response = r.json()
+        if self.raw:
+            # success is signalled by status, proxy can also set X-Proxy-Success: false with error in body
+            if r.headers.get("X-Proxy-Success", "true").lower() == "false":
+                print("Proxy {} returned error: {}".format(proxy_addr, r.text))
+                raise ValueError("Invalid response: {}".format(r.text))
+            body = r.content
+            with profiler.stage("json_decode"):
+                return jsoncodec.loads(body), body
+        with profiler.stage("json_decode"):
+            json_response = jsoncodec.loads(r.content)
+            body = None
+            if json_response["success"] and isinstance(json_response["response"], str):
+                body = json_response["response"].encode("utf-8")
+                json_response["response"] = jsoncodec.loads(body)
         if not json_response["success"]:
             print("Proxy {} returned error: {}".format(proxy_addr, json_response["response"]))
             raise ValueError("Invalid response: {}".format(json_response))
-        if isinstance(json_response["response"], str):
-            json_response["response"] = json.loads(json_response["response"])
-        return json_response["response"]
+        return json_response["response"], body
+
 
+# default of store lookups, a stored difference can be None
+MISSING = object()
 
 class DifferenceCache:
     """
     Wrapper for caching differences
     If calculated difference exists, we will use it instead of calculating it again
+    Differences are kept as compact records with tag lists encoded by vocabulary, and returned in (new_dict, old_dict) format
     """
-    def __init__(self, cache_file="difference_cache.jsonl"):
+    def __init__(self, cache_file="difference_cache.jsonl", vocabulary:TagVocabulary=None):
         self.cache_file = cache_file
         self.cache = {}
+        self.vocabulary = vocabulary if vocabulary is not None else tag_vocabulary
+        # shared buffered appender, compaction holds it while replacing the file
+        self.appender = get_appender(cache_file)
+        # merged store is looked up on demand instead of loading it
+        self.store = SqliteCacheStore(cache_file) if is_store_file(cache_file) else None
         self.load_cache()
     
     def load_cache(self):
-        if os.path.isfile(self.cache_file):
-            with open(self.cache_file, "r") as f:
-                for line in f:
-                    try:
-                        data = json.loads(line)
-                        self.cache[data["id"]] = data["difference"]
-                    except Exception as e:
-                        continue
-                        #logging.exception("Error loading cache: {}, skipping line".format(e))
+        if self.store is None and os.path.isfile(self.cache_file):
+            for data in jsoncodec.iter_jsonl(self.cache_file):
+                try:
+                    self.cache[data["id"]] = compact_difference(data["difference"], self.vocabulary)
+                except Exception as e:
+                    continue
+                    #logging.exception("Error loading cache: {}, skipping line".format(e))
     def get(self, post_id):
         # if tuple, unpack
         logging.debug(f"Getting difference for post {post_id}")
         if isinstance(post_id, tuple):
             assert len(post_id) == 1, "post_id tuple must be of length 1"
             post_id = post_id[0]
-        if post_id in self.cache:
-            return self.cache[post_id]
+        if self.contains(post_id):
+            cache_lookups.inc(cache="differences", result="hit")
+            return expand_difference(self.cache[post_id], self.vocabulary)
         else:
+            cache_lookups.inc(cache="differences", result="miss")
             difference = compare_info(post_id)
-            to_json = {"id": post_id, "difference": difference}
-            self.cache[post_id] = to_json["difference"]
-            with open(self.cache_file, "a") as f:
-                f.write(json.dumps(to_json) + "\n")
-            return to_json["difference"]
+            self.cache[post_id] = compact_difference(difference, self.vocabulary)
+            self.write([(post_id, difference)])
+            return difference
+    def write(self, differences):
+        """
+        Persists (post_id, difference) pairs
+        """
+        with profiler.stage("difference_append"):
+            if self.store is not None:
+                self.store.put_differences(differences)
+                return
+            lines = b"".join(jsoncodec.dumps_line({"id": post_id, "difference": difference}) for post_id, difference in differences)
+            self.appender.append(lines)
+    def get_many(self, post_ids:List[int]):
+        """
+        Returns differences for multiple posts, posts which are not cached are compared in one batch
+        Posts which failed to compare are not included in the result
+        """
+        result = self.get_cached(post_ids, count=False)
+        missing = [post_id for post_id in post_ids if post_id not in result]
+        cache_lookups.inc(len(result), cache="differences", result="hit")
+        cache_lookups.inc(len(missing), cache="differences", result="miss")
+        if not missing:
+            return result
+        differences = compare_info_batch(missing)
+        self.put_many(differences)
+        result.update(differences)
+        return result
+    def get_cached(self, post_ids:List[int], count=True):
+        """
+        Returns cached differences of posts, without comparing missing posts
+        """
+        result = {post_id: expand_difference(self.cache[post_id], self.vocabulary) for post_id in post_ids if self.contains(post_id)}
+        if count:
+            cache_lookups.inc(len(result), cache="differences", result="hit")
+            cache_lookups.inc(len(post_ids) - len(result), cache="differences", result="miss")
+        return result
+    def put_many(self, differences):
+        """
+        Caches and persists dict of post_id -> difference
+        """
+        for post_id, difference in differences.items():
+            self.cache[post_id] = compact_difference(difference, self.vocabulary)
+        self.write(differences.items())
     def contains(self, post_id):
-        return post_id in self.cache
+        """
+        Returns True if difference is cached, stored differences are loaded into memory
+        """
+        if post_id in self.cache:
+            return True
+        if self.store is not None:
+            difference = self.store.get_difference(post_id, MISSING)
+            if difference is not MISSING:
+                self.cache[post_id] = compact_difference(difference, self.vocabulary)
+                return True
+        return False
+    def __len__(self):
+        return self.store.count("differences") if self.store is not None else len(self.cache)
     
 class PostPatchStateCache:
     """
     Wrapper for caching post patch states
     Returns True if post is patched, False if not patched
+    Patched ids are stored in a bitmap file, previous jsonl cache file is migrated on first load and lines appended to it later are added on next load
+    Processes started in one directory share the bitmap file, see BitmapIdSet
     """
-    def __init__(self, cache_file="post_patch_state_cache.jsonl"):
+    def __init__(self, cache_file="post_patch_state_cache.jsonl", bitmap_file=None):
         self.cache_file = cache_file
-        self.cache = {}
+        self.bitmap_file = bitmap_file if bitmap_file is not None else os.path.splitext(cache_file)[0] + ".bitmap"
+        self.cache : BitmapIdSet = None
         self.load_cache()
     
     def load_cache(self):
-        if os.path.isfile(self.cache_file):
-            with open(self.cache_file, "r") as f:
-                for line in f:
-                    try:
-                        data = json.loads(line)
-                        self.cache[data["id"]] = data["state"]
-                    except Exception as e:
-                        continue
-                        #logging.exception("Error loading cache: {}, skipping line".format(e))
+        self.cache = migrate_jsonl(self.cache_file, self.bitmap_file)
     def get(self, post_id):
         return post_id in self.cache
     
     def set(self, post_id, state:bool=True):
-        self.cache[post_id] = state
-        to_json = {"id": post_id, "state": state}
-        with open(self.cache_file, "a") as f:
-            f.write(json.dumps(to_json) + "\n")
-        return to_json["state"]
+        if state:
+            self.cache.add(post_id)
+        else:
+            self.cache.discard(post_id)
+        return state
 
 class TagCreationCache:
     """
@@ -224,18 +461,18 @@ class TagCreationCache:
     def __init__(self, cache_file="tag_creation_cache.jsonl"):
         self.cache_file = cache_file
         self.cache = {}
+        # shared buffered appender, compaction holds it while replacing the file
+        self.appender = get_appender(cache_file)
         self.load_cache()
     
     def load_cache(self):
         if os.path.isfile(self.cache_file):
-            with open(self.cache_file, "r") as f:
-                for line in f:
-                    try:
-                        data = json.loads(line)
-                        self.cache[data["id"]] = {"tag_name": data["tag_id"], "tag_context": data["tag_name"]}
-                    except Exception as e:
-                        continue
-                        #logging.exception("Error loading cache: {}, skipping line".format(e))
+            for data in jsoncodec.iter_jsonl(self.cache_file):
+                try:
+                    self.cache[data["id"]] = {"tag_name": data["tag_id"], "tag_context": data["tag_name"]}
+                except Exception as e:
+                    continue
+                    #logging.exception("Error loading cache: {}, skipping line".format(e))
     def init_tags(self):
         """
         Initialize tags
@@ -249,19 +486,26 @@ class TagCreationCache:
     def set(self, tag_id, tag_name, tag_context):
         self.cache[tag_id] = {"tag_name": tag_name, "tag_context": tag_context}
         to_json = {"id": tag_id, "tag_name": tag_name, "tag_context": tag_context}
-        with open(self.cache_file, "a") as f:
-            f.write(json.dumps(to_json) + "\n")
+        self.appender.append(jsoncodec.dumps_line(to_json))
         return to_json
 
 requests_cache = None
+# installed in main, threads read through own read-only connections and writes use one writer connection
+db_connections : ConnectionManager = None
+
+def database_writer():
+    """
+    Returns context for database writes, which uses the writer connection if connection manager is installed
+    """
+    return db_connections.writer() if db_connections is not None else nullcontext()
 rating_dict = {"s": "sensitive", "q": "questionable", "e": "explicit", "g": "general"}
 
 difference_database = None
 
-patched_posts = PostPatchStateCache()
+# created in main, worker processes import this module and must not open the bitmap or create tags again
+patched_posts : PostPatchStateCache = None
 
-tag_creation_cache = TagCreationCache()
-tag_creation_cache.init_tags()
+tag_creation_cache : TagCreationCache = None
 
 def convert_tag_ids_to_names(tag_ids: Union[int, Tag, List[Union[int, Tag]]]) -> Union[str, List[str]]:
     """
@@ -280,9 +524,13 @@ def create_tag(string:str, tag_context="general"):
     """Create a tag in the database"""
     tag = Tag.get_or_none(Tag.name == string)
     if tag is None:
-        tag = Tag.create(name=string,type=tag_context,popularity=-1)
-        logging.info("Created tag {} with id {}".format(string,tag.id))
-        tag_creation_cache.set(tag.id, tag_name=string, tag_context=tag_context)
+        with database_writer():
+            # checked again with writer connection, another thread may have created it
+            tag = Tag.get_or_none(Tag.name == string)
+            if tag is None:
+                tag = Tag.create(name=string,type=tag_context,popularity=-1)
+                logging.info("Created tag {} with id {}".format(string,tag.id))
+                tag_creation_cache.set(tag.id, tag_name=string, tag_context=tag_context)
     return tag
 
 def convert_string_to_tag_ids(tag_names: Union[str, List[str]], context="general") -> Union[int, List[int]]:
@@ -317,7 +565,8 @@ def check_danbooru_post(post_id,by_id=False):
     try:
         url = get_query_bulk(post_id)
         #print(f"Getting response from url {url} for post {post_id}")
-        r = requests_cache.get(url)
+        with profiler.stage("danbooru_fetch"):
+            r = requests_cache.get(url)
         # check if post exists
         if len(r) == 0:
             logging.warning(f"Post {post_id} does not exist")
@@ -344,20 +593,68 @@ def check_danbooru_post(post_id,by_id=False):
             "tag_list_copyright" : r["tag_string_copyright"].split(" "),
         }
         if by_id:
-            for key in result_dict:
-                if "tag_list" not in key:
-                    continue
-                result_dict[key] = convert_string_to_tag_ids(result_dict[key],key.split("_")[2])
+            with profiler.stage("tag_resolution"):
+                for key in result_dict:
+                    if "tag_list" not in key:
+                        continue
+                    result_dict[key] = convert_string_to_tag_ids(result_dict[key],key.split("_")[2])
     except Exception as e:
         print(f"Exception: {e}")
         logging.exception(f"Error in post {post_id}: {e}")
     return result_dict
 
 def check_database_post(post_id,by_id=True):
-    post = Post.get_or_none(Post.id == post_id)
+    with profiler.stage("database_read"):
+        post = Post.get_or_none(Post.id == post_id)
+    return database_post_info(post, by_id=by_id)
+
+# tag lists are stored as delimited tag ids, only the numbers are needed
+TAG_ID_PATTERN = re.compile(r"\d+")
+DATABASE_INFO_COLUMNS = ("id", "file_url", "large_file_url", "rating", "created_at", "score", "fav_count")
+
+def check_database_posts(post_ids:List[int], by_id=True):
+    """
+    Returns dict of post_id -> database info for multiple posts, in same format as check_database_post
+    Raw columns are read through the cursor in one query, so tag lists are never converted to Tag objects,
+    names of all tags are resolved with one query if not by_id
+    Posts which do not exist are mapped to None
+    """
+    # file_url is optional in Post model, missing columns are selected as NULL
+    columns = [getattr(Post, name) if name in Post._meta.fields else SQL("NULL") for name in DATABASE_INFO_COLUMNS] + [getattr(Post, key) for key in TAG_LIST_KEYS]
+    with profiler.stage("database_read"):
+        rows = Post._meta.database.execute(Post.select(*columns).where(Post.id.in_(post_ids))).fetchall()
+    tag_lists = [[[int(tag_id) for tag_id in TAG_ID_PATTERN.findall(value)] if value else [] for value in row[len(DATABASE_INFO_COLUMNS):]] for row in rows]
+    tag_names = None
+    if not by_id:
+        with profiler.stage("tag_resolution"):
+            tag_ids = list({tag_id for lists in tag_lists for ids in lists for tag_id in ids})
+            tag_names = {}
+            # bounded below sqlite's variable limit, a page has only a few thousand tags
+            for chunk in chunked(tag_ids, 30000):
+                tag_names.update(Tag.select(Tag.id, Tag.name).where(Tag.id.in_(chunk)).tuples())
+    infos = dict.fromkeys(post_ids)
+    for row, lists in zip(rows, tag_lists):
+        post_id, file_url, large_file_url, rating, created_at, score, fav_count = row[:len(DATABASE_INFO_COLUMNS)]
+        result_dict = {
+            "id" : post_id,
+            "file_url" : large_file_url if large_file_url is not None else file_url, # use large_file_url if available (for high res images)
+            "rating" : rating_dict[rating],
+            "year" : created_at[0:4],
+            "score" : score,
+            "fav_count" : fav_count,
+        }
+        for key, ids in zip(TAG_LIST_KEYS, lists):
+            result_dict[key] = ids if by_id else [tag_names[tag_id] for tag_id in ids]
+        infos[post_id] = result_dict
+    return infos
+
+def database_post_info(post, by_id=True):
+    """
+    Returns info dict of loaded Post in same format as check_danbooru_post, or None
+    """
     if post is None:
         return None
-    else:
+    with profiler.stage("database_read"):
         result_dict = {
             "id" : post.id,
             "file_url" : post.large_file_url if post.large_file_url is not None else getattr(post,"file_url",None), # use large_file_url if available (for high res images)
@@ -371,12 +668,13 @@ def check_database_post(post_id,by_id=True):
             "tag_list_meta" : get_id_from_tag(post.tag_list_meta),
             "tag_list_copyright" : get_id_from_tag(post.tag_list_copyright),
         }
-        if not by_id:
+    if not by_id:
+        with profiler.stage("tag_resolution"):
             for key in result_dict:
                 if "tag_list" not in key:
                     continue
                 result_dict[key] = convert_tag_ids_to_names(result_dict[key])
-        return result_dict
+    return result_dict
 
 def compare_info(post_id, by_id=False):
     """
@@ -386,28 +684,87 @@ def compare_info(post_id, by_id=False):
     difference_dict = {},{}
     assert isinstance(post_id, int), f"post_id must be int but got {type(post_id)} with value {post_id}"
     danbooru_info = check_danbooru_post(post_id,by_id=by_id)
+    if danbooru_info is None:
+        return None
     database_info = check_database_post(post_id,by_id=by_id)
     if database_info is None:
         return None, danbooru_info
-    for key in danbooru_info:
-        # check "tag_list" keys
-        if "tag_list" in key:
-            if set(danbooru_info[key]) != set(database_info[key]):
-                difference_dict[0][key] = set(danbooru_info[key]) - set(database_info[key])
-                difference_dict[1][key] = set(database_info[key]) - set(danbooru_info[key])
-                # ignore meta tags
-                difference_dict[0][key] = [tag for tag in difference_dict[0][key] if not should_ignore_tag(tag)]
-                difference_dict[1][key] = [tag for tag in difference_dict[1][key] if not should_ignore_tag(tag)]
-        else:
-            # update values
+    with profiler.stage("compare"):
+        for key in danbooru_info:
+            # check "tag_list" keys
+            if "tag_list" in key:
+                if set(danbooru_info[key]) != set(database_info[key]):
+                    difference_dict[0][key] = set(danbooru_info[key]) - set(database_info[key])
+                    difference_dict[1][key] = set(database_info[key]) - set(danbooru_info[key])
+                    # ignore meta tags
+                    difference_dict[0][key] = [tag for tag in difference_dict[0][key] if not should_ignore_tag(tag)]
+                    difference_dict[1][key] = [tag for tag in difference_dict[1][key] if not should_ignore_tag(tag)]
+            else:
+                # update values
+                if key == "file_url":
+                    # check incoming url is valid
+                    if not danbooru_info[key]:
+                        continue
+                if danbooru_info[key] != database_info[key]:
+                    difference_dict[0][key] = database_info[key]
+                    # we only need to update the database from danbooru
+    return difference_dict
+
+def compare_info_batch(post_ids:List[int], by_id=False):
+    """
+    Compare danbooru and database info for multiple posts
+    Tag lists are compared as sorted index arrays for all posts at once
+    Returns dict of post_id -> difference, in same format as compare_info
+    Posts which raised exception are not included
+    """
+    infos = {}
+    for post_id in post_ids:
+        try:
+            danbooru_info = check_danbooru_post(post_id,by_id=by_id)
+            database_info = check_database_post(post_id,by_id=by_id)
+        except Exception as e:
+            logging.exception(f"Error in post {post_id}: {e}")
+            continue
+        infos[post_id] = (danbooru_info, database_info)
+    with profiler.stage("compare"):
+        return compare_infos(infos)
+
+def compare_infos(infos):
+    """
+    Compare (danbooru_info, database_info) pairs of posts
+    Returns dict of post_id -> difference, in same format as compare_info
+    Posts which do not exist on danbooru are mapped to None
+    """
+    result = {}
+    compared_ids = []
+    for post_id, (danbooru_info, database_info) in infos.items():
+        if danbooru_info is None:
+            result[post_id] = None
+            continue
+        if database_info is None:
+            result[post_id] = (None, danbooru_info)
+            continue
+        difference_dict = {},{}
+        for key in VALUE_KEYS:
             if key == "file_url":
                 # check incoming url is valid
                 if not danbooru_info[key]:
                     continue
             if danbooru_info[key] != database_info[key]:
                 difference_dict[0][key] = database_info[key]
-                # we only need to update the database from danbooru
-    return difference_dict
+        result[post_id] = difference_dict
+        compared_ids.append(post_id)
+    for key in TAG_LIST_KEYS:
+        tag_differences = diff_tag_lists(
+            [infos[post_id][0][key] for post_id in compared_ids],
+            [infos[post_id][1][key] for post_id in compared_ids],
+            tag_vocabulary,
+        )
+        for post_id, tag_difference in zip(compared_ids, tag_differences):
+            if tag_difference is None:
+                continue
+            result[post_id][0][key], result[post_id][1][key] = tag_difference
+    return result
 
 from functools import cache
 @cache
@@ -421,6 +778,10 @@ def should_ignore_tag(tag_id):
     if tag is None:
         return False
     return "bad" in tag.name and "id" in tag.name # ignore bad_*_id tags
+TAG_LIST_KEYS = ["tag_list_general", "tag_list_character", "tag_list_artist", "tag_list_meta", "tag_list_copyright"]
+# keys of post info which are compared as values
+VALUE_KEYS = ("id", "file_url", "rating", "year", "score", "fav_count")
+tag_vocabulary = TagVocabulary(should_ignore_tag)
 import threading
 from queue import Queue, Empty
 queue = Queue()
@@ -431,10 +792,17 @@ def threaded_executor():
     while True:
         try:
             task = queue.get(timeout=0.1)
-            task()
-            logging.info("Transaction complete")
-            if pbar is not None:
-                pbar.update(1)
+            try:
+                writer_backlog.set(queue.qsize())
+                with profiler.stage("writer_task"), database_writer():
+                    task()
+                writer_tasks.inc()
+                logging.info("Transaction complete")
+                if pbar is not None:
+                    pbar.update(1)
+            finally:
+                # failed tasks are done too, wait_for_writer only waits until the queue is drained
+                queue.task_done()
         except Empty:
             if event.is_set():
                 logging.info("Thread exiting, event set")
@@ -453,6 +821,12 @@ if "thread" not in globals():
     thread = threading.Thread(target=threaded_executor)
     thread.start()
 
+def wait_for_writer():
+    """
+    Blocks until all queued patches are executed by the writer thread
+    """
+    queue.join()
+
 def refresh_thread_and_event():
     """
     Refresh the thread and event
@@ -516,6 +890,7 @@ def patch_differences(id, before, after, submit=True):
     # send transaction to queue
     if submit:
         queue.put(lambda: post_by_id.save() and patched_posts.set(id))
+        writer_backlog.set(queue.qsize())
         logging.info(f"Transaction saved for post {id}, queue size: {queue.qsize()}")
     else:
         logging.info(f"Transaction not saved for post {id}, cached for further use")
@@ -532,7 +907,8 @@ def patch_differences_auto(id, submit=True, retry_count=100):
     handle_rate_limit()
     for _ in range(retry_count):
         try:
-            difference_dict = difference_database.get(id)
+            with profiler.task():
+                difference_dict = difference_database.get(id)
             break
         except Exception as e:
             # check 429 error
@@ -541,25 +917,82 @@ def patch_differences_auto(id, submit=True, retry_count=100):
             else:
                 logging.exception(f"Error in post {id}: {e}")
             continue
+    handle_difference(id, difference_dict, submit=submit)
+
+def handle_difference(id, difference_dict, submit=True):
+    """
+    Patch the post with calculated difference
+    """
     global pbar
     if pbar is not None:
         pbar.update(1)
     if difference_dict is None:
         logging.warning(f"Post {id} does not exist, patch failed")
+        posts_checked.inc(result="missing")
         return
     elif len(difference_dict[0]) == 0:
         logging.debug(f"Post {id} is up to date")
+        posts_checked.inc(result="up_to_date")
         return
+    posts_checked.inc(result="different")
     if submit:
         patch_differences(id, difference_dict[1], difference_dict[0], submit=submit)
     else:
         logging.debug(f"Post {id} had differences, but not submitted")
 
+def patch_differences_auto_batch(ids:List[int], submit=True, retry_count=100):
+    """
+    Automatically patch the differences for posts in same page
+    Differences are compared in one batch, failed posts are retried one by one
+    """
+    handle_rate_limit()
+    try:
+        with profiler.task():
+            differences = difference_database.get_many(ids)
+    except Exception as e:
+        # check 429 error
+        if isinstance(e, requests.exceptions.HTTPError) and e.response.status_code == 429:
+            rate_limit_event.set()
+        else:
+            logging.exception(f"Error in posts {ids[0]}..{ids[-1]}: {e}")
+        differences = {}
+    for id in ids:
+        if id in differences:
+            handle_difference(id, differences[id], submit=submit)
+        else:
+            patch_differences_auto(id, submit=submit, retry_count=retry_count)
+    requests_cache.release(get_query_bulk(ids[0]))
 
+def iterate_unchecked_batches(ids, submit=True, batch_size=PER_REQUEST_POSTS):
+    """
+    Yields lists of consecutive ids in same page
+    Patched posts, and cached posts if not submitting, are skipped and removed from progress bar total
+    """
+    batch = []
+    for id in tqdm(ids):
+        if isinstance(id, tuple):
+            id = id[0]
+        if patched_posts.get(id):
+            logging.debug(f"Post {id} already patched, skipping")
+            pbar.total -= 1
+            pbar.update(0)
+            continue
+        elif not submit and difference_database.contains(id):
+            logging.debug(f"Post {id} already cached, skipping")
+            pbar.total -= 1
+            pbar.update(0)
+            continue
+        if batch and (len(batch) >= batch_size or batch[-1] // PER_REQUEST_POSTS != id // PER_REQUEST_POSTS):
+            yield batch
+            batch = []
+        batch.append(id)
+    if batch:
+        yield batch
 
-def patch_differences_auto_multi(ids, threads=4, submit=True, retry_count=5, total=None):
+def patch_differences_auto_multi(ids, threads=4, submit=True, retry_count=5, total=None, batch_size=PER_REQUEST_POSTS):
     """
     Automatically patch the differences between before and after
+    Consecutive posts in same page are submitted as one batch
     """
     refresh_thread_and_event()
     print(f"Starting {threads} threads")
@@ -567,24 +1000,295 @@ def patch_differences_auto_multi(ids, threads=4, submit=True, retry_count=5, tot
     with ThreadPoolExecutor(max_workers=threads) as executor:
         global pbar
         pbar = tqdm(total=len(ids) if total is None else total)
-        submit_pbar = tqdm(ids)
-        for id in submit_pbar:
-            if isinstance(id, tuple):
-                id = id[0]
-            if patched_posts.get(id):
-                logging.debug(f"Post {id} already patched, skipping")
-                pbar.total -= 1
-                pbar.update(0)
-                continue
-            elif not submit and difference_database.contains(id):
-                logging.debug(f"Post {id} already cached, skipping")
-                pbar.total -= 1
-                pbar.update(0)
-                continue
-            future = executor.submit(partial(patch_differences_auto, id, submit=submit, retry_count=retry_count))
+        for batch in iterate_unchecked_batches(ids, submit=submit, batch_size=batch_size):
+            future = executor.submit(partial(patch_differences_auto_batch, batch, submit=submit, retry_count=retry_count))
             futures.append(future)
     logging.info("All posts submitted")
     return futures
+
+def fetch_stage(batch):
+    """
+    Pipeline stage, fetches danbooru page of posts which are not cached yet
+    """
+    item = {"ids": batch, "differences": difference_database.get_cached(batch), "infos": None}
+    missing = [post_id for post_id in batch if post_id not in item["differences"]]
+    if not missing:
+        return item
+    handle_rate_limit()
+    try:
+        with profiler.task():
+            item["danbooru"] = {post_id: check_danbooru_post(post_id) for post_id in missing}
+    except Exception as e:
+        # check 429 error
+        if isinstance(e, requests.exceptions.HTTPError) and e.response.status_code == 429:
+            rate_limit_event.set()
+        else:
+            logging.exception(f"Error in posts {batch[0]}..{batch[-1]}: {e}")
+    return item
+
+def load_stage(item):
+    """
+    Pipeline stage, loads database rows of fetched posts in one query
+    """
+    danbooru_infos = item.pop("danbooru", None)
+    if danbooru_infos is None:
+        return item
+    try:
+        with profiler.task():
+            database_infos = check_database_posts(list(danbooru_infos), by_id=False)
+        item["infos"] = {post_id: (danbooru_infos[post_id], database_infos[post_id]) for post_id in danbooru_infos}
+    except Exception as e:
+        logging.exception(f"Error in posts {item['ids'][0]}..{item['ids'][-1]}: {e}")
+    return item
+
+def diff_stage(item, submit=True, retry_count=5):
+    """
+    Pipeline stage, compares posts, caches differences and patches them
+    Posts which failed in previous stages are retried one by one
+    """
+    differences = item["differences"]
+    if item["infos"] is not None:
+        try:
+            with profiler.task():
+                with profiler.stage("compare"):
+                    compared = compare_infos(item["infos"])
+                difference_database.put_many(compared)
+            differences.update(compared)
+        except Exception as e:
+            logging.exception(f"Error in posts {item['ids'][0]}..{item['ids'][-1]}: {e}")
+    for id in item["ids"]:
+        if id in differences:
+            handle_difference(id, differences[id], submit=submit)
+        else:
+            patch_differences_auto(id, submit=submit, retry_count=retry_count)
+    requests_cache.release(get_query_bulk(item["ids"][0]))
+
+def patch_differences_pipelined(ids, fetch_workers=8, load_workers=2, diff_workers=2, prefetch=16, submit=True, retry_count=5, total=None):
+    """
+    Patch the differences with staged pipeline instead of one thread per page
+    Danbooru pages are fetched up to prefetch pages ahead while database rows of fetched pages are loaded and compared
+    Blocks until all posts are checked
+    """
+    global pbar
+    refresh_thread_and_event()
+    print(f"Starting pipeline with {fetch_workers} fetch, {load_workers} load and {diff_workers} diff workers")
+    pbar = tqdm(total=len(ids) if total is None else total)
+    pipeline = Pipeline([
+        ("fetch", fetch_stage, fetch_workers),
+        ("load", load_stage, load_workers),
+        ("diff", partial(diff_stage, submit=submit, retry_count=retry_count), diff_workers),
+    ], queue_size=prefetch)
+    pipeline.run(iterate_unchecked_batches(ids, submit=submit))
+    logging.info("All posts checked")
+
+def compare_page(batch, retry_count=5):
+    """
+    Compares posts in same page without difference cache, used by worker processes
+    Returns dict of post_id -> difference, posts which failed are not included
+    """
+    for _ in range(retry_count):
+        handle_rate_limit()
+        try:
+            with profiler.task():
+                danbooru_infos = {post_id: check_danbooru_post(post_id) for post_id in batch}
+                database_infos = check_database_posts(batch, by_id=False)
+                with profiler.stage("compare"):
+                    differences = compare_infos({post_id: (danbooru_infos[post_id], database_infos[post_id]) for post_id in batch})
+            requests_cache.release(get_query_bulk(batch[0]))
+            return differences
+        except Exception as e:
+            # check 429 error
+            if isinstance(e, requests.exceptions.HTTPError) and e.response.status_code == 429:
+                rate_limit_event.set()
+            else:
+                logging.exception(f"Error in posts {batch[0]}..{batch[-1]}: {e}")
+    return {}
+
+def multiprocess_worker(index, tasks, results, options):
+    """
+    Worker process of ProcessWorkers, compares pages of tasks and sends results to writer process
+    Database is only read here, differences and request cache entries are sent as ("page", batch, differences) and ("request", url, body)
+    """
+    global requests_cache, request_getter, session_getter, db_connections
+    logging.basicConfig(filename=options["logging_file"], level=logging.INFO)
+    # writer thread is started on import, patches are only written by writer process
+    event.set()
+    thread.join()
+    if not options["shared_connection"] and ConnectionManager.supports(Post._meta.database):
+        db_connections = ConnectionManager(Post._meta.database, mmap_size=options["db_mmap_size"], cache_size=options["db_cache_size"]).install()
+    request_getter = generate_retry_handler(options["retry"])
+    session_getter = generate_session_retry_handler(options["retry"])
+    requests_cache = ForwardingCachedRequest(options["requests_cache"], results, max_entries=options["requests_cache_entries"])
+    if options["proxies"] is not None:
+        requests_cache.proxy_handler = ProxyHandler(proxies=options["proxies"], proxy_auth=options["proxy_auth"], raw=options["proxy_raw"])
+    logging.info(f"Worker process {index} started")
+    # pages in flight are bounded, so next task is taken only when threads are free
+    slots = threading.BoundedSemaphore(options["threads"] * 2)
+    def send(batch, future):
+        try:
+            differences = future.result()
+        except Exception as e:
+            logging.exception(f"Error in posts {batch[0]}..{batch[-1]}: {e}")
+            differences = {}
+        results.put(("page", batch, differences))
+        slots.release()
+    with ThreadPoolExecutor(max_workers=options["threads"]) as executor:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            for batch in task:
+                slots.acquire()
+                executor.submit(compare_page, batch, options["retry"]).add_done_callback(partial(send, batch))
+    if requests_cache.store is not None:
+        requests_cache.store.close()
+    if db_connections is not None:
+        db_connections.close()
+    logging.info(f"Worker process {index} exiting")
+
+class ProcessWorkers:
+    """
+    Worker processes comparing posts, JSON decoding and comparing hold the GIL so threads of one process do not scale
+    This process stays the only writer, it owns the database writer connection and all cache files
+    Workers send differences and request cache entries, which are persisted and patched here
+    Processes are spawned, so workers start the same way on every platform and inherit no threads or connections
+    """
+    def __init__(self, processes, options, pages_per_task=10):
+        self.pages_per_task = pages_per_task
+        self.submit = True
+        context = multiprocessing.get_context("spawn")
+        self.tasks = context.Queue(maxsize=processes * 2)
+        self.results = context.Queue()
+        self.processes = [
+            context.Process(target=multiprocess_worker, args=(index, self.tasks, self.results, options), daemon=True)
+            for index in range(processes)
+        ]
+        for process in self.processes:
+            process.start()
+    def handle_message(self, message, submit=True):
+        """
+        Handles message of worker, returns number of completed pages
+        """
+        if message[0] == "request":
+            requests_cache.persist(message[1], message[2])
+            return 0
+        _, batch, differences = message
+        difference_database.put_many(differences)
+        for id in batch:
+            if id in differences:
+                handle_difference(id, differences[id], submit=submit)
+            else:
+                posts_checked.inc(result="failed")
+                if pbar is not None:
+                    pbar.update(1)
+        return 1
+    def check(self, ids, submit=True, total=None):
+        """
+        Checks posts with worker processes, blocks until all posts are checked
+        Cached differences are handled here without sending them to workers
+        """
+        global pbar
+        self.submit = submit
+        refresh_thread_and_event()
+        print(f"Starting check with {len(self.processes)} worker processes")
+        pbar = tqdm(total=len(ids) if total is None else total)
+        dispatched = [0]
+        feeding_done = threading.Event()
+        def feed():
+            try:
+                task = []
+                for batch in iterate_unchecked_batches(ids, submit=submit):
+                    cached = difference_database.get_cached(batch) if submit else {}
+                    for id, difference in cached.items():
+                        handle_difference(id, difference, submit=submit)
+                    missing = [id for id in batch if id not in cached]
+                    if missing:
+                        task.append(missing)
+                    if len(task) >= self.pages_per_task:
+                        self.tasks.put(task)
+                        dispatched[0] += len(task)
+                        task = []
+                if task:
+                    self.tasks.put(task)
+                    dispatched[0] += len(task)
+            except Exception as e:
+                logging.exception(f"Error while dispatching posts: {e}")
+            finally:
+                feeding_done.set()
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        received = 0
+        while not (feeding_done.is_set() and received >= dispatched[0]):
+            try:
+                message = self.results.get(timeout=1)
+            except Empty:
+                if not any(process.is_alive() for process in self.processes):
+                    logging.error(f"All worker processes exited, {dispatched[0] - received} pages were not checked")
+                    break
+                continue
+            received += self.handle_message(message, submit=submit)
+        feeder.join()
+        logging.info("All posts checked")
+    def close(self):
+        """
+        Stops workers, messages sent meanwhile are still handled
+        """
+        for _ in self.processes:
+            self.tasks.put(None)
+        while any(process.is_alive() for process in self.processes) or not self.results.empty():
+            try:
+                self.handle_message(self.results.get(timeout=0.1), submit=self.submit)
+            except Empty:
+                continue
+        for process in self.processes:
+            process.join()
+
+def wait_for_futures(futures):
+    """
+    Wait for futures, returns False if interrupted
+    """
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except Exception as e:
+            if isinstance(e, KeyboardInterrupt):
+                logging.info("Exiting...")
+                event.set()
+                return False
+            else:
+                logging.exception("Error in future: {}".format(e))
+                continue
+    return True
+
+def patch_differences_coordinated(coordinator:LeaseCoordinator, worker, threads=4, submit=True, retry_count=5, pipeline_options=None, process_workers:ProcessWorkers=None):
+    """
+    Patch the differences of id blocks leased from coordinator until all blocks are done
+    Slow or dead workers only hold their current block, which is reissued when lease expires
+    If pipeline_options is given, blocks are checked with patch_differences_pipelined using the options
+    If process_workers is given, blocks are checked by its worker processes
+    """
+    for lease in coordinator.leases(worker):
+        # leaving the context without completing the lease releases the block
+        with lease:
+            start, end = lease.start, lease.end
+            logging.info(f"Worker {worker} leased block {start}..{end}")
+            ids = Post.select(Post.id).where((Post.id >= start) & (Post.id < end)).tuples()
+            if process_workers is not None:
+                process_workers.check(ids, submit=submit, total=len(ids))
+            elif pipeline_options is not None:
+                patch_differences_pipelined(ids, submit=submit, retry_count=retry_count, total=len(ids), **pipeline_options)
+            else:
+                futures = patch_differences_auto_multi(ids, threads=threads, submit=submit, retry_count=retry_count, total=len(ids))
+                if not wait_for_futures(futures):
+                    break
+            # queued patches are saved and marked patched before results are synced and block is completed
+            wait_for_writer()
+            checkpoint_all()
+            patched_posts.cache.flush()
+            if not lease.complete():
+                logging.warning(f"Worker {worker} lost lease of block {start}..{end}, it was reissued to another worker")
+                continue
+        logging.info(f"Worker {worker} finished block {start}..{end}, progress: {coordinator.progress()}")
 import argparse
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Sanity check for danbooru database')
@@ -599,61 +1303,134 @@ if __name__ == "__main__":
     parser.add_argument('--proxy-file', type=str, default=None, help='Filepath to proxy list')
     parser.add_argument('--proxy-address', type=str, default=None, help='Proxy address')
     parser.add_argument('--proxy-auth', type=str, default=r"", help='Proxy authentication (user:password)')
+    parser.add_argument('--proxy-raw', action="store_true", help='Proxy sends upstream body from get_response_raw instead of json envelope')
     parser.add_argument('--logging-file', type=str, default=log_file, help='Logging file')
     parser.add_argument('--save-file', type=str, default="difference_cache.jsonl", help='Difference cache file')
     parser.add_argument('--requests-cache', type=str, default="cache.jsonl", help='Requests cache file')
+    # usage : python sanity_check.py --threads 400 --requests-cache-entries 1600 --requests-cache cache_proxy.jsonl
+    parser.add_argument('--requests-cache-entries', type=int, default=0, help='Responses kept in memory, others are read again from requests cache file, 0 keeps all responses, bounds below threads * 4 evict pages in flight')
     # --unordered
     parser.add_argument('--unordered', action="store_true", help='Shuffle the posts')
+    # usage : python sanity_check.py --coordinator coordinator.sqlite --worker-id 0 --threads 8 --proxy --proxy-address http://ip:port
+    parser.add_argument('--coordinator', type=str, default=None, help='Lease coordinator file, id blocks are taken from it instead of --start-idx and --end-idx')
+    parser.add_argument('--worker-id', type=str, default=f"{socket.gethostname()}-{os.getpid()}", help='Worker name for coordinator leases')
+    parser.add_argument('--lease-time', type=float, default=300, help='Seconds until lease of unresponsive worker expires')
+    parser.add_argument('--metrics-file', type=str, default=None, help='Metrics file, rewritten periodically (.json for json, prometheus text otherwise)')
+    parser.add_argument('--metrics-interval', type=float, default=10, help='Seconds between metrics file updates')
+    parser.add_argument('--profile', action="store_true", help='Print wall time and call count per stage at exit')
+    parser.add_argument('--profile-dump', type=str, default=None, help='Prefix of per-thread cProfile dumps, requires --profile')
+    parser.add_argument('--profile-sample', type=int, default=100, help='Run cProfile for every Nth task of each thread')
+    parser.add_argument('--compact-interval', type=float, default=0, help='Seconds between background compactions of jsonl caches, 0 to disable')
+    parser.add_argument('--compact-min-growth', type=int, default=16 << 20, help='Bytes a cache file has to grow before it is compacted again')
+    parser.add_argument('--append-buffer', type=int, default=1 << 20, help='Bytes buffered per cache file before writing')
+    parser.add_argument('--append-interval', type=float, default=1.0, help='Seconds between flushes of buffered cache writes')
+    parser.add_argument('--append-fsync', action="store_true", help='Sync cache files to disk on every flush, otherwise only on checkpoints')
+    # usage : python sanity_check.py --pipeline --fetch-workers 32 --load-workers 4 --diff-workers 2 --prefetch 64 --proxy --proxy-address http://ip:port
+    parser.add_argument('--pipeline', action="store_true", help='Check posts with staged fetch, database load and diff workers instead of --threads')
+    parser.add_argument('--fetch-workers', type=int, default=8, help='Pipeline workers fetching danbooru pages')
+    parser.add_argument('--load-workers', type=int, default=2, help='Pipeline workers loading database rows')
+    parser.add_argument('--diff-workers', type=int, default=2, help='Pipeline workers comparing and patching posts')
+    parser.add_argument('--prefetch', type=int, default=16, help='Pages queued between pipeline stages')
+    parser.add_argument('--shared-connection', action="store_true", help='Use connection of db.py for reads and writes instead of per-thread read-only connections')
+    parser.add_argument('--db-mmap-size', type=int, default=1 << 30, help='mmap_size pragma of database connections')
+    parser.add_argument('--db-cache-size', type=int, default=-8192, help='cache_size pragma of each database connection, negative values are KiB')
+    # usage : python sanity_check.py --processes 8 --threads 16 --proxy --proxy-address http://ip:port
+    parser.add_argument('--processes', type=int, default=0, help='Worker processes comparing posts with --threads threads each, this process only writes database and caches')
     args = parser.parse_args()
     logging.basicConfig(filename=args.logging_file, level=logging.INFO)
+    patched_posts = PostPatchStateCache()
+    tag_creation_cache = TagCreationCache()
+    tag_creation_cache.init_tags()
+    if args.profile:
+        profiler.enable(sample_every=args.profile_sample, dump_prefix=args.profile_dump)
+    if not args.shared_connection and ConnectionManager.supports(Post._meta.database):
+        db_connections = ConnectionManager(Post._meta.database, mmap_size=args.db_mmap_size, cache_size=args.db_cache_size).install()
+    configure_appenders(max_buffer=args.append_buffer, interval=args.append_interval, fsync=args.append_fsync)
+    metrics_exporter = start_exporter(args.metrics_file, interval=args.metrics_interval) if args.metrics_file is not None else None
     request_getter = generate_retry_handler(args.retry)
     session_getter = generate_session_retry_handler(args.retry)
     difference_database = DifferenceCache(args.save_file)
-    requests_cache = CachedRequest(args.requests_cache)
+    requests_cache = CachedRequest(args.requests_cache, max_entries=args.requests_cache_entries)
+    compactor = None
+    if args.compact_interval > 0:
+        compactor = BackgroundCompactor([
+            (cache.cache_file, CACHE_KEYS[kind], cache.appender)
+            for kind, cache in (("requests", requests_cache), ("differences", difference_database), ("tag_creation", tag_creation_cache))
+            if getattr(cache, "store", None) is None
+        ], interval=args.compact_interval, min_growth=args.compact_min_growth)
+        compactor.start()
     print(f"Found finished transactions: {len(patched_posts.cache)}")
-    print(f"Found cached differences: {len(difference_database.cache)}")
+    print(f"Found cached differences: {len(difference_database)}")
+    proxies = None
     if args.proxy:
         if args.proxy_file is not None:
             with open(args.proxy_file, "r", encoding="utf-8") as f:
                 proxies = [line.strip() for line in f]
-            proxyhandler = ProxyHandler(proxies=proxies, proxy_auth=args.proxy_auth)
+            proxyhandler = ProxyHandler(proxies=proxies, proxy_auth=args.proxy_auth, raw=args.proxy_raw)
         elif args.proxy_address is not None:
-            proxyhandler = ProxyHandler(proxies=[args.proxy_address], proxy_auth=args.proxy_auth)
+            proxies = [args.proxy_address]
+            proxyhandler = ProxyHandler(proxies=proxies, proxy_auth=args.proxy_auth, raw=args.proxy_raw)
         else:
             raise ValueError("Must specify either --proxy-file or --proxy-address")
         # bind
         requests_cache.proxy_handler = proxyhandler
-    # lazy iterator for peewee
-    all_post_ids = []
-    if args.all:
-        all_post_ids = Post.select(Post.id)
+    process_workers = None
+    if args.processes > 0:
+        process_workers = ProcessWorkers(args.processes, {
+            "threads": args.threads, "retry": args.retry, "logging_file": args.logging_file,
+            "requests_cache": args.requests_cache, "requests_cache_entries": args.requests_cache_entries,
+            "proxies": proxies, "proxy_auth": args.proxy_auth, "proxy_raw": args.proxy_raw,
+            "shared_connection": args.shared_connection, "db_mmap_size": args.db_mmap_size, "db_cache_size": args.db_cache_size,
+        })
+    pipeline_options = None
+    if args.pipeline:
+        pipeline_options = {"fetch_workers": args.fetch_workers, "load_workers": args.load_workers, "diff_workers": args.diff_workers, "prefetch": args.prefetch}
+    if args.coordinator is not None:
+        coordinator = LeaseCoordinator(args.coordinator, lease_time=args.lease_time)
+        print(f"Coordinator progress: {coordinator.progress()}")
+        patch_differences_coordinated(coordinator, args.worker_id, threads=args.threads, submit=args.submit, retry_count=args.retry, pipeline_options=pipeline_options, process_workers=process_workers)
+        coordinator.close()
     else:
-        all_post_ids = Post.select(Post.id).where(Post.id >= args.start_idx)
-        if args.end_idx != -1:
-            all_post_ids = all_post_ids.where(Post.id <= args.end_idx)
-    if args.unordered:
-        all_post_ids = all_post_ids.order_by(fn.Random())
-    all_post_ids = all_post_ids.tuples()
-    print(f"Found {len(all_post_ids)} posts")
-    futures = patch_differences_auto_multi(all_post_ids, threads=args.threads, submit=args.submit, retry_count=args.retry, total=len(all_post_ids))
-    logging.info("All posts submitted, waiting for futures")
-    for future in as_completed(futures):
-        try:
-            future.result()
-        except Exception as e:
-            if isinstance(e, KeyboardInterrupt):
-                logging.info("Exiting...")
-                event.set()
-                break
-            else:
-                logging.exception("Error in future: {}".format(e))
-                continue
+        # lazy iterator for peewee
+        all_post_ids = []
+        if args.all:
+            all_post_ids = Post.select(Post.id)
+        else:
+            all_post_ids = Post.select(Post.id).where(Post.id >= args.start_idx)
+            if args.end_idx != -1:
+                all_post_ids = all_post_ids.where(Post.id <= args.end_idx)
+        if args.unordered:
+            all_post_ids = all_post_ids.order_by(fn.Random())
+        all_post_ids = all_post_ids.tuples()
+        print(f"Found {len(all_post_ids)} posts")
+        if process_workers is not None:
+            process_workers.check(all_post_ids, submit=args.submit, total=len(all_post_ids))
+        elif pipeline_options is not None:
+            patch_differences_pipelined(all_post_ids, submit=args.submit, retry_count=args.retry, total=len(all_post_ids), **pipeline_options)
+        else:
+            futures = patch_differences_auto_multi(all_post_ids, threads=args.threads, submit=args.submit, retry_count=args.retry, total=len(all_post_ids))
+            logging.info("All posts submitted, waiting for futures")
+            wait_for_futures(futures)
     logging.info("All posts checked")
     logging.info("Exiting...")
+    if process_workers is not None:
+        process_workers.close()
     # set event to stop thread
     event.set()
     thread.join()
     logging.info("Thread joined")
+    patched_posts.cache.flush()
+    checkpoint_all()
+    for cache in (requests_cache, difference_database):
+        if cache.store is not None:
+            cache.store.close()
+    if db_connections is not None:
+        db_connections.close()
+    if compactor is not None:
+        compactor.stop()
+    if metrics_exporter is not None:
+        metrics_exporter.stop()
+    profiler.finish()
     logging.info("Exiting...")
     if pbar is not None:
         pbar.close()
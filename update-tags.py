@@ -4,12 +4,15 @@ from typing import List
 import requests
 import os
 from functools import cache
-import json
+from utils import jsoncodec
 import time
 from threading import Lock
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from utils.proxyhandler import ProxyHandler
+from utils.idset import BitmapIdSet, migrate_jsonl
+from utils.metrics import registry, start_exporter
+from utils.cursorcrawler import AdaptivePageSize, CursorCheckpoints, split_segments, crawl_segment
 
 handler = ProxyHandler("ips.txt", port=80, wait_time=0.12, timeouts=15, proxy_auth="user:password_notdefault")
 handler.check()
@@ -17,7 +20,11 @@ print(f"Proxy Handler Checked, total {len(handler.proxy_list)} proxies")
 filelock = Lock()
 # faster
 PER_REQUEST_POSTS = 100
-post_ids = set()
+# largest limit of tags.json
+MAX_PAGE_LIMIT = 1000
+post_ids = BitmapIdSet()
+crawled_requests = registry.counter("crawler_requests_total", "Crawler requests by crawler and result")
+crawled_items = registry.counter("crawler_items_total", "Items written by crawler")
 @cache
 def split_query(start, end) -> List[str]:
     """
@@ -50,40 +57,54 @@ def get_response(url):
     """
     try:
         response = handler.get_response(url)
+        crawled_requests.inc(crawler="tags", result="success" if response is not None else "failed")
         return response
     except Exception as e:
         print(f"Exception: {e}")
+        crawled_requests.inc(crawler="tags", result="exception")
         return None
 total_posts = 0
-def write_to_file(data, post_file='tag.jsonl'):
+def write_to_file(data, post_file='tag.jsonl', expected=PER_REQUEST_POSTS):
     """
     Writes the data to the file
+    If expected is given, responses with other number of items are reported
+    Returns False if the page could not be written
     """
     global pbar, total_posts
     skipped = 0
     # if no directory, create directory
     if not os.path.exists(os.path.dirname(post_file)):
         os.makedirs(os.path.dirname(post_file), exist_ok=True)
+    # page is written to temporary file and ids are added after it is complete,
+    # so an interrupted write leaves neither a partial page nor ids of unwritten posts
+    temp_file = post_file + ".tmp"
+    written = []
     try:
         if os.path.exists(post_file):
-            return
-        with open(post_file, 'w') as f:
+            return True
+        with open(temp_file, 'wb') as f:
             if not isinstance(data, list):
                 print(f"Error: {data}")
             total_posts += len(data)
-            if len(data) != PER_REQUEST_POSTS:
-                print(f"Warning: {len(data)} posts in response, expected {PER_REQUEST_POSTS}")
+            if expected is not None and len(data) != expected:
+                print(f"Warning: {len(data)} posts in response, expected {expected}")
             print(f"Wrote {total_posts} posts to file")
             for post in data:
                 if 'id' not in post:
                     print(f"Error: {post}")
                     continue
                 #assert "file_url" in post or "large_file_url" in post, f"Post has no file url: {post['id']} : post {post}" # gold account?
-                f.write(json.dumps(post))
-                f.write('\n')
-                post_ids.add(post['id'])
+                f.write(jsoncodec.dumps_line(post))
+                crawled_items.inc(crawler="tags")
+                written.append(post['id'])
+        os.replace(temp_file, post_file)
+        post_ids.update(written)
+        return True
     except Exception as e:
         print(f"Exception: {e} while writing to file")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        return False
 def get_posts(query, post_file='tags.jsonl'):
     """
     Gets the posts from the query
@@ -124,20 +145,67 @@ def get_posts_threaded(queries, post_file='tags/tag.jsonl'):
             except Exception as e:
                 print(f"Exception: {e}")
     #wait until all threads are done
+
+def get_cursor_query(last_id, end_id, limit):
+    """
+    Returns the query link of the page after last_id, limited to ids before end_id
+    """
+    return rf"https://danbooru.donmai.us/tags.json?limit={limit}&page=a{last_id}&search[id_lt]={end_id}"
+
+def write_page(items, first_id, last_id):
+    return write_to_file(items, post_file=f"tags/{first_id // 1000000}M/{first_id}_{last_id}.jsonl", expected=None)
+
+def crawl_cursor(start, end, segment_size=100000, max_limit=MAX_PAGE_LIMIT):
+    """
+    Crawls tags in [start, end) with one cursor per segment instead of fixed 100-id windows
+    Tag ids are sparse, so pages skip missing ids instead of requesting them
+    Segments continue after the largest id crawled by previous cursor runs, ids of fixed-window runs are not used as checkpoints
+    """
+    global pbar
+    page_size = AdaptivePageSize(maximum=max_limit)
+    checkpoints = CursorCheckpoints("tags/cursor_checkpoints.json")
+    segments = split_segments(start, end, segment_size)
+    pbar = tqdm(total=len(segments))
+    total_requests = 0
+    with ThreadPoolExecutor(max_workers=len(handler.proxy_list) * 5) as executor:
+        futures = [
+            executor.submit(crawl_segment, get_response, get_cursor_query, segment_start, segment_end, write_page, page_size, checkpoints=checkpoints)
+            for segment_start, segment_end in segments
+        ]
+        for future in as_completed(futures):
+            try:
+                total_requests += future.result()
+            except Exception as e:
+                print(f"Exception: {e}")
+            pbar.update(1)
+    print(f"Crawled {len(segments)} segments with {total_requests} requests, page size {page_size.get()}")
+
 if __name__ == '__main__':
-    # test
+    import argparse
+    parser = argparse.ArgumentParser(description='Crawl danbooru tags')
+    # usage : python update-tags.py --cursor --segment-size 100000
+    parser.add_argument('--start', type=int, default=1, help='First tag id')
+    parser.add_argument('--end', type=int, default=2068075, help='Last tag id')
+    parser.add_argument('--cursor', action="store_true", help='Page by id after last seen tag with adaptive page size instead of fixed 100-id windows')
+    parser.add_argument('--segment-size', type=int, default=100000, help='Ids per cursor segment, segments are crawled in parallel')
+    parser.add_argument('--max-limit', type=int, default=MAX_PAGE_LIMIT, help='Largest page size of cursor mode')
+    parser.add_argument('--metrics-file', type=str, default=None, help='Metrics file, rewritten periodically (.json for json, prometheus text otherwise)')
+    parser.add_argument('--metrics-interval', type=float, default=10, help='Seconds between metrics file updates')
+    args = parser.parse_args()
     post_file = 'tags/tag.jsonl'
-    if os.path.exists(post_file):
-        _lines = 0
-        with open(post_file, 'r') as f:
-            for line in f:
-                try:
-                    post_ids.add(json.loads(line)['id'])
-                except:
-                    print(f"Error: {line}")
-                _lines += 1
-        print(f"Total Posts: {len(post_ids)}")
-        print(f"Total Lines: {_lines}")
-    queries = split_query(1, 2068075)
-    pbar = tqdm(total=len(queries))
-    get_posts_threaded(queries, post_file=post_file)
+    # seen ids are persisted as bitmap, previous jsonl file is migrated on first run
+    post_ids = migrate_jsonl(post_file, "tags/tag_ids.bitmap")
+    print(f"Total Posts: {len(post_ids)}")
+    metrics_exporter = start_exporter(args.metrics_file, interval=args.metrics_interval) if args.metrics_file is not None else None
+    try:
+        if args.cursor:
+            crawl_cursor(args.start, args.end + 1, segment_size=args.segment_size, max_limit=args.max_limit)
+        else:
+            queries = split_query(args.start, args.end)
+            pbar = tqdm(total=len(queries))
+            get_posts_threaded(queries, post_file=post_file)
+    finally:
+        post_ids.flush()
+        # last interval is exported on stop
+        if metrics_exporter is not None:
+            metrics_exporter.stop()
@@ -0,0 +1,129 @@
+"""
+Buffered, thread-safe appender for jsonl caches
+One open handle per file, lines are buffered and written in one write call per flush
+"""
+
+import os
+import atexit
+import threading
+
+class BufferedAppender:
+    """
+    Appends lines to file through one handle, shared by threads
+    Buffer is flushed when it exceeds max_buffer bytes, every interval seconds, on checkpoint and at exit
+    Only complete lines are written, so a crash loses buffered lines but never leaves interleaved lines
+    If fsync is True every flush is synced to disk, otherwise only checkpoint() syncs
+
+    Holding the appender as context manager flushes and closes the file, so it can be replaced meanwhile
+    The file is opened again on the next flush
+    """
+    def __init__(self, path, max_buffer=1 << 20, interval=1.0, fsync=False):
+        self.path = path
+        self.max_buffer = max_buffer
+        self.interval = interval
+        self.fsync = fsync
+        self.lock = threading.RLock()
+        self.buffer = []
+        self.buffer_size = 0
+        self.file = None
+        self.flusher = None
+        self.stop_event = threading.Event()
+    def append(self, data:bytes):
+        """
+        Appends data, which should be one or more complete lines
+        """
+        with self.lock:
+            self.buffer.append(data)
+            self.buffer_size += len(data)
+            if self.buffer_size >= self.max_buffer:
+                self._flush()
+            elif self.flusher is None and self.interval > 0:
+                self.flusher = threading.Thread(target=self._run, daemon=True)
+                self.flusher.start()
+    def _flush(self, fsync=False):
+        if self.buffer:
+            if self.file is None:
+                self.file = open(self.path, "ab")
+            self.file.write(b"".join(self.buffer))
+            self.file.flush()
+            self.buffer = []
+            self.buffer_size = 0
+        if (fsync or self.fsync) and self.file is not None:
+            os.fsync(self.file.fileno())
+    def flush(self):
+        with self.lock:
+            self._flush()
+    def checkpoint(self):
+        """
+        Flushes buffer and syncs file to disk
+        """
+        with self.lock:
+            self._flush(fsync=True)
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Exception: {e} while flushing {self.path}")
+    def close(self):
+        self.stop_event.set()
+        with self.lock:
+            self._flush(fsync=True)
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self._flush()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        except BaseException:
+            self.lock.release()
+            raise
+        return self
+    def __exit__(self, *exc):
+        self.lock.release()
+        return False
+
+appenders = {}
+appenders_lock = threading.Lock()
+default_options = {"max_buffer": 1 << 20, "interval": 1.0, "fsync": False}
+
+def configure(**options):
+    """
+    Sets flush options of existing and future shared appenders
+    """
+    default_options.update(options)
+    with appenders_lock:
+        for appender in appenders.values():
+            for name, value in options.items():
+                setattr(appender, name, value)
+
+def get_appender(path, **options):
+    """
+    Returns shared appender of path, created with default_options updated by options on first call
+    """
+    key = os.path.abspath(path)
+    with appenders_lock:
+        appender = appenders.get(key)
+        if appender is None:
+            appender = appenders[key] = BufferedAppender(path, **{**default_options, **options})
+        return appender
+
+def checkpoint_all():
+    """
+    Flushes and syncs all shared appenders
+    """
+    with appenders_lock:
+        targets = list(appenders.values())
+    for appender in targets:
+        appender.checkpoint()
+
+@atexit.register
+def close_all():
+    with appenders_lock:
+        targets = list(appenders.values())
+    for appender in targets:
+        appender.close()
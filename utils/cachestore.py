@@ -0,0 +1,165 @@
+import os
+import re
+import glob
+from utils import jsoncodec
+import sqlite3
+import threading
+
+def is_store_file(filepath):
+    """
+    Returns True if filepath should be opened as SqliteCacheStore instead of jsonl
+    """
+    return os.path.splitext(filepath)[1] in (".sqlite", ".sqlite3", ".db")
+
+# orders of cache files for expand_cache_files
+CACHE_FILE_ORDERS = ("name", "given", "mtime")
+
+def cache_file_order(filepath):
+    """
+    Sort key of cache files of split runs, entries of files later in order replace earlier ones
+    Files are ordered by the numbers in their name (id range or run index), then by name, so the order survives copying
+    """
+    name = os.path.basename(filepath)
+    return [int(number) for number in re.findall(r"\d+", name)], name, filepath
+
+def expand_cache_files(patterns, order="name"):
+    """
+    Returns files matching glob patterns in merge order, entries of later files win
+    "name" sorts with cache_file_order, "given" keeps order of patterns and sorts each pattern with cache_file_order,
+    "mtime" sorts by modification time, which changes when files are copied or extracted
+    """
+    if order not in CACHE_FILE_ORDERS:
+        raise ValueError(f"Unknown cache file order {order}, expected one of {CACHE_FILE_ORDERS}")
+    files = []
+    for pattern in patterns:
+        for file in sorted(glob.glob(pattern), key=cache_file_order):
+            if file not in files:
+                files.append(file)
+    if order == "name":
+        files.sort(key=cache_file_order)
+    elif order == "mtime":
+        files.sort(key=lambda file: (os.path.getmtime(file), file))
+    return files
+
+def get_page_start(url):
+    """
+    Returns the first post id of posts.json?tags=id%3A{start}..{end} query, or None
+    """
+    match = re.search(r"id(?:%3A|:)(\d+)\.\.", url)
+    return int(match.group(1)) if match else None
+
+class SqliteCacheStore:
+    """
+    Deduplicated store for request and difference caches, indexed by url / post id
+    Any worker can look up entries regardless of which range produced them
+    Each thread uses its own connection, journal is in WAL mode so readers do not block writers
+    Connections of all threads are closed by close()
+    """
+    def __init__(self, path="cache_store.sqlite"):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        connection = self.connection
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS requests (url TEXT PRIMARY KEY, page_start INTEGER, response TEXT NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS requests_page_start ON requests (page_start)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS differences (id INTEGER PRIMARY KEY, difference TEXT NOT NULL)"
+        )
+    @property
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # closed by close() from another thread
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+    def get_request(self, url):
+        """
+        Returns cached response of url, or None
+        """
+        row = self.connection.execute("SELECT response FROM requests WHERE url = ?", (url,)).fetchone()
+        return jsoncodec.loads(row[0]) if row is not None else None
+    def put_request(self, url, response):
+        self.put_requests([(url, response)])
+    def put_requests(self, items):
+        """
+        Stores (url, response) pairs, existing urls are replaced
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO requests (url, page_start, response) VALUES (?, ?, ?)",
+            ((url, get_page_start(url), jsoncodec.dumps_str(response)) for url, response in items),
+        )
+    def put_request_raw(self, url, body:bytes):
+        """
+        Stores original response body of url without decoding and encoding it again
+        """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO requests (url, page_start, response) VALUES (?, ?, ?)",
+            (url, get_page_start(url), body.decode("utf-8")),
+        )
+    def get_difference(self, post_id, default=None):
+        """
+        Returns cached difference of post, or default if post is not stored
+        Note that difference itself can be None, pass a sentinel as default to check existence with one query
+        """
+        row = self.connection.execute("SELECT difference FROM differences WHERE id = ?", (post_id,)).fetchone()
+        return jsoncodec.loads(row[0]) if row is not None else default
+    def put_difference(self, post_id, difference):
+        self.put_differences([(post_id, difference)])
+    def put_differences(self, items):
+        """
+        Stores (post_id, difference) pairs, existing ids are replaced
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO differences (id, difference) VALUES (?, ?)",
+            ((post_id, jsoncodec.dumps_str(difference)) for post_id, difference in items),
+        )
+    def count(self, table):
+        assert table in ("requests", "differences"), f"Unknown table {table}"
+        return self.connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    def merge_jsonl(self, filepath, kind, batch_size=10000):
+        """
+        Merges jsonl cache file into the store, kind is "requests" or "differences"
+        Later entries replace earlier ones, malformed lines are skipped
+        Returns number of merged lines
+        """
+        assert kind in ("requests", "differences"), f"Unknown kind {kind}"
+        key, value = ("url", "response") if kind == "requests" else ("id", "difference")
+        put = self.put_requests if kind == "requests" else self.put_differences
+        merged = 0
+        batch = []
+        connection = self.connection
+        connection.execute("BEGIN")
+        try:
+            for data in jsoncodec.iter_jsonl(filepath, batch_size):
+                try:
+                    batch.append((data[key], data[value]))
+                except Exception as e:
+                    continue
+                if len(batch) >= batch_size:
+                    put(batch)
+                    merged += len(batch)
+                    batch = []
+            put(batch)
+            merged += len(batch)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return merged
+    def close(self):
+        """
+        Closes connections of all threads, the store should not be used afterwards
+        """
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+        self.local = threading.local()
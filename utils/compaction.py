@@ -0,0 +1,133 @@
+"""
+Compaction of append-only jsonl caches
+Keeps only the latest entry per key and drops malformed and partial lines
+The file is rewritten to a temporary path and replaced atomically, readers see either the old or the compacted file
+"""
+
+import os
+import threading
+from contextlib import nullcontext
+from utils import jsoncodec
+
+# key of each jsonl cache written by sanity_check
+CACHE_KEYS = {
+    "requests": "url",
+    "differences": "id",
+    "tag_creation": "id",
+}
+
+def read_latest_lines(filepath, key):
+    """
+    Returns (dict of key -> (offset, length) of latest line, lines read, offset of first unread byte)
+    Only positions are kept, so memory does not grow with the size of the lines
+    Trailing line without newline is not read, it can be partially written
+    """
+    latest = {}
+    read = 0
+    offset = 0
+    with open(filepath, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            read += 1
+            try:
+                entry_key = jsoncodec.loads(line)[key]
+                # moved to the end, so lines keep the order of their latest write
+                latest.pop(entry_key, None)
+                latest[entry_key] = (offset, len(line))
+            except Exception as e:
+                pass
+            offset += len(line)
+    return latest, read, offset
+
+def copy_ranges(source, target, ranges, chunk_size=1 << 20):
+    """
+    Copies (offset, length) ranges of source file to target in order, adjacent ranges are copied as one
+    """
+    start, end = None, None
+    for offset, length in ranges:
+        if offset == end:
+            end += length
+            continue
+        if start is not None:
+            copy_range(source, target, start, end - start, chunk_size)
+        start, end = offset, offset + length
+    if start is not None:
+        copy_range(source, target, start, end - start, chunk_size)
+
+def copy_range(source, target, offset, length, chunk_size=1 << 20):
+    source.seek(offset)
+    while length > 0:
+        data = source.read(min(length, chunk_size))
+        if not data:
+            raise EOFError(f"{source.name} ended before offset {offset + length}")
+        target.write(data)
+        length -= len(data)
+
+def compact_jsonl(filepath, key, lock=None):
+    """
+    Rewrites jsonl file with only the latest line per key, lines are kept byte for byte in order of their latest write
+    Returns (lines read, lines kept), or None if file does not exist or could not be replaced
+    Lines appended during compaction are copied to the compacted file before replacing
+    lock is held while the tail is copied and the file is replaced, appenders in this process should hold the same lock
+    BufferedAppender can be passed as lock, it is flushed and its handle is closed while held
+    Appenders in other processes are not blocked, a line appended between the tail copy and the replace can be lost,
+    so run compaction from the process which writes the cache or while no other process writes it
+    """
+    if not os.path.isfile(filepath):
+        return None
+    latest, read, offset = read_latest_lines(filepath, key)
+    temp_path = filepath + ".compact.tmp"
+    with open(temp_path, "wb") as f:
+        # compacted part of the file is not modified by appenders, latest lines are copied by position
+        with open(filepath, "rb") as source:
+            copy_ranges(source, f, latest.values())
+        with lock if lock is not None else nullcontext():
+            with open(filepath, "rb") as source:
+                source.seek(offset)
+                tail = source.read()
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            try:
+                os.replace(temp_path, filepath)
+            except PermissionError as e:
+                # windows does not allow replacing a file which is open in another process
+                print(f"Could not replace {filepath}: {e}, compaction skipped")
+                os.remove(temp_path)
+                return None
+    return read, len(latest) + tail.count(b"\n")
+
+class BackgroundCompactor(threading.Thread):
+    """
+    Periodically compacts jsonl caches in a daemon thread
+    targets is list of (filepath, key, lock), a file is compacted when it grew by min_growth bytes since the last compaction
+    """
+    def __init__(self, targets, interval=600, min_growth=16 << 20):
+        super().__init__(daemon=True)
+        self.targets = targets
+        self.interval = interval
+        self.min_growth = min_growth
+        self.stop_event = threading.Event()
+        self.compacted_size = {}
+    def compact_once(self, force=False):
+        for filepath, key, lock in self.targets:
+            if not os.path.isfile(filepath):
+                continue
+            size = os.path.getsize(filepath)
+            if not force and size - self.compacted_size.get(filepath, 0) < self.min_growth:
+                continue
+            result = compact_jsonl(filepath, key, lock)
+            if result is None:
+                continue
+            self.compacted_size[filepath] = os.path.getsize(filepath)
+            print(f"Compacted {filepath}: {result[0]} lines to {result[1]} lines, {size} bytes to {self.compacted_size[filepath]} bytes")
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.compact_once()
+            except Exception as e:
+                print(f"Exception: {e} while compacting caches")
+    def stop(self):
+        self.stop_event.set()
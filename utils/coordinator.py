@@ -0,0 +1,146 @@
+import time
+import sqlite3
+from threading import Lock, Thread, Event
+
+class LeaseCoordinator:
+    """
+    Hands out id blocks [start, end) to workers on demand from a sqlite lease table
+    Workers acquire a block, renew the lease while working on it and mark it done
+    Leases which are not renewed expire and are reissued to other workers
+    Multiple processes on same machine can share the same file
+    """
+    def __init__(self, path="coordinator.sqlite", lease_time=300):
+        self.path = path
+        self.lease_time = lease_time
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS blocks ("
+            "start INTEGER PRIMARY KEY, end INTEGER NOT NULL, state TEXT NOT NULL DEFAULT 'pending', "
+            "worker TEXT, expires REAL, attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS blocks_state ON blocks (state, start)")
+    def init_blocks(self, start, end, block_size=1000):
+        """
+        Creates blocks for [start, end), existing blocks are kept as is
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO blocks (start, end) VALUES (?, ?)",
+                ((i, min(i + block_size, end)) for i in range(start, end, block_size)),
+            )
+            self.connection.execute("COMMIT")
+    def acquire(self, worker):
+        """
+        Leases the lowest pending or expired block to worker
+        Returns (start, end) or None if all blocks are done or leased
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    "SELECT start, end FROM blocks WHERE state = 'pending' OR (state = 'leased' AND expires < ?) ORDER BY start LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE blocks SET state = 'leased', worker = ?, expires = ?, attempts = attempts + 1 WHERE start = ?",
+                        (worker, now + self.lease_time, row[0]),
+                    )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return row
+    def renew(self, worker, start):
+        """
+        Extends the lease, returns False if block is no longer leased by worker
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE blocks SET expires = ? WHERE start = ? AND worker = ? AND state = 'leased'",
+                (time.time() + self.lease_time, start, worker),
+            )
+        return cursor.rowcount == 1
+    def complete(self, worker, start):
+        """
+        Marks block as done, returns False if block is no longer leased by worker
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE blocks SET state = 'done', expires = NULL WHERE start = ? AND worker = ? AND state = 'leased'",
+                (start, worker),
+            )
+        return cursor.rowcount == 1
+    def release(self, worker, start):
+        """
+        Returns block to pending state, so other workers can take it immediately
+        """
+        with self.lock:
+            self.connection.execute(
+                "UPDATE blocks SET state = 'pending', expires = NULL WHERE start = ? AND worker = ? AND state = 'leased'",
+                (start, worker),
+            )
+    def progress(self):
+        """
+        Returns dict of state -> number of blocks
+        """
+        with self.lock:
+            return dict(self.connection.execute("SELECT state, COUNT(*) FROM blocks GROUP BY state").fetchall())
+    def leases(self, worker):
+        """
+        Yields Lease of next block for worker until all blocks are done
+        The consumer uses each lease as context manager, so the block is released even if the loop is left early
+        """
+        while True:
+            block = self.acquire(worker)
+            if block is None:
+                # blocks leased by other workers may still expire and be reissued
+                if self.progress().get("leased", 0) == 0:
+                    return
+                time.sleep(min(self.lease_time / 3, 30))
+                continue
+            yield Lease(self, worker, *block)
+    def close(self):
+        self.connection.close()
+
+class Lease:
+    """
+    Block leased by worker, the lease is renewed in background while the context is open
+    Leaving the context without complete() returns the block to pending state
+    """
+    def __init__(self, coordinator:LeaseCoordinator, worker, start, end):
+        self.coordinator = coordinator
+        self.worker = worker
+        self.start = start
+        self.end = end
+        self.closed = False
+        self.stop = Event()
+        self.renewer = Thread(target=self._renew, daemon=True)
+    def _renew(self):
+        while not self.stop.wait(self.coordinator.lease_time / 3):
+            if not self.coordinator.renew(self.worker, self.start):
+                return
+    def __enter__(self):
+        self.renewer.start()
+        return self
+    def _stop(self):
+        self.stop.set()
+        if self.renewer.is_alive():
+            self.renewer.join()
+    def complete(self):
+        """
+        Marks block as done, returns False if the lease expired and block was reissued to another worker
+        """
+        self._stop()
+        self.closed = True
+        return self.coordinator.complete(self.worker, self.start)
+    def __exit__(self, *exc_info):
+        self._stop()
+        if not self.closed:
+            self.closed = True
+            self.coordinator.release(self.worker, self.start)
+        return False
@@ -0,0 +1,112 @@
+"""
+Cursor based crawling of danbooru index endpoints
+Pages are requested with page=a{last_id}, which returns the next ids after last_id, so sparse id ranges need no empty requests
+Page size adapts to response time and errors
+"""
+
+import os
+import time
+from threading import Lock
+
+from utils import jsoncodec
+
+class AdaptivePageSize:
+    """
+    Page size shared by crawler threads
+    Starts at maximum, halves on failed request, shrinks when response is slower than target_seconds
+    and grows back by a tenth of maximum on fast responses
+    """
+    def __init__(self, maximum=200, minimum=20, target_seconds=3.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.target_seconds = target_seconds
+        self.size = maximum
+        self.lock = Lock()
+    def get(self):
+        return self.size
+    def success(self, elapsed):
+        with self.lock:
+            if elapsed > self.target_seconds:
+                self.size = max(self.minimum, int(self.size * 0.75))
+            else:
+                self.size = min(self.maximum, self.size + max(1, self.maximum // 10))
+    def failure(self):
+        with self.lock:
+            self.size = max(self.minimum, self.size // 2)
+
+class CursorCheckpoints:
+    """
+    Largest id crawled by cursor mode per segment, persisted to json file after each written page
+    Seen id sets also hold ids of fixed-window runs, whose windows complete out of order and leave holes on failure,
+    so segments resume only from checkpoints written by the cursor itself
+    Checkpoints are keyed by segment bounds, segments of another segment size start from their first id
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = Lock()
+        self.checkpoints = {}
+        if os.path.exists(filepath):
+            with open(filepath, "rb") as f:
+                self.checkpoints = jsoncodec.loads(f.read())
+    def get(self, start_id, end_id):
+        """
+        Returns largest crawled id of segment, or None if segment was not crawled by cursor
+        """
+        return self.checkpoints.get(f"{start_id}_{end_id}")
+    def set(self, start_id, end_id, last_id):
+        with self.lock:
+            self.checkpoints[f"{start_id}_{end_id}"] = last_id
+            # replaced as a whole, so an interrupted save keeps previous checkpoints
+            temp_file = self.filepath + ".tmp"
+            with open(temp_file, "wb") as f:
+                f.write(jsoncodec.dumps(self.checkpoints))
+            os.replace(temp_file, self.filepath)
+
+def split_segments(start_id, end_id, segment_size):
+    """
+    Returns list of [start, end) id segments, each segment is crawled by one cursor
+    """
+    return [(start, min(start + segment_size, end_id)) for start in range(start_id, end_id, segment_size)]
+
+def crawl_segment(fetch, make_url, start_id, end_id, write_page, page_size:AdaptivePageSize, checkpoints:CursorCheckpoints=None, max_retry=10):
+    """
+    Crawls ids in [start_id, end_id) with cursor, starting after checkpoint of segment if given
+    fetch(url) returns list of items or None on failure
+    make_url(last_id, end_id, limit) returns url of the page after last_id
+    write_page(items, first_id, last_id) persists items of one page, items are in [start_id, end_id), returns False if items were not written
+    Segment ends when a page has no items in range, or stops when a page could not be written so the checkpoint stays before it
+    Returns number of requests
+    """
+    last_id = checkpoints.get(start_id, end_id) if checkpoints is not None else None
+    if last_id is None:
+        last_id = start_id - 1
+    requests = 0
+    failures = 0
+    while last_id < end_id - 1:
+        limit = page_size.get()
+        url = make_url(last_id, end_id, limit)
+        start_time = time.time()
+        items = fetch(url)
+        requests += 1
+        if items is None or not isinstance(items, list):
+            page_size.failure()
+            failures += 1
+            if failures > max_retry:
+                print(f"Giving up segment {start_id}..{end_id} after {failures} failures at id {last_id}")
+                break
+            continue
+        failures = 0
+        page_size.success(time.time() - start_time)
+        items = [item for item in items if "id" in item and last_id < item["id"] < end_id]
+        if not items:
+            if checkpoints is not None:
+                checkpoints.set(start_id, end_id, end_id - 1)
+            break
+        ids = [item["id"] for item in items]
+        if write_page(items, min(ids), max(ids)) is False:
+            print(f"Stopping segment {start_id}..{end_id}, page {min(ids)}..{max(ids)} was not written")
+            break
+        last_id = max(ids)
+        if checkpoints is not None:
+            checkpoints.set(start_id, end_id, last_id)
+    return requests
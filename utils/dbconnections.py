@@ -0,0 +1,90 @@
+"""
+Connection management for peewee SqliteDatabase shared by many threads
+Each thread reads through its own read-only connection, writes go through one dedicated writer connection
+"""
+
+import sqlite3
+import pathlib
+import threading
+from contextlib import contextmanager
+from peewee import SqliteDatabase
+
+class ConnectionManager:
+    """
+    Replaces connection factory of database, so every thread opens read-only connection with read pragmas
+    The database file is switched to WAL once, so readers do not block each other or the writer
+    Code which writes has to run inside writer(), which lends the writer connection to the current thread under a lock
+    """
+    def __init__(self, database:SqliteDatabase, mmap_size=1 << 30, cache_size=-8192, busy_timeout=60000):
+        self.database = database
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.busy_timeout = busy_timeout
+        self.write_lock = threading.RLock()
+        self.writer_connection = None
+        self.uri = pathlib.Path(database.database).resolve().as_uri() + "?mode=ro"
+    @staticmethod
+    def supports(database):
+        """
+        Returns True if database is file based sqlite database
+        """
+        return isinstance(database, SqliteDatabase) and database.database not in (None, "", ":memory:") and not str(database.database).startswith("file:")
+    def open(self, read_only=True):
+        """
+        Opens connection with pragmas of database and read or write pragmas
+        """
+        database = self.database
+        if read_only:
+            connection = sqlite3.connect(self.uri, uri=True, timeout=database._timeout, isolation_level=None)
+        else:
+            connection = sqlite3.connect(database.database, timeout=database._timeout, isolation_level=None, check_same_thread=False)
+        try:
+            # registers functions and applies pragmas given to database
+            database._add_conn_hooks(connection)
+            connection.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+            connection.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+            connection.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+            if read_only:
+                connection.execute("PRAGMA query_only = 1")
+                connection.execute("PRAGMA temp_store = memory")
+            else:
+                connection.execute("PRAGMA synchronous = normal")
+        except Exception:
+            connection.close()
+            raise
+        return connection
+    def install(self):
+        """
+        Switches database to WAL and read-only connections of threads, returns self
+        Connection already opened by the calling thread is closed, other threads should not be connected yet
+        """
+        self.writer_connection = self.open(read_only=False)
+        self.writer_connection.execute("PRAGMA journal_mode = wal")
+        if not self.database.is_closed():
+            self.database.close()
+        # instance attribute shadows SqliteDatabase._connect, called by peewee for each thread
+        self.database._connect = lambda: self.open(read_only=True)
+        return self
+    @contextmanager
+    def writer(self):
+        """
+        Runs with-block with writer connection as connection of the current thread
+        Writers are serialized, the thread's own read connection is restored afterwards
+        """
+        with self.write_lock:
+            state = self.database._state
+            if state.conn is self.writer_connection:
+                # nested writer block
+                yield self.writer_connection
+                return
+            previous_connection, previous_closed = state.conn, state.closed
+            state.conn, state.closed = self.writer_connection, False
+            try:
+                yield self.writer_connection
+            finally:
+                state.conn, state.closed = previous_connection, previous_closed
+    def close(self):
+        if self.writer_connection is not None:
+            with self.write_lock:
+                self.writer_connection.close()
+                self.writer_connection = None
@@ -0,0 +1,163 @@
+"""
+Directory layout of downloaded post files and index of existing files
+Files are named {post_id}.{ext}, directories are taken from the lowest digits of post id,
+so sequential ids are spread over all directories
+"""
+
+import os
+from array import array
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+class ShardedLayout:
+    """
+    Maps post id to {root}/{id % 100}/{id // 100 % 100}/{id}.{ext} for levels (2, 2)
+    Each level uses the given number of decimal digits, (2, 2) gives 10000 directories with ~700 files each for 7M posts
+    legacy layout is the previous {root}{id % 100} / layout, directory name ends with a space
+    """
+    def __init__(self, root, levels=(2, 2), legacy=False):
+        self.root = root
+        self.levels = tuple(levels)
+        self.legacy = legacy
+        self.created = set()
+        self.lock = Lock()
+    def directory(self, post_id):
+        if self.legacy:
+            return self.root + f"{post_id % 100} /"
+        parts = []
+        for digits in self.levels:
+            parts.append(str(post_id % 10 ** digits).zfill(digits))
+            post_id //= 10 ** digits
+        return os.path.join(self.root, *parts)
+    def path(self, post_id, ext):
+        return os.path.join(self.directory(post_id), f"{post_id}.{ext}")
+    def ensure_directory(self, post_id):
+        """
+        Creates directory of post id, each directory is created at most once per process
+        """
+        directory = self.directory(post_id)
+        if directory in self.created:
+            return directory
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            self.created.add(directory)
+        return directory
+
+def parse_post_filename(name):
+    """
+    Returns (post_id, ext) of {post_id}.{ext}, or None for other files
+    Partial downloads {post_id}.{ext}.part are other files
+    """
+    stem, _, ext = name.partition(".")
+    if not ext or not stem.isdigit() or "." in ext:
+        return None
+    return int(stem), ext
+
+def _scan_directory(directory):
+    """
+    Returns (files, subdirectories) of directory, files are (path, name, size)
+    """
+    files, directories = [], []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append((entry.path, entry.name, entry.stat().st_size))
+    except FileNotFoundError:
+        pass
+    return files, directories
+
+def scan_files(root, workers=16):
+    """
+    Yields (path, name, size) of all files under root
+    Directories are scanned in parallel with os.scandir, level by level
+    """
+    if not os.path.isdir(root):
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = [root]
+        while pending:
+            next_pending = []
+            for files, directories in executor.map(_scan_directory, pending):
+                yield from files
+                next_pending.extend(directories)
+            pending = next_pending
+
+class FileIndex:
+    """
+    Sizes of downloaded post files by post id, built with one scan of the download directory
+    Sizes are kept in array of int64 indexed by post id (-1 if missing) and extensions as one byte code per post,
+    7M posts take ~63MB instead of a dict of file names
+    Paths are not stored, scan with layout only indexes files at layout.path(post_id, ext)
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.sizes = array("q")
+        self.ext_codes = bytearray()
+        self.exts = [None]
+        self.ext_ids = {}
+        self.count = 0
+        # files found at other paths than their layout path, not indexed
+        self.misplaced = 0
+    @classmethod
+    def scan(cls, root, workers=16, layout:ShardedLayout=None):
+        """
+        Returns index of post files under root
+        If layout is given, files of other layouts are counted as misplaced instead of indexed, so they are not treated as downloaded
+        """
+        index = cls()
+        for path, name, size in scan_files(root, workers):
+            parsed = parse_post_filename(name)
+            if parsed is None:
+                continue
+            if layout is not None and os.path.abspath(path) != os.path.abspath(layout.path(*parsed)):
+                index.misplaced += 1
+                continue
+            index.add(parsed[0], parsed[1], size)
+        if index.misplaced:
+            print(f"Warning: {index.misplaced} files under {root} are not at their layout path and are treated as missing, run migrate_downloads.py to move them")
+        return index
+    def __len__(self):
+        return self.count
+    def _grow(self, post_id):
+        if post_id < len(self.sizes):
+            return
+        grow = max(post_id + 1, len(self.sizes) * 3 // 2) - len(self.sizes)
+        self.sizes.extend(array("q", [-1]) * grow)
+        self.ext_codes.extend(bytes(grow))
+    def add(self, post_id, ext, size):
+        with self.lock:
+            if ext not in self.ext_ids:
+                if len(self.exts) >= 256:
+                    raise ValueError(f"Too many file extensions, can't add {ext}")
+                self.ext_ids[ext] = len(self.exts)
+                self.exts.append(ext)
+            self._grow(post_id)
+            if self.sizes[post_id] < 0:
+                self.count += 1
+            self.sizes[post_id] = size
+            self.ext_codes[post_id] = self.ext_ids[ext]
+    def discard(self, post_id):
+        with self.lock:
+            if post_id < len(self.sizes) and self.sizes[post_id] >= 0:
+                self.sizes[post_id] = -1
+                self.ext_codes[post_id] = 0
+                self.count -= 1
+    def get(self, post_id):
+        """
+        Returns (ext, size) of the file of post id, or None if it was not found
+        """
+        if post_id >= len(self.sizes) or self.sizes[post_id] < 0:
+            return None
+        return self.exts[self.ext_codes[post_id]], self.sizes[post_id]
+    def get_size(self, post_id, ext):
+        """
+        Returns size of {post_id}.{ext}, or None if it was not found
+        """
+        if post_id >= len(self.sizes) or self.sizes[post_id] < 0:
+            return None
+        if self.exts[self.ext_codes[post_id]] != ext:
+            return None
+        return self.sizes[post_id]
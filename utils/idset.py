@@ -0,0 +1,229 @@
+import os
+import mmap
+import tempfile
+from contextlib import contextmanager
+from utils import jsoncodec
+from threading import Lock
+try:
+    import fcntl
+except ImportError:
+    # no cross-process lock on Windows, bitmap files must not be shared by processes there
+    fcntl = None
+
+class BitmapIdSet:
+    """
+    Set of non-negative integer ids, stored as one bit per id
+    If path is given, the bitmap is persisted to the file through mmap, otherwise it is kept in memory
+    Processes sharing a bitmap file see each other's ids through the mapping, updates and growth take an flock on the file,
+    len() only counts ids present on open and added by this process
+    7M ids take less than 1MB
+    """
+    def __init__(self, path=None, capacity=1 << 23):
+        self.path = path
+        self.lock = Lock()
+        self._file = None
+        self._buffer = None
+        self._size = 0
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(path, "a+b")
+        with self._locked():
+            self._open(max(capacity, 8) // 8)
+        self._count = self.count_range(0, self._size * 8)
+    @contextmanager
+    def _locked(self):
+        """
+        Holds thread lock and, for bitmap files, an exclusive flock so byte updates of other processes are not lost
+        """
+        with self.lock:
+            if self._file is None or fcntl is None:
+                yield
+                return
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+    def _open(self, size):
+        """
+        Opens or grows the backing buffer to at least size bytes, called with _locked held
+        File is only grown, never truncated below the size another process has grown it to
+        """
+        if size <= self._size:
+            return
+        if self.path is None:
+            buffer = bytearray(size)
+            if self._buffer is not None:
+                buffer[:self._size] = self._buffer
+        else:
+            self._file.seek(0, os.SEEK_END)
+            size = max(size, self._file.tell())
+            self._file.truncate(size)
+            buffer = mmap.mmap(self._file.fileno(), size)
+        previous = self._buffer
+        self._buffer = buffer
+        self._size = size
+        # lock-free readers holding the previous mmap retry with the new one
+        if isinstance(previous, mmap.mmap):
+            previous.close()
+    def __contains__(self, idx):
+        if idx < 0:
+            return False
+        try:
+            return self._test(self._buffer, idx)
+        except ValueError:
+            # buffer was grown and closed while reading
+            with self.lock:
+                return self._test(self._buffer, idx)
+    @staticmethod
+    def _test(buffer, idx):
+        byte = idx >> 3
+        if byte >= len(buffer):
+            return False
+        return bool(buffer[byte] & (1 << (idx & 7)))
+    def __len__(self):
+        return self._count
+    def __iter__(self):
+        with self.lock:
+            buffer = bytes(self._buffer)
+        for byte_idx in range(len(buffer)):
+            value = buffer[byte_idx]
+            if not value:
+                continue
+            for bit in range(8):
+                if value & (1 << bit):
+                    yield byte_idx * 8 + bit
+    def add(self, idx):
+        """
+        Adds the id, returns True if it was not in the set
+        """
+        if idx < 0:
+            raise ValueError(f"id must be non-negative but got {idx}")
+        byte, mask = idx >> 3, 1 << (idx & 7)
+        with self._locked():
+            if byte >= self._size:
+                self._open(max(byte + 1, self._size * 2))
+            if self._buffer[byte] & mask:
+                return False
+            self._buffer[byte] |= mask
+            self._count += 1
+            return True
+    def update(self, ids):
+        """
+        Adds all ids
+        """
+        for idx in ids:
+            self.add(idx)
+    def discard(self, idx):
+        """
+        Removes the id if it exists
+        """
+        if idx not in self:
+            return
+        byte, mask = idx >> 3, 1 << (idx & 7)
+        with self._locked():
+            if self._buffer[byte] & mask:
+                self._buffer[byte] &= ~mask & 0xFF
+                self._count -= 1
+    def count_range(self, start, end):
+        """
+        Returns the number of ids in [start, end)
+        """
+        start = max(start, 0)
+        with self.lock:
+            end = min(end, len(self._buffer) * 8)
+            if end <= start:
+                return 0
+            chunk = int.from_bytes(self._buffer[start >> 3:(end + 7) >> 3], "little")
+        chunk >>= start & 7
+        chunk &= (1 << (end - start)) - 1
+        return chunk.bit_count()
+    def flush(self):
+        """
+        Flushes the bitmap to the file
+        """
+        if self.path is not None:
+            with self.lock:
+                self._buffer.flush()
+    def close(self):
+        if self.path is not None and self._file is not None:
+            self._buffer.flush()
+            self._buffer.close()
+            self._file.close()
+            self._file = None
+
+def add_jsonl_ids(ids:BitmapIdSet, jsonl_path, offset=0, key="id"):
+    """
+    Adds ids of complete lines of jsonl file from offset, returns offset after the last complete line
+    """
+    with open(jsonl_path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            try:
+                ids.add(jsoncodec.loads(line)[key])
+            except Exception as e:
+                continue
+    return offset
+
+def write_atomic(path, data:bytes):
+    """
+    Replaces file with data through a temporary file of this process
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+def migrate_jsonl(jsonl_path, bitmap_path, key="id"):
+    """
+    Returns bitmap id set of bitmap_path with the ids of a jsonl file added
+    On first run the bitmap is built in a temporary file of this process and linked into place,
+    so processes migrating at the same time do not overwrite each other, the first link wins
+    The jsonl file stays the record of older versions, lines appended to it later are added on the next call,
+    read offset is kept in {bitmap_path}.offset and ids are only added, so reading a line twice is harmless
+    """
+    offset_path = bitmap_path + ".offset"
+    if not os.path.exists(bitmap_path) and os.path.isfile(jsonl_path):
+        directory = os.path.dirname(bitmap_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        # write to temporary file first, interrupted migration should not leave partial bitmap
+        fd, temp_path = tempfile.mkstemp(dir=directory or ".", prefix=os.path.basename(bitmap_path) + ".", suffix=".tmp")
+        os.close(fd)
+        try:
+            ids = BitmapIdSet(temp_path)
+            offset = add_jsonl_ids(ids, jsonl_path, 0, key)
+            count = len(ids)
+            ids.close()
+            try:
+                os.link(temp_path, bitmap_path)
+            except FileExistsError:
+                pass
+            else:
+                write_atomic(offset_path, str(offset).encode())
+                print(f"Migrated {count} ids from {jsonl_path} to {bitmap_path}")
+        finally:
+            os.remove(temp_path)
+    ids = BitmapIdSet(bitmap_path)
+    if os.path.isfile(jsonl_path):
+        try:
+            with open(offset_path, "rb") as f:
+                offset = int(f.read())
+        except (FileNotFoundError, ValueError):
+            offset = 0
+        if os.path.getsize(jsonl_path) > offset:
+            added = len(ids)
+            offset = add_jsonl_ids(ids, jsonl_path, offset, key)
+            write_atomic(offset_path, str(offset).encode())
+            if len(ids) > added:
+                print(f"Added {len(ids) - added} ids appended to {jsonl_path} to {bitmap_path}")
+    return ids
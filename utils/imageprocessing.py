@@ -0,0 +1,180 @@
+"""
+Post-processing of downloaded images in a process pool
+Each downloaded file is decode-checked while it is still in page cache and resized or transcoded variants are written
+Corrupt files are removed and their posts requeued for download, files whose variants could not be written are kept and written to backlog
+Requires Pillow, which is imported only when post-processing is used
+"""
+
+import os
+from functools import partial
+from threading import Lock, BoundedSemaphore
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from utils import jsoncodec
+from utils.appender import get_appender
+from utils.filelayout import ShardedLayout
+from utils.metrics import registry
+
+processed_images = registry.counter("postprocess_images_total", "Post-processed images by result")
+
+# Pillow format names of variant extensions
+FORMATS = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "webp": "WEBP"}
+# image modes each format can save, other modes are converted to RGB or RGBA
+SAVE_MODES = {"JPEG": ("RGB", "L"), "PNG": ("1", "L", "LA", "I", "P", "RGB", "RGBA"), "WEBP": ("RGB", "RGBA")}
+
+def parse_variant(text):
+    """
+    Parses "512:webp" to (512, "webp"), max side 0 keeps original size and only transcodes
+    """
+    max_side, _, ext = text.partition(":")
+    ext = ext.lower() or "webp"
+    if ext not in FORMATS:
+        raise ValueError(f"Unknown variant format {ext}, expected one of {list(FORMATS)}")
+    return int(max_side), ext
+
+def convert_for_format(image, image_format):
+    """
+    Returns image in a mode image_format can save, alpha is kept if the format supports it
+    """
+    if image.mode in SAVE_MODES[image_format]:
+        return image
+    has_alpha = "A" in image.mode or "transparency" in image.info
+    return image.convert("RGBA" if has_alpha and "RGBA" in SAVE_MODES[image_format] else "RGB")
+
+def process_image(path, targets, quality=90):
+    """
+    Decode-checks image at path and writes variants, runs in worker process
+    targets is list of (max_side, ext, target_path)
+    Returns (result, error), result is "ok", "corrupt" if the file failed decoding, or "variant_error" if a variant could not be written
+    """
+    from PIL import Image
+    # downloads are trusted, large images are not decompression bombs
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        # verify checks structure without decoding, load decodes all pixel data
+        with Image.open(path) as image:
+            image.verify()
+        image = Image.open(path)
+        image.load()
+    except Exception as e:
+        return "corrupt", f"{type(e).__name__}: {e}"
+    with image:
+        for max_side, ext, target in targets:
+            temp_path = target + ".tmp"
+            try:
+                variant = image
+                if max_side and max(image.size) > max_side:
+                    variant = image.copy()
+                    variant.thumbnail((max_side, max_side), Image.LANCZOS)
+                variant = convert_for_format(variant, FORMATS[ext])
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                variant.save(temp_path, format=FORMATS[ext], quality=quality)
+                os.replace(temp_path, target)
+            except Exception as e:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return "variant_error", f"{type(e).__name__}: {e}"
+    return "ok", None
+
+class ImagePostProcessor:
+    """
+    Runs process_image for downloaded files in a process pool
+    At most max_pending images are queued, submit waits up to max_wait seconds for a slot,
+    then the file is written to backlog_file instead so download threads are not blocked by slow processing
+    Workers default to cpu count - 1, leaving one core for download threads
+    requeue(post_dict) is called for corrupt files, at most max_requeue times per post
+    Files whose variants could not be written are not corrupt, they are kept and written to backlog_file
+    """
+    def __init__(self, output_root, variants=((512, "webp"),), levels=(2, 2), workers=None, max_pending=None, max_wait=1.0,
+                 quality=90, requeue=None, max_requeue=2, index=None, backlog_file="postprocess_backlog.jsonl"):
+        try:
+            import PIL
+        except ImportError:
+            raise ImportError("Pillow is required for image post-processing, install it with pip install pillow")
+        workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.slots = BoundedSemaphore(max_pending or workers * 4)
+        self.max_wait = max_wait
+        self.quality = quality
+        self.requeue = requeue
+        self.max_requeue = max_requeue
+        self.index = index
+        self.backlog = get_appender(backlog_file)
+        self.attempts = {}
+        self.pending = set()
+        self.lock = Lock()
+        self.layouts = [
+            (max_side, ext, ShardedLayout(os.path.join(output_root, f"{max_side or 'full'}_{ext}"), levels))
+            for max_side, ext in variants
+        ]
+    def targets(self, post_id):
+        return [(max_side, ext, layout.path(post_id, ext)) for max_side, ext, layout in self.layouts]
+    def submit(self, post_dict, path):
+        """
+        Queues downloaded file of post for processing, returns future or None if the file was written to backlog
+        """
+        if not self.slots.acquire(timeout=self.max_wait):
+            self.backlog.append(jsoncodec.dumps_line({"id": post_dict["id"], "path": path}))
+            processed_images.inc(result="deferred")
+            return None
+        try:
+            future = self.executor.submit(process_image, path, self.targets(post_dict["id"]), self.quality)
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(partial(self._done, post_dict, path))
+        return future
+    def _done(self, post_dict, path, future):
+        self.slots.release()
+        try:
+            self._handle_result(post_dict, path, future)
+        finally:
+            # removed after requeue, so join() returns only when requeued posts are visible
+            with self.lock:
+                self.pending.discard(future)
+    def _handle_result(self, post_dict, path, future):
+        post_id = post_dict["id"]
+        try:
+            result, error = future.result()
+        except Exception as e:
+            # worker crashed, the file itself is not known to be corrupt
+            print(f"Exception: {e} when post-processing {post_id}")
+            self.backlog.append(jsoncodec.dumps_line({"id": post_id, "path": path}))
+            processed_images.inc(result="error")
+            return
+        if result == "ok":
+            processed_images.inc(result="ok")
+            return
+        if result == "variant_error":
+            # disk or format problem of the variant, the downloaded file is kept for a later run
+            print(f"Error: {post_id} variant could not be written, {error}")
+            self.backlog.append(jsoncodec.dumps_line({"id": post_id, "path": path}))
+            processed_images.inc(result="variant_error")
+            return
+        print(f"Error: {post_id} image is corrupt, {error}")
+        if os.path.exists(path):
+            os.remove(path)
+        if self.index is not None:
+            self.index.discard(post_id)
+        with self.lock:
+            attempts = self.attempts[post_id] = self.attempts.get(post_id, 0) + 1
+        if self.requeue is not None and attempts <= self.max_requeue:
+            processed_images.inc(result="requeued")
+            self.requeue(post_dict)
+        else:
+            processed_images.inc(result="corrupt")
+    def join(self):
+        """
+        Waits until all queued images are processed
+        """
+        while True:
+            with self.lock:
+                pending = list(self.pending)
+            if not pending:
+                return
+            wait(pending)
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        self.backlog.flush()
@@ -0,0 +1,84 @@
+"""
+JSON codec for jsonl caches and crawled posts
+Uses orjson if installed, otherwise stdlib json
+Decoders accept str or bytes, encoders return bytes, so files can be read and written in binary mode
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+# orjson.JSONDecodeError is subclass of json.JSONDecodeError
+JSONDecodeError = json.JSONDecodeError
+
+if orjson is not None:
+    DUMPS_OPTIONS = orjson.OPT_NON_STR_KEYS
+    def loads(data):
+        return orjson.loads(data)
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=DUMPS_OPTIONS)
+    def dumps_line(obj) -> bytes:
+        return orjson.dumps(obj, option=DUMPS_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+    def dumps_str(obj) -> str:
+        return orjson.dumps(obj, option=DUMPS_OPTIONS).decode("utf-8")
+else:
+    def loads(data):
+        return json.loads(data)
+    def dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+    def dumps_line(obj) -> bytes:
+        return (json.dumps(obj) + "\n").encode("utf-8")
+    def dumps_str(obj) -> str:
+        return json.dumps(obj)
+
+def decode_lines(lines, skip_errors=True):
+    """
+    Decodes list of jsonl lines (bytes), empty lines are skipped
+    With stdlib json, lines are joined into one json array so the parser is called once per batch
+    orjson is faster per line than on joined copy, so lines are decoded one by one
+    Malformed lines are skipped unless skip_errors is False
+    """
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return []
+    if orjson is None:
+        try:
+            result = loads(b"[" + b",".join(lines) + b"]")
+            # a malformed line can still join into valid array, e.g. '1,2'
+            if len(result) == len(lines):
+                return result
+        except JSONDecodeError:
+            pass
+    result = []
+    for line in lines:
+        try:
+            result.append(loads(line))
+        except JSONDecodeError:
+            if not skip_errors:
+                raise
+    return result
+
+def read_jsonl(filepath, batch_size=10000, skip_errors=True):
+    """
+    Yields lists of decoded objects from jsonl file, up to batch_size objects per list
+    """
+    with open(filepath, "rb") as f:
+        batch = []
+        for line in f:
+            batch.append(line)
+            if len(batch) >= batch_size:
+                yield decode_lines(batch, skip_errors)
+                batch = []
+        if batch:
+            yield decode_lines(batch, skip_errors)
+
+def iter_jsonl(filepath, batch_size=10000, skip_errors=True):
+    """
+    Yields decoded objects from jsonl file, decoded in batches
+    """
+    for batch in read_jsonl(filepath, batch_size, skip_errors):
+        yield from batch
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in key) + "}"
+
+class Counter:
+    """
+    Monotonic counter per label set
+    """
+    kind = "counter"
+    def __init__(self, name, description=""):
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self.values = {}
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    def get(self, **labels):
+        return self.values.get(label_key(labels), 0)
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+class Gauge(Counter):
+    """
+    Value which can go up and down per label set
+    """
+    kind = "gauge"
+    def set(self, value, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram:
+    """
+    Cumulative histogram per label set, with sum and count
+    """
+    kind = "histogram"
+    def __init__(self, name, description="", buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][idx] += 1
+            state[1] += value
+            state[2] += 1
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    samples.append((self.name + "_bucket", key + (("le", bound),), cumulative))
+                samples.append((self.name + "_sum", key, total))
+                samples.append((self.name + "_count", key, count))
+        return samples
+
+class MetricsRegistry:
+    """
+    Holds named metrics, metrics with same name are shared
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+    def _get(self, cls, name, description, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, description, **kwargs)
+            assert isinstance(metric, cls), f"Metric {name} already registered as {metric.kind}"
+            return metric
+    def counter(self, name, description="") -> Counter:
+        return self._get(Counter, name, description)
+    def gauge(self, name, description="") -> Gauge:
+        return self._get(Gauge, name, description)
+    def histogram(self, name, description="", buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, description, buckets=buckets)
+    def to_prometheus(self):
+        """
+        Returns metrics in prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+    def to_dict(self):
+        """
+        Returns metrics as dict of name -> list of {labels, value}
+        """
+        result = {}
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            for name, key, value in metric.samples():
+                result.setdefault(name, []).append({"labels": {label: str(label_value) for label, label_value in key}, "value": value})
+        return result
+
+registry = MetricsRegistry()
+
+class MetricsExporter(threading.Thread):
+    """
+    Periodically rewrites metrics file, format is json if path ends with .json, prometheus text otherwise
+    File is replaced atomically so readers never see partial content
+    Json output also contains per-second rates of counters since previous export
+    """
+    def __init__(self, path, interval=10, metrics_registry:MetricsRegistry=None):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.registry = metrics_registry if metrics_registry is not None else registry
+        self.stop_event = threading.Event()
+        self.previous = None
+    def export(self):
+        if self.path.endswith(".json"):
+            now = time.time()
+            metrics = self.registry.to_dict()
+            with self.registry.lock:
+                counter_metrics = [metric for metric in self.registry.metrics.values() if metric.kind == "counter"]
+            counters = {(name, key): value for metric in counter_metrics for name, key, value in metric.samples()}
+            rates = {}
+            if self.previous is not None:
+                previous_time, previous_counters = self.previous
+                elapsed = max(now - previous_time, 1e-9)
+                for (name, key), value in counters.items():
+                    rate = (value - previous_counters.get((name, key), 0)) / elapsed
+                    rates.setdefault(name, []).append({"labels": {label: str(label_value) for label, label_value in key}, "value": rate})
+            self.previous = (now, counters)
+            content = json.dumps({"time": now, "metrics": metrics, "rates": rates})
+        else:
+            content = self.registry.to_prometheus()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(content)
+        os.replace(temp_path, self.path)
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.export()
+            except Exception as e:
+                print(f"Exception: {e} while exporting metrics")
+    def stop(self):
+        self.stop_event.set()
+        self.export()
+
+def start_exporter(path, interval=10):
+    """
+    Starts background exporter of default registry, returns the exporter thread
+    """
+    exporter = MetricsExporter(path, interval=interval)
+    exporter.start()
+    return exporter
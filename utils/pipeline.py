@@ -0,0 +1,77 @@
+"""
+Staged pipeline with bounded queues between stages
+Each stage has its own worker threads, so network bound and disk bound stages run at the same time
+"""
+
+import logging
+import threading
+from queue import Queue
+from utils.metrics import registry
+
+STOP = object()
+queue_size_gauge = registry.gauge("pipeline_queue_size", "Items waiting in front of pipeline stage")
+stage_items = registry.counter("pipeline_items_total", "Items processed by pipeline stage and result")
+
+class Pipeline:
+    """
+    Runs items through stages, stages is list of (name, function, workers)
+    function takes item of previous stage and returns item for next stage, None drops the item
+    Return value of the last stage is discarded
+    Queues hold at most queue_size items, so fast stages run ahead of slow ones only up to queue_size items
+    Exceptions of stage functions are logged and the item is dropped, functions should handle retries themselves
+    """
+    def __init__(self, stages, queue_size=8):
+        self.stages = stages
+        self.queues = [Queue(maxsize=queue_size) for _ in stages]
+        self.lock = threading.Lock()
+        self.running = [workers for _, _, workers in stages]
+        self.threads = []
+    def worker(self, index):
+        name, function, _ = self.stages[index]
+        source = self.queues[index]
+        target = self.queues[index + 1] if index + 1 < len(self.queues) else None
+        while True:
+            item = source.get()
+            queue_size_gauge.set(source.qsize(), stage=name)
+            if item is STOP:
+                break
+            try:
+                result = function(item)
+            except Exception as e:
+                logging.exception(f"Error in pipeline stage {name}: {e}")
+                stage_items.inc(stage=name, result="error")
+                continue
+            stage_items.inc(stage=name, result="ok")
+            if target is not None and result is not None:
+                target.put(result)
+        with self.lock:
+            self.running[index] -= 1
+            last = self.running[index] == 0
+        # last worker of stage stops the next stage
+        if last and target is not None:
+            for _ in range(self.stages[index + 1][2]):
+                target.put(STOP)
+    def start(self):
+        for index, (name, _, workers) in enumerate(self.stages):
+            for number in range(workers):
+                thread = threading.Thread(target=self.worker, args=(index,), name=f"{name}-{number}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+    def put(self, item):
+        """
+        Feeds item to the first stage, blocks while the first queue is full
+        """
+        self.queues[0].put(item)
+    def close(self):
+        """
+        Waits until all fed items passed all stages
+        """
+        for _ in range(self.stages[0][2]):
+            self.queues[0].put(STOP)
+        for thread in self.threads:
+            thread.join()
+    def run(self, items):
+        self.start()
+        for item in items:
+            self.put(item)
+        self.close()
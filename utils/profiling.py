@@ -0,0 +1,146 @@
+import time
+import atexit
+import cProfile
+import threading
+from contextlib import nullcontext
+
+NULL_CONTEXT = nullcontext()
+
+class StageTimer:
+    """
+    Adds elapsed wall time of with-block to thread-local stats of stage
+    """
+    __slots__ = ("stats", "start_time")
+    def __init__(self, stats):
+        self.stats = stats
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+    def __exit__(self, *exc):
+        self.stats[0] += time.perf_counter() - self.start_time
+        self.stats[1] += 1
+        return False
+
+class TaskProfile:
+    """
+    Runs cProfile of the thread while with-block runs
+    """
+    def __init__(self, profile:cProfile.Profile, local):
+        self.profile = profile
+        self.local = local
+    def __enter__(self):
+        self.local.in_task = True
+        self.profile.enable()
+        return self
+    def __exit__(self, *exc):
+        self.profile.disable()
+        self.local.in_task = False
+        return False
+
+class StageProfiler:
+    """
+    Collects cumulative wall time and call counts per stage, per thread without locking
+    Disabled profiler returns no-op context, so instrumented code costs one attribute check
+    Optionally runs cProfile for every Nth task of each thread, dumped per thread at exit
+    """
+    def __init__(self):
+        self.enabled = False
+        self.sample_every = 0
+        self.dump_prefix = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.thread_stats = []
+        self.thread_profiles = []
+        self.start_time = time.perf_counter()
+    def enable(self, sample_every=0, dump_prefix=None, report_at_exit=True):
+        """
+        Enables stage timers, cProfile is sampled if sample_every > 0 and dump_prefix is given
+        """
+        self.enabled = True
+        self.sample_every = sample_every
+        self.dump_prefix = dump_prefix
+        self.start_time = time.perf_counter()
+        if report_at_exit:
+            atexit.register(self.finish)
+    def _stats(self):
+        stats = getattr(self.local, "stats", None)
+        if stats is None:
+            stats = self.local.stats = {}
+            with self.lock:
+                self.thread_stats.append(stats)
+        return stats
+    def stage(self, name):
+        """
+        Returns context which times the with-block as stage
+        """
+        if not self.enabled:
+            return NULL_CONTEXT
+        stats = self._stats()
+        stage_stats = stats.get(name)
+        if stage_stats is None:
+            stage_stats = stats[name] = [0.0, 0]
+        return StageTimer(stage_stats)
+    def task(self):
+        """
+        Returns context for one unit of work, every sample_every-th task of the thread is run under cProfile
+        """
+        if not self.enabled or not self.sample_every or self.dump_prefix is None:
+            return NULL_CONTEXT
+        local = self.local
+        # nested tasks are already covered by outer task
+        if getattr(local, "in_task", False):
+            return NULL_CONTEXT
+        count = getattr(local, "task_count", 0)
+        local.task_count = count + 1
+        if count % self.sample_every != 0:
+            return NULL_CONTEXT
+        profile = getattr(local, "profile", None)
+        if profile is None:
+            profile = local.profile = cProfile.Profile()
+            with self.lock:
+                self.thread_profiles.append((threading.current_thread().name, profile))
+        return TaskProfile(profile, local)
+    def summary(self):
+        """
+        Returns dict of stage -> (total seconds, calls), summed over threads
+        """
+        result = {}
+        with self.lock:
+            thread_stats = list(self.thread_stats)
+        for stats in thread_stats:
+            for name, (total, calls) in list(stats.items()):
+                previous = result.get(name, (0.0, 0))
+                result[name] = (previous[0] + total, previous[1] + calls)
+        return result
+    def report(self):
+        """
+        Returns breakdown table, stage times are summed over threads and nested stages are included in outer stages
+        """
+        wall = time.perf_counter() - self.start_time
+        summary = self.summary()
+        lines = [f"Profile: {wall:.1f}s wall time, {len(self.thread_stats)} threads"]
+        lines.append(f"{'stage':<24}{'calls':>12}{'total (s)':>14}{'mean (ms)':>12}{'per wall':>10}")
+        for name, (total, calls) in sorted(summary.items(), key=lambda item: -item[1][0]):
+            lines.append(f"{name:<24}{calls:>12}{total:>14.2f}{total / max(calls, 1) * 1000:>12.3f}{total / max(wall, 1e-9):>10.2f}")
+        return "\n".join(lines)
+    def dump_profiles(self):
+        """
+        Writes sampled cProfile stats per thread, returns list of written files
+        """
+        files = []
+        with self.lock:
+            thread_profiles = list(self.thread_profiles)
+        for thread_name, profile in thread_profiles:
+            filepath = f"{self.dump_prefix}_{thread_name}.prof"
+            profile.dump_stats(filepath)
+            files.append(filepath)
+        return files
+    def finish(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        print(self.report())
+        if self.dump_prefix is not None and self.thread_profiles:
+            print(f"Wrote {len(self.dump_profiles())} cProfile dumps with prefix {self.dump_prefix}")
+
+profiler = StageProfiler()
@@ -1,15 +1,22 @@
 
-import json
+from utils import jsoncodec
 import time
 import requests
 # url encode
 import urllib.parse
+from utils.metrics import registry
+
+request_latency = registry.histogram("proxy_request_seconds", "Latency of requests to proxy by proxy and endpoint")
+request_count = registry.counter("proxy_requests_total", "Requests to proxy by proxy, endpoint and status")
+response_bytes = registry.counter("proxy_response_bytes_total", "Bytes received from proxy by proxy and endpoint")
 class ProxyHandler:
     """
     Sends request to http://{ip}:{port}/get_response_raw?url={url} with auth 
     """
-    def __init__(self, proxy_list_file,proxy_auth="user:pass",port=80, wait_time=0.1,timeouts=10):
+    def __init__(self, proxy_list_file,proxy_auth="user:pass",port=80, wait_time=0.1,timeouts=10, raw=False):
         self.proxy_auth = proxy_auth
+        # raw mode fetches upstream body from get_response_raw, which is decoded once instead of envelope + inner string
+        self.raw = raw
         self.port = port
         self.proxy_list = []
         self.commit_time = {}
@@ -38,20 +45,40 @@ class ProxyHandler:
         while time.time() < self.commit_time[proxy_index] + self.wait_time:
             time.sleep(0.01)
         self.commit_time[proxy_index] = time.time()
+    def request(self, endpoint, query):
+        """
+        Sends request to current proxy endpoint and records latency, status and bytes
+        """
+        proxy = self.proxy_list[self.proxy_index]
+        start_time = time.time()
+        try:
+            response = requests.get(proxy + f"{endpoint}?{query}", timeout=self.timeouts, auth=tuple(self.proxy_auth.split(":")))
+        except Exception as e:
+            request_count.inc(proxy=proxy, endpoint=endpoint, status=type(e).__name__)
+            raise
+        finally:
+            request_latency.observe(time.time() - start_time, proxy=proxy, endpoint=endpoint)
+        request_count.inc(proxy=proxy, endpoint=endpoint, status=response.status_code)
+        response_bytes.inc(len(response.content), proxy=proxy, endpoint=endpoint)
+        return response
     def get_response(self, url):
         """
         Returns the response of the url
         """
+        if self.raw:
+            result = self.get_response_bytes(url)
+            return result[0] if result is not None else None
         url = urllib.parse.quote(url, safe='')
         try:
             self.proxy_index = (self.proxy_index + 1) % len(self.proxy_list)
             self.wait_until_commit()
-            response = requests.get(self.proxy_list[self.proxy_index] + f"get_response?url={url}", timeout=self.timeouts, auth=tuple(self.proxy_auth.split(":")))
+            response = self.request("get_response", f"url={url}")
             if response.status_code == 200:
-                json_response = response.json()
+                json_response = jsoncodec.loads(response.content)
                 if json_response["success"]:
-                    return json.loads(json_response["response"])
+                    return jsoncodec.loads(json_response["response"])
                 else:
+                    request_count.inc(proxy=self.proxy_list[self.proxy_index], endpoint="get_response", status="failed")
                     print(f"Failed in proxy side: {json_response['response']}")
                     return None
             else:
@@ -60,6 +87,29 @@ class ProxyHandler:
         except Exception as e:
             print(f"Error while processing response from proxy: {e}")
             return None
+    def get_response_bytes(self, url):
+        """
+        Returns (decoded response, original body bytes) of the url from get_response_raw
+        Success is signalled by status 200, proxy can also set X-Proxy-Success: false with error in body
+        Body bytes can be stored as is, without encoding decoded response again
+        """
+        quoted_url = urllib.parse.quote(url, safe='')
+        try:
+            self.proxy_index = (self.proxy_index + 1) % len(self.proxy_list)
+            self.wait_until_commit()
+            response = self.request("get_response_raw", f"url={quoted_url}")
+            if response.status_code != 200:
+                print(f"Failed in proxy side: {response.status_code}")
+                return None
+            if response.headers.get("X-Proxy-Success", "true").lower() == "false":
+                request_count.inc(proxy=self.proxy_list[self.proxy_index], endpoint="get_response_raw", status="failed")
+                print(f"Failed in proxy side: {response.text}")
+                return None
+            body = response.content
+            return jsoncodec.loads(body), body
+        except Exception as e:
+            print(f"Error while processing response from proxy: {e}")
+            return None
     def get(self, url):
         """
         Returns the response of the url
@@ -68,7 +118,7 @@ class ProxyHandler:
         try:
             self.proxy_index = (self.proxy_index + 1) % len(self.proxy_list)
             self.wait_until_commit()
-            response = requests.get(self.proxy_list[self.proxy_index] + f"get_response_raw?url={url}", timeout=self.timeouts, auth=tuple(self.proxy_auth.split(":")))
+            response = self.request("get_response_raw", f"url={url}")
             if response.status_code == 200:
                 return response
             else:
@@ -85,7 +135,7 @@ class ProxyHandler:
         try:
             self.proxy_index = (self.proxy_index + 1) % len(self.proxy_list)
             self.wait_until_commit()
-            response = requests.get(self.proxy_list[self.proxy_index] + f"file_size?url={url}", timeout=self.timeouts, auth=tuple(self.proxy_auth.split(":")))
+            response = self.request("file_size", f"url={url}")
             if response.status_code == 200:
                 return int(response.text)
             else:
@@ -102,7 +152,7 @@ class ProxyHandler:
         try:
             self.proxy_index = (self.proxy_index + 1) % len(self.proxy_list)
             self.wait_until_commit()
-            response = requests.get(self.proxy_list[self.proxy_index] + f"filepart?url={url}&start={start}&end={end}", timeout=self.timeouts, auth=tuple(self.proxy_auth.split(":")))
+            response = self.request("filepart", f"url={url}&start={start}&end={end}")
             if response.status_code == 200:
                 return response
             else:
@@ -0,0 +1,100 @@
+"""
+Compact records of post differences kept in memory by sanity_check.DifferenceCache
+Differences are (new_dict, old_dict) pairs in jsonl caches, as records they use __slots__ and tag lists are packed in array('i') of vocabulary indices
+Unchanged posts share one record, so the common case costs only the cache entry
+"""
+
+from array import array
+
+from utils.tagdiff import TagVocabulary
+
+TAG_LIST_KEYS = ("tag_list_general", "tag_list_character", "tag_list_artist", "tag_list_meta", "tag_list_copyright")
+TAG_LIST_INDEX = {key: idx for idx, key in enumerate(TAG_LIST_KEYS)}
+
+# tuples of changed value keys are shared by all records with the same keys
+VALUE_KEY_TUPLES = {}
+
+class PostDifference:
+    """
+    Difference of one post
+    value_keys and values hold changed fields with their database value, or are None if no value changed
+    tags holds changed tag lists packed in one array('i') as [key index, added count, removed count, added..., removed...] per tag list,
+    or is None if no tag list changed
+    Tags are encoded with vocabulary, so records are only valid in the process which created them
+    """
+    __slots__ = ("value_keys", "values", "tags")
+    def __init__(self, value_keys=None, values=None, tags=None):
+        self.value_keys = value_keys
+        self.values = values
+        self.tags = tags
+    @classmethod
+    def from_difference(cls, difference, vocabulary:TagVocabulary):
+        """
+        Returns record of (new_dict, old_dict), or None if difference has other shape
+        Missing posts, (None, danbooru_info), and unknown keys are not compacted
+        """
+        if difference is None or len(difference) != 2 or difference[0] is None:
+            return None
+        new_dict, old_dict = difference
+        if not new_dict and not old_dict:
+            return UNCHANGED
+        value_keys, values, tags = [], [], None
+        tag_lists = 0
+        for key, value in new_dict.items():
+            idx = TAG_LIST_INDEX.get(key)
+            if idx is None:
+                if "tag_list" in key:
+                    return None
+                value_keys.append(key)
+                values.append(value)
+                continue
+            removed = old_dict.get(key)
+            if removed is None:
+                return None
+            if tags is None:
+                tags = array("i")
+            tags.extend((idx, len(value), len(removed)))
+            tags.extend([vocabulary.index(tag) for tag in value])
+            tags.extend([vocabulary.index(tag) for tag in removed])
+            tag_lists += 1
+        if len(old_dict) != tag_lists:
+            return None
+        if not value_keys:
+            return cls(None, None, tags)
+        value_keys = tuple(value_keys)
+        return cls(VALUE_KEY_TUPLES.setdefault(value_keys, value_keys), tuple(values), tags)
+    def to_difference(self, vocabulary:TagVocabulary):
+        """
+        Returns (new_dict, old_dict) in same format as compare_info
+        """
+        new_dict = dict(zip(self.value_keys, self.values)) if self.value_keys is not None else {}
+        old_dict = {}
+        if self.tags is not None:
+            names = vocabulary.tags
+            tags = self.tags
+            position = 0
+            while position < len(tags):
+                key, added, removed = TAG_LIST_KEYS[tags[position]], tags[position + 1], tags[position + 2]
+                position += 3
+                new_dict[key] = [names[idx] for idx in tags[position:position + added]]
+                position += added
+                old_dict[key] = [names[idx] for idx in tags[position:position + removed]]
+                position += removed
+        return new_dict, old_dict
+    def is_unchanged(self):
+        return self.value_keys is None and self.tags is None
+
+UNCHANGED = PostDifference()
+
+def compact_difference(difference, vocabulary:TagVocabulary):
+    """
+    Returns PostDifference of difference, or difference itself if it can't be compacted
+    """
+    record = PostDifference.from_difference(difference, vocabulary)
+    return record if record is not None else difference
+
+def expand_difference(stored, vocabulary:TagVocabulary):
+    """
+    Returns difference in (new_dict, old_dict) format of value returned by compact_difference
+    """
+    return stored.to_difference(vocabulary) if isinstance(stored, PostDifference) else stored
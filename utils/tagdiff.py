@@ -0,0 +1,120 @@
+from threading import Lock
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+class TagVocabulary:
+    """
+    Maps tags (names or ids) to dense int32 indices
+    Ignore flags are computed once per tag when the tag is first seen, and kept as boolean array over indices
+    """
+    def __init__(self, should_ignore:Callable=None):
+        self.should_ignore = should_ignore
+        self.indices = {}
+        self.tags = []
+        self.lock = Lock()
+        self._ignored = np.zeros(1024, dtype=bool)
+    def index(self, tag) -> int:
+        """
+        Returns the index of the tag, adding it if it was not seen before
+        """
+        idx = self.indices.get(tag)
+        if idx is not None:
+            return idx
+        with self.lock:
+            idx = self.indices.get(tag)
+            if idx is not None:
+                return idx
+            idx = len(self.tags)
+            if idx >= len(self._ignored):
+                self._ignored = np.concatenate([self._ignored, np.zeros(len(self._ignored), dtype=bool)])
+            self._ignored[idx] = bool(self.should_ignore(tag)) if self.should_ignore is not None else False
+            self.tags.append(tag)
+            self.indices[tag] = idx
+            return idx
+    def encode(self, tags:List) -> np.ndarray:
+        """
+        Returns sorted unique indices of the tags
+        """
+        return np.unique(np.fromiter((self.index(tag) for tag in tags), dtype=np.int32, count=len(tags)))
+    def decode(self, indices:np.ndarray) -> List:
+        tags = self.tags
+        return [tags[idx] for idx in indices.tolist()]
+    @property
+    def ignored(self) -> np.ndarray:
+        """
+        Boolean mask over indices, True if tag should be ignored
+        """
+        return self._ignored[:len(self.tags)]
+
+class CSRTagLists:
+    """
+    Tag lists of multiple posts in CSR layout
+    Row i holds sorted unique tag indices indices[indptr[i]:indptr[i+1]]
+    """
+    def __init__(self, indptr:np.ndarray, indices:np.ndarray):
+        self.indptr = indptr
+        self.indices = indices
+    @classmethod
+    def from_lists(cls, tag_lists:List[List], vocabulary:TagVocabulary):
+        rows = [vocabulary.encode(tags) for tags in tag_lists]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(row) for row in rows], out=indptr[1:])
+        indices = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+        return cls(indptr, indices.astype(np.int32, copy=False))
+    def __len__(self):
+        return len(self.indptr) - 1
+    def keys(self) -> np.ndarray:
+        """
+        Returns (row << 32 | tag) keys, sorted since rows are sorted
+        """
+        rows = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+        return (rows << 32) | self.indices.astype(np.int64)
+
+def split_keys(keys:np.ndarray, rows:int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Splits (row << 32 | tag) keys into indptr and tag indices
+    """
+    row_ids = keys >> 32
+    indptr = np.searchsorted(row_ids, np.arange(rows + 1, dtype=np.int64))
+    return indptr, (keys & 0xFFFFFFFF).astype(np.int32)
+
+def diff_csr(new:CSRTagLists, old:CSRTagLists, ignored:np.ndarray):
+    """
+    Computes added (new - old) and removed (old - new) tags per row
+    Returns changed, added, removed
+    changed is boolean array, True if row differs before ignored tags are removed
+    added and removed are CSRTagLists without ignored tags
+    """
+    assert len(new) == len(old), f"row count mismatch, {len(new)} != {len(old)}"
+    rows = len(new)
+    new_keys, old_keys = new.keys(), old.keys()
+    added_keys = np.setdiff1d(new_keys, old_keys, assume_unique=True)
+    removed_keys = np.setdiff1d(old_keys, new_keys, assume_unique=True)
+    changed = np.zeros(rows, dtype=bool)
+    changed[added_keys >> 32] = True
+    changed[removed_keys >> 32] = True
+    # ignore meta tags
+    added_keys = added_keys[~ignored[added_keys & 0xFFFFFFFF]]
+    removed_keys = removed_keys[~ignored[removed_keys & 0xFFFFFFFF]]
+    return changed, CSRTagLists(*split_keys(added_keys, rows)), CSRTagLists(*split_keys(removed_keys, rows))
+
+def diff_tag_lists(new_lists:List[List], old_lists:List[List], vocabulary:TagVocabulary) -> List[Tuple[List, List]]:
+    """
+    Returns (added, removed) per row, or None for rows without difference
+    """
+    changed, added, removed = diff_csr(
+        CSRTagLists.from_lists(new_lists, vocabulary),
+        CSRTagLists.from_lists(old_lists, vocabulary),
+        vocabulary.ignored,
+    )
+    result = []
+    for row in range(len(changed)):
+        if not changed[row]:
+            result.append(None)
+            continue
+        result.append((
+            vocabulary.decode(added.indices[added.indptr[row]:added.indptr[row + 1]]),
+            vocabulary.decode(removed.indices[removed.indptr[row]:removed.indptr[row + 1]]),
+        ))
+    return result
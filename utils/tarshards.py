@@ -0,0 +1,142 @@
+"""
+Sequential tar shards of samples in WebDataset format
+Members of one sample share the key as name, e.g. 123.jpg and 123.json
+Shards are written to a temporary file and renamed when complete, then their members are appended to the index,
+so the index only lists complete shards and can be used to resume packing
+Shards renamed by an interrupted run before their samples were indexed are removed on start and their samples packed again
+"""
+
+import os
+import re
+import glob
+import time
+import tarfile
+from io import BytesIO
+
+from utils import jsoncodec
+from utils.idset import BitmapIdSet
+
+TAR_BLOCK = 512
+
+def truncate_partial_line(filepath, chunk_size=1 << 16):
+    """
+    Removes last line of file if it does not end with newline, left by an interrupted append
+    """
+    with open(filepath, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - chunk_size)
+            f.seek(start)
+            chunk = f.read(position - start)
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position != end:
+            f.truncate(position)
+
+class ShardWriter:
+    """
+    Writes samples to {directory}/{prefix}-{number:06d}.tar
+    A shard is completed when it exceeds max_size bytes or max_count samples
+    Index is jsonl of {"id", "shard", "members": {ext: [data offset, size]}} per sample, data can be read with one seek
+    packed holds ids of added samples, ids of indexed samples are loaded on start
+    """
+    def __init__(self, directory, prefix="shard", max_size=1 << 30, max_count=10000, index_file="index.jsonl"):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_size = max_size
+        self.max_count = max_count
+        self.index_path = os.path.join(directory, index_file)
+        os.makedirs(directory, exist_ok=True)
+        self.packed = BitmapIdSet()
+        indexed_shards = set()
+        if os.path.exists(self.index_path):
+            truncate_partial_line(self.index_path)
+            for entry in jsoncodec.iter_jsonl(self.index_path):
+                self.packed.add(entry["id"])
+                indexed_shards.add(entry["shard"])
+        # incomplete shard of interrupted run, its samples are not indexed
+        for temp_path in glob.glob(os.path.join(directory, f"{prefix}-*.tar.tmp")):
+            os.remove(temp_path)
+        shard_paths = glob.glob(os.path.join(directory, f"{prefix}-*.tar"))
+        for path in shard_paths:
+            if os.path.basename(path) not in indexed_shards:
+                # complete shard whose samples were not indexed, its samples are not in packed and are packed again
+                print(f"Removing shard {path} missing from index")
+                os.remove(path)
+        numbers = [int(match.group(1)) for match in (re.search(r"-(\d+)\.tar$", path) for path in shard_paths if os.path.basename(path) in indexed_shards) if match]
+        self.number = max(numbers) + 1 if numbers else 0
+        self.tar = None
+        self.entries = []
+    def shard_name(self):
+        return f"{self.prefix}-{self.number:06d}.tar"
+    def _open(self):
+        self.temp_path = os.path.join(self.directory, self.shard_name() + ".tmp")
+        self.tar = tarfile.open(self.temp_path, "w", format=tarfile.GNU_FORMAT)
+        self.entries = []
+    def _add_member(self, name, fileobj, size, mtime):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        self.tar.addfile(info, fileobj)
+        # offset is at the end of padded data after addfile
+        return self.tar.offset - (size + TAR_BLOCK - 1) // TAR_BLOCK * TAR_BLOCK
+    def add(self, key, members):
+        """
+        Adds sample of members [(ext, path or bytes)], files are streamed from disk
+        Returns name of shard the sample was written to
+        """
+        if self.tar is None:
+            self._open()
+        now = time.time()
+        entry = {"id": key, "shard": self.shard_name(), "members": {}}
+        for ext, data in members:
+            name = f"{key}.{ext}"
+            if isinstance(data, (bytes, bytearray)):
+                offset = self._add_member(name, BytesIO(data), len(data), now)
+                entry["members"][ext] = [offset, len(data)]
+            else:
+                stat = os.stat(data)
+                with open(data, "rb") as f:
+                    offset = self._add_member(name, f, stat.st_size, stat.st_mtime)
+                entry["members"][ext] = [offset, stat.st_size]
+        self.entries.append(entry)
+        self.packed.add(key)
+        shard_name = self.shard_name()
+        if self.tar.offset >= self.max_size or len(self.entries) >= self.max_count:
+            self.finish_shard()
+        return shard_name
+    def finish_shard(self):
+        """
+        Completes current shard and appends its samples to the index
+        Returns list of packed ids
+        """
+        if self.tar is None:
+            return []
+        self.tar.close()
+        self.tar = None
+        os.replace(self.temp_path, os.path.join(self.directory, self.shard_name()))
+        with open(self.index_path, "ab") as f:
+            f.write(b"".join(jsoncodec.dumps_line(entry) for entry in self.entries))
+            f.flush()
+            os.fsync(f.fileno())
+        ids = [entry["id"] for entry in self.entries]
+        self.entries = []
+        self.number += 1
+        return ids
+    def close(self):
+        return self.finish_shard()
+
+def read_sample(directory, entry):
+    """
+    Returns {ext: bytes} of index entry
+    """
+    members = {}
+    with open(os.path.join(directory, entry["shard"]), "rb") as f:
+        for ext, (offset, size) in entry["members"].items():
+            f.seek(offset)
+            members[ext] = f.read(size)
+    return members